@@ -20,4 +20,5 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=DeprecationWarning)
     from .visiondatamodule import *
 from .datamodules import *
+from .patch_queue import PatchQueue
 from .gan_queue import GANQueue
@@ -9,16 +9,21 @@ split, transform, and process the data.
 """
 
 from abc import ABCMeta, abstractmethod
-from typing import Any, Optional, Type, Union, Tuple
+from typing import Any, Dict, Optional, Type, Union, Tuple
 from pathlib import Path
 import tempfile
 import torchio as tio
 import pytorch_lightning as pl
+from torch.utils.data import Dataset
 from radio.settings.pathutils import DATA_ROOT, PathType
 from .validation import (EvalDataLoaderType, TrainDataLoaderType,
                          KFoldValidation, OneFoldValidation, ValidationType)
 from .dataset import TrainDatasetType, EvalDatasetType
-from .datatypes import EvalSizeType, TrainSizeType
+from .datatypes import EvalSizeType, SpatialShapeType, TrainSizeType
+from .subjects_loader import SubjectsPool
+from .foreground_filter import ForegroundFilter
+from .patch_queue import PatchQueue, resize_sampler
+from .queue_autoscaler import QueueAutoscaler
 
 __all__ = ["BaseDataModule"]
 
@@ -154,6 +159,242 @@ class BaseDataModule(pl.LightningDataModule, metaclass=ABCMeta):
         self.validation: ValidationType
         self.has_validation = False
         self.val_split = val_split
+        # Checkpointing of the data state
+        self.checkpoint_patches = False
+        self._pending_state: Optional[Dict[str, Any]] = None
+        # Options of the queues of the patch datamodules, see get_queue
+        self.train_sampler: tio.data.PatchSampler
+        self.queue_max_length: int
+        self.samples_per_volume: int
+        self.shuffle_subjects: bool
+        self.shuffle_patches: bool
+        self.start_background: bool
+        self.verbose: bool
+        self.autoscale_queue = False
+        # Workers shared by the queues of the datamodule
+        self.share_workers = False
+        self.subjects_cache_size = 0
+        self._subjects_pool: Optional[SubjectsPool] = None
+        # Rejection of background patches by the queues
+        self.min_foreground_fraction = 0.0
+        self.foreground_image: Optional[str] = None
+
+    def get_subjects_pool(self) -> Optional[SubjectsPool]:
+        """
+        Get the pool of workers shared by the queues of the datamodule.
+
+        A new pool is created once the workers of the current pool have
+        started, so that the queues created by a new call to ``setup`` can
+        register their datasets.
+
+        Returns
+        -------
+        _ : SubjectsPool, optional
+            Pool of ``num_workers`` workers caching ``subjects_cache_size``
+            subjects each, or ``None`` if ``share_workers`` is ``False`` or
+            ``num_workers`` is ``0``.
+        """
+        if not self.share_workers or self.num_workers == 0:
+            return None
+        pool = self._subjects_pool
+        if pool is None or pool.is_started:
+            if pool is not None:
+                pool.close()
+            self._subjects_pool = SubjectsPool(
+                self.num_workers, cache_size=self.subjects_cache_size)
+        return self._subjects_pool
+
+    def get_foreground_filter(self) -> Optional[ForegroundFilter]:
+        """
+        Get a filter of the background patches for a queue of the
+        datamodule.
+
+        Each call returns a new filter, so that the accepted and rejected
+        counts of the train and validation queues are kept apart.
+
+        Returns
+        -------
+        _ : ForegroundFilter, optional
+            Filter rejecting the patches with a fraction of foreground voxels
+            of ``foreground_image`` below ``min_foreground_fraction``, or
+            ``None`` if ``min_foreground_fraction`` is ``0``.
+        """
+        if self.min_foreground_fraction <= 0:
+            return None
+        return ForegroundFilter(self.min_foreground_fraction,
+                                image_name=self.foreground_image)
+
+    def get_queue(self,
+                  dataset: Dataset,
+                  queue_cls: Type[PatchQueue] = PatchQueue,
+                  **extra: Any) -> PatchQueue:
+        """
+        Instantiate a patches queue over ``dataset``.
+
+        The queue draws ``samples_per_volume`` patches of each subject with
+        ``train_sampler``, keeps at most ``queue_max_length`` of them, and
+        loads the subjects with ``num_workers`` workers, as set by the patch
+        datamodules. Their other queue options are:
+
+        * ``autoscale_queue``: if ``True``, ``samples_per_volume`` and
+          ``queue_max_length`` are only initial values, adjusted by the
+          queues between epochs to avoid starving the model while mixing as
+          many subjects as possible. Samples per volume are kept between
+          ``1`` and ``queue_max_length``, and the queue length between
+          ``batch_size`` and ``queue_max_length``.
+        * ``share_workers``: if ``True`` and ``num_workers > 0``, the train
+          and validation queues load their subjects with a single pool of
+          ``num_workers`` workers, instead of ``num_workers`` workers each.
+          Subjects are delivered to the queues as soon as they are loaded.
+        * ``subjects_cache_size``: number of decoded subjects cached by each
+          shared worker, so that the subjects loaded by both queues are read
+          from disk once while they are cached. Only used if
+          ``share_workers`` is ``True``.
+        * ``min_foreground_fraction``: if positive, patches with a lower
+          fraction of foreground voxels are replaced by new draws before
+          they are queued. See
+          :class:`~radio.data.foreground_filter.ForegroundFilter`.
+        * ``foreground_image``: name of the image defining the foreground,
+          e.g., a brain mask. If ``None``, the first image of each subject is
+          used, and voxels above ``0`` are foreground.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            Dataset from which the queue extracts patches.
+        queue_cls : Type[PatchQueue], optional
+            Class of the queue. Default = ``PatchQueue``.
+        **extra : Any
+            Extra arguments of ``queue_cls``.
+
+        Returns
+        -------
+        _ : PatchQueue
+            Queue of patches from ``dataset``.
+        """
+        autoscaler = None
+        if self.autoscale_queue:
+            autoscaler = QueueAutoscaler(
+                max_samples_per_volume=self.queue_max_length,
+                min_length=min(self.batch_size, self.queue_max_length),
+                max_length=self.queue_max_length)
+        return queue_cls(dataset,
+                         max_length=self.queue_max_length,
+                         samples_per_volume=self.samples_per_volume,
+                         sampler=self.train_sampler,
+                         num_workers=self.num_workers,
+                         shuffle_subjects=self.shuffle_subjects,
+                         shuffle_patches=self.shuffle_patches,
+                         start_background=self.start_background,
+                         autoscaler=autoscaler,
+                         subjects_pool=self.get_subjects_pool(),
+                         foreground_filter=self.get_foreground_filter(),
+                         verbose=self.verbose,
+                         **extra)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Get the state of the data, to resume training mid-epoch from a
+        checkpoint.
+
+        The state holds the train/validation split and, for queues that can
+        be checkpointed, the subjects order, position in the epoch and RNG
+        states of the queues. Queued patches are included if
+        ``checkpoint_patches`` is ``True``.
+
+        Returns
+        -------
+        _ : Dict[str, Any]
+            State of the data.
+        """
+        state: Dict[str, Any] = {}
+        if self.has_validation:
+            state['validation'] = self.validation.state_dict()
+        for name in ('train_queue', 'val_queue'):
+            queue = getattr(self, name, None)
+            if hasattr(queue, 'state_dict'):
+                state[name] = queue.state_dict(
+                    include_patches=self.checkpoint_patches)
+        return state
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Restore a state returned by ``state_dict``.
+
+        If ``setup`` was not called yet, the state is restored at the end of
+        ``setup``.
+
+        Parameters
+        ----------
+        state_dict : Dict[str, Any]
+            State of the data.
+        """
+        self._pending_state = state_dict
+        if hasattr(self, 'train_dataset'):
+            self._restore_state()
+
+    def _restore_state(self) -> None:
+        """Restore the state passed to ``load_state_dict``, if any."""
+        if self._pending_state is None:
+            return
+        state = self._pending_state
+        self._pending_state = None
+        if self.has_validation and 'validation' in state:
+            self.validation.load_state_dict(state['validation'])
+            self._update_sizes()
+        for name in ('train_queue', 'val_queue'):
+            queue = getattr(self, name, None)
+            if name in state and hasattr(queue, 'load_state_dict'):
+                queue.load_state_dict(state[name])
+
+    def _update_sizes(self) -> None:
+        """Compute again the sizes of the train and validation data."""
+        size_train = getattr(self, 'size_train_dataset', None)
+        size_eval = getattr(self, 'size_eval_dataset', None)
+        if size_train is None or size_eval is None:
+            return
+        if self.has_validation:
+            self.size_train = size_train(self.validation.train_samplers)
+            self.size_val = size_eval(self.validation.val_samplers)
+        elif hasattr(self, 'train_dataset'):
+            self.size_train = size_train(self.train_dataset)
+            if hasattr(self, 'val_dataset'):
+                self.size_val = size_eval(self.val_dataset)
+
+    def set_patch_size(self,
+                       patch_size: SpatialShapeType,
+                       samples_per_volume: Optional[int] = None) -> None:
+        """
+        Change the size of the patches of the queues, e.g., between epochs
+        for progressive-resolution training.
+
+        The queues discard their patches and fill again with patches of the
+        new size, keeping their subjects loaders and workers alive. Queues
+        created by a later call to ``setup`` use the new size too. With a
+        train/validation split, the number of patches per epoch of the split
+        samplers is the one computed in ``setup``.
+
+        Parameters
+        ----------
+        patch_size : SpatialShapeType
+            New size of the patches.
+        samples_per_volume : int, optional
+            If not ``None``, new default number of patches extracted from
+            each volume. Default = ``None``.
+        """
+        sampler = getattr(self, 'train_sampler', None)
+        if sampler is None:
+            raise RuntimeError(
+                f'{type(self).__name__} does not sample patches.')
+        self.train_sampler = resize_sampler(sampler, patch_size)
+        self.patch_size = patch_size
+        if samples_per_volume is not None:
+            self.samples_per_volume = samples_per_volume
+        for name in ('train_queue', 'val_queue'):
+            queue = getattr(self, name, None)
+            if hasattr(queue, 'set_patch_size'):
+                queue.set_patch_size(patch_size, samples_per_volume)
+        self._update_sizes()
 
     @abstractmethod
     def prepare_data(self, *args: Any, **kwargs: Any) -> None:
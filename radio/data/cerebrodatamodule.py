@@ -13,7 +13,7 @@ from typing import (Any, Mapping, Optional, Sequence, Sized, List, Tuple, cast,
                     Union, Dict)
 from pathlib import Path
 import shutil
-from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data import DataLoader, IterableDataset, RandomSampler
 import torchio as tio
 import numpy as np
 from ..settings.pathutils import is_dir_or_symlink, PathType
@@ -22,6 +22,8 @@ from .datautils import create_probability_map
 from .dataset import DatasetType
 from .validation import TrainDataLoaderType, EvalDataLoaderType
 from .basedatamodule import BaseDataModule
+from .patch_queue import PatchQueue
+from .subjects_loader import CacheableSubjectsDataset
 from .datatypes import TrainSizeType, EvalSizeType
 
 __all__ = ["CerebroDataModule"]
@@ -148,6 +150,23 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
     start_background : bool, optional
         If ``True``, the loader will start working in the background as soon as
         the queues are instantiated. Default = ``True``.
+    autoscale_queue : bool, optional
+        Adjust ``samples_per_volume`` and ``queue_max_length`` between
+        epochs, see :meth:`~radio.data.BaseDataModule.get_queue`.
+        Default = ``False``.
+    share_workers : bool, optional
+        Load the subjects of the train and validation queues with a single
+        pool of ``num_workers`` workers, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``False``.
+    subjects_cache_size : int, optional
+        Number of decoded subjects cached by each shared worker, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``0``.
+    min_foreground_fraction : float, optional
+        Minimum fraction of foreground voxels of the queued patches, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``0``.
+    foreground_image : str, optional
+        Name of the image defining the foreground of the patches, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``None``.
     drop_last : bool, optional
         Set to ``True`` to drop the last incomplete batch, if the dataset size
         is not divisible by the batch size. If ``False`` and the size of
@@ -175,7 +194,7 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
     #: Dataset name
     name: str = ""
     #: Dataset class to use. E.g., torchvision.datasets.MNIST
-    dataset_cls = tio.SubjectsDataset
+    dataset_cls = CacheableSubjectsDataset
     #: Extra arguments for dataset_cls instantiation.
     EXTRA_ARGS: dict = {}
 
@@ -207,6 +226,11 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
         num_workers: int = 0,
         pin_memory: bool = True,
         start_background: bool = True,
+        autoscale_queue: bool = False,
+        share_workers: bool = False,
+        subjects_cache_size: int = 0,
+        min_foreground_fraction: float = 0.0,
+        foreground_image: Optional[str] = None,
         drop_last: bool = False,
         num_folds: int = 2,
         val_split: Union[int, float] = 0.2,
@@ -277,13 +301,18 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
             self.label_probabilities = label_probabilities
 
             # Queue parameters
-            self.train_queue: tio.Queue
-            self.val_queue: tio.Queue
+            self.train_queue: PatchQueue
+            self.val_queue: PatchQueue
             self.queue_max_length = queue_max_length
             self.samples_per_volume = samples_per_volume
             self.shuffle_subjects = shuffle_subjects
             self.shuffle_patches = shuffle_patches
             self.start_background = start_background
+            self.autoscale_queue = autoscale_queue
+            self.share_workers = share_workers
+            self.subjects_cache_size = subjects_cache_size
+            self.min_foreground_fraction = min_foreground_fraction
+            self.foreground_image = foreground_image
 
     def check_if_data_split(self) -> None:
         """
@@ -326,6 +355,7 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
             self._setup_no_queue(stage)
         else:
             self._setup_with_queue(stage)
+        self._restore_state()
 
     def _setup_no_queue(self, stage: Optional[str] = None) -> None:
         """
@@ -437,27 +467,9 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
                     train_subjects,
                     transform=val_transforms,
                 )
-                self.train_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, train_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
-
-                self.val_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, val_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.train_queue = self.get_queue(train_dataset)
+
+                self.val_queue = self.get_queue(val_dataset)
 
                 self.validation = self.val_cls(
                     train_dataset=self.train_queue,
@@ -484,16 +496,7 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
                     train_subjects = self.add_sampling_map(train_subjects)
                 train_dataset = self.dataset_cls(train_subjects,
                                                  transform=train_transforms)
-                self.train_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, train_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.train_queue = self.get_queue(train_dataset)
 
                 val_subjects = self.get_subjects(fold="val")
                 if self.create_custom_probability_map:
@@ -503,16 +506,7 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
                 self.train_dataset = self.train_queue
                 self.size_train = self.size_train_dataset(self.train_dataset)
 
-                self.val_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, val_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.val_queue = self.get_queue(val_dataset)
                 self.val_dataset = self.val_queue
                 self.size_val = self.size_eval_dataset(self.val_dataset)
 
@@ -795,10 +789,18 @@ class CerebroDataModule(BaseDataModule, metaclass=ABCMeta):
         """
         shuffle = shuffle if shuffle else self.shuffle
         shuffle &= not isinstance(dataset, IterableDataset)
+        sampler = None
+        if hasattr(dataset, 'get_epoch_sampler'):
+            # Patches queues start a new epoch each time the loader is
+            # iterated
+            sampler = dataset.get_epoch_sampler(
+                RandomSampler(dataset) if shuffle else None)
+            shuffle = False
         return DataLoader(
             dataset=dataset,
             batch_size=batch_size if batch_size else self.batch_size,
             shuffle=shuffle,
+            sampler=sampler,
             num_workers=num_workers if num_workers else self.num_workers,
             pin_memory=pin_memory if pin_memory else self.pin_memory,
             drop_last=drop_last if drop_last else self.drop_last,
@@ -8,12 +8,14 @@ models. They also allow you to share a full dataset without explaining how to
 download, split, transform, and process the data.
 """
 
-from typing import Any, Dict, List, Optional, Tuple, Union, cast
+from typing import Any, Dict, List, Optional, Tuple, Union
 from pathlib import Path
 from string import Template
 import torchio as tio  # type: ignore
 from radio.settings.pathutils import PathType
 from ..datatypes import SpatialShapeType
+from ..patch_queue import PatchQueue
+from ..subjects_loader import CacheableSubjectsDataset
 from .brain_aging_prediction import BrainAgingPredictionDataModule
 
 __all__ = ["BrainAgingPredictionPatchDataModule"]
@@ -129,6 +131,23 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
     start_background : bool, optional
         If ``True``, the loader will start working in the background as soon as
         the queues are instantiated. Default = ``True``.
+    autoscale_queue : bool, optional
+        Adjust ``samples_per_volume`` and ``queue_max_length`` between
+        epochs, see :meth:`~radio.data.BaseDataModule.get_queue`.
+        Default = ``False``.
+    share_workers : bool, optional
+        Load the subjects of the train and validation queues with a single
+        pool of ``num_workers`` workers, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``False``.
+    subjects_cache_size : int, optional
+        Number of decoded subjects cached by each shared worker, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``0``.
+    min_foreground_fraction : float, optional
+        Minimum fraction of foreground voxels of the queued patches, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``0``.
+    foreground_image : str, optional
+        Name of the image defining the foreground of the patches, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``None``.
     drop_last : bool, optional
         Set to ``True`` to drop the last incomplete batch, if the dataset size
         is not divisible by the batch size. If ``False`` and the size of
@@ -161,7 +180,7 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
     #: Extra arguments for dataset_cls instantiation.
     EXTRA_ARGS: dict = {}
     #: Dataset class to use. E.g., torchvision.datasets.MNIST
-    dataset_cls = tio.SubjectsDataset
+    dataset_cls = CacheableSubjectsDataset
     #: A tuple describing the shape of the data
     dims: Optional[Tuple[int, int, int]]
     #: Dataset name
@@ -197,6 +216,11 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
         num_workers: int = 0,
         pin_memory: bool = True,
         start_background: bool = True,
+        autoscale_queue: bool = False,
+        share_workers: bool = False,
+        subjects_cache_size: int = 0,
+        min_foreground_fraction: float = 0.0,
+        foreground_image: Optional[str] = None,
         drop_last: bool = False,
         num_folds: int = 2,
         val_split: Union[int, float] = 0.2,
@@ -256,13 +280,18 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
         self.label_probabilities = label_probabilities
 
         # Queue parameters
-        self.train_queue: tio.Queue
-        self.val_queue: tio.Queue
+        self.train_queue: PatchQueue
+        self.val_queue: PatchQueue
         self.queue_max_length = queue_max_length
         self.samples_per_volume = samples_per_volume
         self.shuffle_subjects = shuffle_subjects
         self.shuffle_patches = shuffle_patches
         self.start_background = start_background
+        self.autoscale_queue = autoscale_queue
+        self.share_workers = share_workers
+        self.subjects_cache_size = subjects_cache_size
+        self.min_foreground_fraction = min_foreground_fraction
+        self.foreground_image = foreground_image
 
     def setup(self, stage: Optional[str] = None) -> None:
         """
@@ -293,27 +322,9 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
                     train_subjects,
                     transform=val_transforms,
                 )
-                self.train_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, train_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
-
-                self.val_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, val_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.train_queue = self.get_queue(train_dataset)
+
+                self.val_queue = self.get_queue(val_dataset)
 
                 self.validation = self.val_cls(
                     train_dataset=self.train_queue,
@@ -338,16 +349,7 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
                 train_subjects = self.get_subjects(fold="train")
                 train_dataset = self.dataset_cls(train_subjects,
                                                  transform=train_transforms)
-                self.train_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, train_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.train_queue = self.get_queue(train_dataset)
 
                 val_subjects = self.get_subjects(fold="val")
                 val_dataset = self.dataset_cls(val_subjects,
@@ -355,16 +357,7 @@ class BrainAgingPredictionPatchDataModule(BrainAgingPredictionDataModule):
                 self.train_dataset = self.train_queue
                 self.size_train = self.size_train_dataset(self.train_dataset)
 
-                self.val_queue = tio.Queue(
-                    cast(tio.SubjectsDataset, val_dataset),
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.val_queue = self.get_queue(val_dataset)
                 self.val_dataset = self.val_queue
                 self.size_val = self.size_eval_dataset(self.val_dataset)
 
@@ -8,7 +8,8 @@ models. They also allow you to share a full dataset without explaining how to
 download, split, transform, and process the data.
 """
 
-from typing import Any, Dict, List, Optional, Tuple, Union, cast
+from typing import (Any, Callable, Dict, List, Optional, Tuple, Type, Union,
+                    cast)
 from operator import itemgetter
 from pathlib import Path
 from string import Template
@@ -18,12 +19,13 @@ import torchio as tio  # type: ignore
 import numpy as np
 from tqdm import tqdm
 import psutil
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from radio.settings.pathutils import PathType, ensure_exists
 from ..datatypes import SpatialShapeType
 from ..datavisualization import rotate, import_mpl_plt
 from .mri_3t27t import MRI3T27TDataModule
 from ..unpaired_dataset import MRIUnpairedDataset
+from ..patch_queue import PatchQueue
 from ..gan_queue import GANQueue
 
 __all__ = ["MRI3T27TPatchDataModule"]
@@ -131,6 +133,55 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
     start_background : bool, optional
         If ``True``, the loader will start working in the background as soon as
         the queues are instantiated. Default = ``True``.
+    persistent_workers : bool, optional
+        If ``True``, the subjects loaders of the queues keep their workers
+        alive across epochs. Default = ``True``.
+    double_buffer : bool, optional
+        If ``True``, the queues are refilled by a background thread while the
+        current patches are consumed. If ``False``, the queues are filled
+        synchronously when they run empty. Default = ``False``.
+    patch_storage : str, optional
+        How the queues store patches, either ``'list'`` of subjects or
+        preallocated ``'tensor'`` buffers. Default = ``'list'``.
+    storage_dtype : str, optional
+        If not ``None``, store the queued patches compressed as
+        ``'float16'``, ``'bfloat16'`` or ``'int16'``. Requires
+        ``patch_storage='tensor'``. Default = ``None``.
+    batch_queue : bool, optional
+        If ``True``, the queues yield ready-made batches of ``batch_size``
+        patches gathered from their storage, instead of single patches
+        collated by the dataloaders. Requires ``patch_storage='tensor'``.
+        Default = ``False``.
+    decouple_domains : bool, optional
+        If ``True``, the queues refill each domain independently, loading a
+        volume of a domain only when that domain runs out of patches.
+        Default = ``False``.
+    checkpoint_patches : bool, optional
+        If ``True``, ``state_dict`` includes the patches held by the queues,
+        so that a resumed run pops the same patches. Otherwise, only the
+        subjects order and position in the epoch are saved.
+        Default = ``False``.
+    autoscale_queue : bool, optional
+        Adjust ``samples_per_volume`` and ``queue_max_length`` between
+        epochs, see :meth:`~radio.data.BaseDataModule.get_queue`.
+        Default = ``False``.
+    unordered_subjects : bool, optional
+        If ``True`` and ``num_workers > 0``, the queues receive each subject
+        as soon as a worker has loaded it, so a slow subject does not hold
+        back the others. Default = ``False``.
+    share_workers : bool, optional
+        Load the subjects of the train and validation queues with a single
+        pool of ``num_workers`` workers, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``False``.
+    subjects_cache_size : int, optional
+        Number of decoded subjects cached by each shared worker, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``0``.
+    min_foreground_fraction : float, optional
+        Minimum fraction of foreground voxels of the queued patches, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``0``.
+    foreground_image : str, optional
+        Name of the image defining the foreground of the patches, see
+        :meth:`~radio.data.BaseDataModule.get_queue`. Default = ``None``.
     drop_last : bool, optional
         Set to ``True`` to drop the last incomplete batch, if the dataset size
         is not divisible by the batch size. If ``False`` and the size of
@@ -197,6 +248,19 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
         num_workers: int = 0,
         pin_memory: bool = True,
         start_background: bool = True,
+        persistent_workers: bool = True,
+        double_buffer: bool = False,
+        patch_storage: str = 'list',
+        storage_dtype: Optional[str] = None,
+        batch_queue: bool = False,
+        decouple_domains: bool = False,
+        checkpoint_patches: bool = False,
+        autoscale_queue: bool = False,
+        unordered_subjects: bool = False,
+        share_workers: bool = False,
+        subjects_cache_size: int = 0,
+        min_foreground_fraction: float = 0.0,
+        foreground_image: Optional[str] = None,
         drop_last: bool = False,
         num_folds: int = 2,
         val_split: Union[int, float] = 0.2,
@@ -270,6 +334,64 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
         self.shuffle_subjects = shuffle_subjects
         self.shuffle_patches = shuffle_patches
         self.start_background = start_background
+        self.persistent_workers = persistent_workers
+        self.double_buffer = double_buffer
+        self.patch_storage = patch_storage
+        self.storage_dtype = storage_dtype
+        self.batch_queue = batch_queue
+        self.decouple_domains = decouple_domains
+        self.checkpoint_patches = checkpoint_patches
+        self.autoscale_queue = autoscale_queue
+        self.unordered_subjects = unordered_subjects
+        self.share_workers = share_workers
+        self.subjects_cache_size = subjects_cache_size
+        self.min_foreground_fraction = min_foreground_fraction
+        self.foreground_image = foreground_image
+
+    def get_dataset(
+            self,
+            fold: str = "train",
+            transform: Optional[Callable] = None,
+            add_sampling_map: bool = False,
+            patch_size: SpatialShapeType = (96, 96, 1),
+    ) -> MRIUnpairedDataset:
+        """
+        Get train, test, or val dataset, see
+        :meth:`MRI3T27TDataModule.get_dataset`.
+
+        If the shared workers cache the subjects, the images of the subjects
+        are loaded when they are indexed, so that they are read through the
+        cache.
+        """
+        dataset = super().get_dataset(fold=fold,
+                                      transform=transform,
+                                      add_sampling_map=add_sampling_map,
+                                      patch_size=patch_size)
+        if self.share_workers and self.subjects_cache_size > 0:
+            dataset.load_getitem = True
+        return dataset
+
+    def get_queue(self,
+                  dataset: Dataset,
+                  queue_cls: Type[PatchQueue] = GANQueue,
+                  **extra: Any) -> GANQueue:
+        """
+        Instantiate a queue of patches of both domains over ``dataset``, see
+        :meth:`~radio.data.BaseDataModule.get_queue`, with the buffering,
+        storage and domain options of the datamodule.
+        """
+        queue = super().get_queue(
+            dataset,
+            queue_cls,
+            persistent_workers=self.persistent_workers,
+            double_buffer=self.double_buffer,
+            patch_storage=self.patch_storage,
+            storage_dtype=self.storage_dtype,
+            batch_size=self.batch_size if self.batch_queue else None,
+            decouple_domains=self.decouple_domains,
+            unordered_subjects=self.unordered_subjects,
+            **extra)
+        return cast(GANQueue, queue)
 
     def setup(self, stage: Optional[str] = None) -> None:
         """
@@ -302,36 +424,18 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
                     transform=val_transforms,
                     add_sampling_map=self.create_custom_probability_map,
                     patch_size=self.patch_size)
-                self.train_queue = GANQueue(
-                    train_dataset,
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
-
-                self.val_queue = GANQueue(
-                    val_dataset,
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.train_queue = self.get_queue(train_dataset)
+                self.val_queue = self.get_queue(val_dataset)
 
+                # Batch queues already yield batches
                 self.validation = self.val_cls(
                     train_dataset=self.train_queue,
                     val_dataset=self.val_queue,
-                    batch_size=self.batch_size,
+                    batch_size=None if self.batch_queue else self.batch_size,
                     shuffle=False,
                     num_workers=0,
                     pin_memory=self.pin_memory,
-                    drop_last=self.drop_last,
+                    drop_last=self.drop_last and not self.batch_queue,
                     num_folds=self.num_folds,
                     seed=self.seed,
                 )
@@ -349,16 +453,7 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
                     transform=train_transforms,
                     add_sampling_map=self.create_custom_probability_map,
                     patch_size=self.patch_size)
-                self.train_queue = GANQueue(
-                    train_dataset,
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.train_queue = self.get_queue(train_dataset)
 
                 self.train_dataset = self.train_queue
                 self.size_train = self.size_train_dataset(self.train_dataset)
@@ -368,16 +463,7 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
                     transform=val_transforms,
                     add_sampling_map=self.create_custom_probability_map,
                     patch_size=self.patch_size)
-                self.val_queue = GANQueue(
-                    val_dataset,
-                    max_length=self.queue_max_length,
-                    samples_per_volume=self.samples_per_volume,
-                    sampler=self.train_sampler,
-                    num_workers=self.num_workers,
-                    shuffle_subjects=self.shuffle_subjects,
-                    shuffle_patches=self.shuffle_patches,
-                    start_background=self.start_background,
-                    verbose=self.verbose)
+                self.val_queue = self.get_queue(val_dataset)
                 self.val_dataset = self.val_queue
                 self.size_val = self.size_eval_dataset(self.val_dataset)
 
@@ -391,6 +477,7 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
                 add_sampling_map=self.create_custom_probability_map,
                 patch_size=self.patch_size)
             self.size_test = self.size_eval_dataset(self.test_dataset)
+        self._restore_state()
 
     def get_preprocessing_transforms(
         self,
@@ -474,6 +561,8 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
         _ : Collection of DataLoader
             Collection of train dataloaders specifying training samples.
         """
+        if self.batch_queue and not self.has_validation:
+            return self._batch_queue_dataloader(self.train_queue)
         return super().train_dataloader(num_workers=0, shuffle=False)
 
     def val_dataloader(self, *args, **kwargs):
@@ -485,8 +574,23 @@ class MRI3T27TPatchDataModule(MRI3T27TDataModule):
         _ : Collection of DataLoader
             Collection of validation dataloaders specifying validation samples.
         """
+        if self.batch_queue and not self.has_validation:
+            return self._batch_queue_dataloader(self.val_queue)
         return super().val_dataloader(num_workers=0, shuffle=False)
 
+    def _batch_queue_dataloader(self, queue: GANQueue) -> DataLoader:
+        """
+        Get a dataloader that pops batches from a batch queue without
+        collating them again.
+        """
+        return DataLoader(
+            queue,
+            batch_size=None,
+            sampler=queue.get_epoch_sampler(),
+            num_workers=0,
+            pin_memory=self.pin_memory,
+        )
+
     def save(self,
              dataloader: DataLoader,
              root: PathType = Path(
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Rejection of background patches before they are inserted in a queue.
+"""
+
+from typing import Callable, Iterable, List, Optional
+
+import torch
+import torch.nn.functional as F
+from torchio import Subject, LOCATION
+from .summed_area import get_box_sums, get_summed_area_table
+
+__all__ = ["ForegroundFilter"]
+
+
+class ForegroundFilter:
+    """
+    Reject patches whose foreground fraction is below a threshold, drawing
+    new locations instead.
+
+    The foreground of a subject is the set of voxels of ``image_name`` above
+    ``threshold`` in any channel. When a subject is sampled, its foreground
+    is averaged over blocks of ``downsampling`` voxels per dimension, and the
+    summed-area table of this low-resolution mask is computed once. The
+    foreground fraction of any patch is then read from the table at the 8
+    corners of the patch, so checking a location costs the same whatever the
+    patch size. The table is interpolated between block boundaries, so the
+    fraction is an approximation, exact if the patch locations and sizes are
+    multiples of ``downsampling``.
+
+    A rejected location is replaced by a new draw of the sampler, up to
+    ``max_attempts`` times per patch. Patches still below the threshold after
+    the last attempt are kept, so that subjects with little foreground do not
+    stall the queue, and are counted in :attr:`num_forced`.
+
+    Parameters
+    ----------
+    min_fraction : float
+        Minimum foreground fraction of a patch, in ``[0, 1]``.
+    image_name : str, optional
+        Name of the image defining the foreground, e.g., a brain mask. If
+        ``None``, the first image of the subject is used. Default = ``None``.
+    threshold : float, optional
+        Intensity above which a voxel is foreground. Default = ``0``.
+    downsampling : int, optional
+        Size in voxels of the blocks of the low-resolution mask.
+        Default = ``4``.
+    max_attempts : int, optional
+        Maximum number of new draws for a rejected patch. Default = ``10``.
+    """
+
+    def __init__(self,
+                 min_fraction: float,
+                 image_name: Optional[str] = None,
+                 threshold: float = 0.0,
+                 downsampling: int = 4,
+                 max_attempts: int = 10) -> None:
+        if not 0 <= min_fraction <= 1:
+            raise ValueError('min_fraction must be in [0, 1].')
+        if downsampling < 1:
+            raise ValueError('downsampling must be at least 1.')
+        if max_attempts < 0:
+            raise ValueError('max_attempts must be non-negative.')
+        self.min_fraction = min_fraction
+        self.image_name = image_name
+        self.threshold = threshold
+        self.downsampling = downsampling
+        self.max_attempts = max_attempts
+        self.num_accepted = 0
+        self.num_rejected = 0
+        self.num_forced = 0
+
+    def __repr__(self) -> str:
+        attributes = [
+            f'min_fraction={self.min_fraction}',
+            f'num_accepted={self.num_accepted}',
+            f'num_rejected={self.num_rejected}',
+            f'num_forced={self.num_forced}',
+        ]
+        return f'ForegroundFilter({", ".join(attributes)})'
+
+    @property
+    def rejection_rate(self) -> float:
+        """Fraction of the drawn patches that were rejected."""
+        num_drawn = self.num_accepted + self.num_rejected + self.num_forced
+        return self.num_rejected / num_drawn if num_drawn else 0.0
+
+    def get_integral(self, subject: Subject) -> torch.Tensor:
+        """
+        Get the summed-area table of the low-resolution foreground mask.
+
+        Returns
+        -------
+        integral : torch.Tensor
+            ``(w + 1, h + 1, d + 1)`` tensor, where ``(w, h, d)`` is the shape
+            of the mask, whose entry ``[i, j, k]`` is the sum of the mask over
+            ``[:i, :j, :k]``.
+        """
+        if self.image_name is None:
+            image = subject.get_first_image()
+        else:
+            image = subject[self.image_name]
+        foreground = (image.data > self.threshold).any(dim=0)
+        # Fraction of foreground voxels in each block
+        mask = F.avg_pool3d(foreground[None, None].float(),
+                            self.downsampling,
+                            ceil_mode=True)[0, 0]
+        return get_summed_area_table(mask.double())
+
+    def get_fractions(self, integral: torch.Tensor,
+                      locations: torch.Tensor) -> torch.Tensor:
+        """
+        Get the foreground fraction of the patches at ``locations``.
+
+        Parameters
+        ----------
+        integral : torch.Tensor
+            Summed-area table returned by :meth:`get_integral`.
+        locations : torch.Tensor
+            ``(N, 6)`` tensor of patch locations, as in ``patch[LOCATION]``.
+
+        Returns
+        -------
+        fractions : torch.Tensor
+            ``(N,)`` tensor of foreground fractions.
+        """
+        locations = torch.as_tensor(locations, dtype=torch.float64)
+        # Patch corners in block units
+        ini = locations[:, :3] / self.downsampling
+        end = locations[:, 3:] / self.downsampling
+        total = get_box_sums(integral, ini, end)
+        volume = (end - ini).prod(dim=1).clamp(min=1e-12)
+        return (total / volume).float()
+
+    def filter_locations(
+            self, subject: Subject, num_patches: int,
+            get_locations: Callable[[Subject, int],
+                                    torch.Tensor]) -> torch.Tensor:
+        """
+        Draw ``num_patches`` locations with ``get_locations``, drawing again
+        the locations of the rejected patches.
+
+        Parameters
+        ----------
+        subject : Subject
+            Subject from which the patches are extracted.
+        num_patches : int
+            Number of patch locations to draw.
+        get_locations : Callable[[Subject, int], torch.Tensor]
+            Function drawing a given number of ``(N, 6)`` locations, e.g.,
+            :meth:`MultiPatchSampler.get_locations`.
+
+        Returns
+        -------
+        locations : torch.Tensor
+            ``(num_patches, 6)`` tensor of patch locations.
+        """
+        integral = self.get_integral(subject)
+        locations = get_locations(subject, num_patches)
+        rejected = torch.arange(len(locations))
+        for attempt in range(self.max_attempts + 1):
+            if attempt > 0:
+                locations[rejected] = get_locations(subject, len(rejected))
+            fractions = self.get_fractions(integral, locations[rejected])
+            accepted = fractions >= self.min_fraction
+            self.num_accepted += int(accepted.sum())
+            rejected = rejected[~accepted]
+            if not len(rejected):
+                return locations
+            if attempt < self.max_attempts:
+                self.num_rejected += len(rejected)
+        self.num_forced += len(rejected)
+        return locations
+
+    def filter_patches(self, subject: Subject, num_patches: int,
+                       patches: Iterable[Subject]) -> List[Subject]:
+        """
+        Take ``num_patches`` patches from ``patches``, skipping the rejected
+        ones.
+
+        Parameters
+        ----------
+        subject : Subject
+            Subject from which the patches are extracted.
+        num_patches : int
+            Number of patches to take.
+        patches : Iterable[Subject]
+            Patches drawn by a :class:`torchio.data.PatchSampler` from
+            ``subject``.
+
+        Returns
+        -------
+        patches : List[Subject]
+            Accepted patches, completed with the last rejected ones if
+            ``max_attempts`` was reached.
+        """
+        integral = self.get_integral(subject)
+        accepted: List[Subject] = []
+        rejected: List[Subject] = []
+        max_draws = num_patches * (self.max_attempts + 1)
+        for num_drawn, patch in enumerate(patches, start=1):
+            location = patch[LOCATION][None]
+            if self.get_fractions(integral, location)[0] >= self.min_fraction:
+                accepted.append(patch)
+            else:
+                rejected.append(patch)
+            if len(accepted) == num_patches or num_drawn == max_draws:
+                break
+        num_forced = min(num_patches - len(accepted), len(rejected))
+        self.num_accepted += len(accepted)
+        self.num_rejected += len(rejected) - num_forced
+        self.num_forced += num_forced
+        return accepted + rejected[len(rejected) - num_forced:]
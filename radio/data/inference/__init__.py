@@ -4,3 +4,9 @@
 Inference init
 """
 from .aggregator import *
+from .grid_extractor import *
+from .grid_aggregator import *
+from .background import *
+from .nifti_output import *
+from .augmentation import *
+from .autotune import *
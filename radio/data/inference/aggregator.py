@@ -8,13 +8,26 @@ models. They also allow you to share a full dataset without explaining how to
 download, split, transform, and process the data.
 """
 
-from typing import List, Optional, Union, cast, Dict, Any
+from typing import (Any, Callable, Dict, Iterator, List, Optional, Sequence,
+                    Tuple, Union)
+import contextlib
 import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from torch.utils.data import DataLoader, Dataset
 import torchio as tio  # type: ignore
 import torch
 from ..datatypes import SpatialShapeType
+from ...settings import PathType
 from ..datautils import get_subjects_from_batch
+from .grid_extractor import GridExtractor
+from .grid_aggregator import GridAggregator, LabelAggregator
+from .background import BackgroundDetector
+from .nifti_output import NiftiOutput
+from .augmentation import PatchAugmentation
+
+_OutputFiles = Tuple[NiftiOutput, Optional[NiftiOutput]]
 
 __all__ = ["PatchBasedInference"]
 
@@ -23,6 +36,21 @@ class PatchBasedInference:
     """
     Dense Patch-based inference.
 
+    The grid patches of all the subjects of a batch are extracted as tensors
+    by a :class:`~radio.data.inference.GridExtractor`, and the patches of
+    each requested intensity are gathered into model batches of
+    ``patch_batch_size`` patches, whatever the subject they come from. Each
+    output patch is routed back to the aggregator of its subject and
+    intensity, which accumulates it in place. The grid locations are
+    computed once per volume shape and shared by all the intensities.
+    Patches are moved to the device of the model.
+
+    An ensemble of models, e.g., the models of the folds of a
+    :class:`~radio.data.KFoldValidation`, is inferred in a single pass: each
+    subject is loaded and each batch of patches extracted once, and then run
+    through all the models, so that the cost of loading, extraction and
+    aggregation does not grow with the number of models.
+
     Typical Workflow
     ----------------
     in_dataset: tio.SubjectsDataset
@@ -49,7 +77,10 @@ class PatchBasedInference:
         between patches for dense inference. If a single number ``n`` is
         provided, ``w_o = h_o = d_o = n``. Default = ``(0, 0, 0)``.
     patch_batch_size : int, optional
-        How many patches per batch to load. Default = ``32``.
+        Number of patches in each batch fed to the model, gathered across
+        subjects and intensities. It can be tuned, with ``num_threads``,
+        ``num_workers`` and ``pin_memory``, by an
+        :class:`~radio.data.inference.InferenceAutotuner`. Default = ``32``.
     padding_mode : str or float or None, optional
         If ``None``, the volume will not be padded before sampling and patches
         at the border will not be cropped by the aggregator. Otherwise, the
@@ -62,13 +93,107 @@ class PatchBasedInference:
     overlap_mode : str, optional
         If ``'crop'``, the overlapping predictions will be cropped. If
         ``'average'``, the predictions in the overlapping areas will be
-        averaged with equal weights. Default = ``'crop'``.
+        averaged with equal weights. If ``'gaussian'`` or ``'hann'``, they
+        will be averaged with weights decreasing towards the patch borders.
+        See :class:`~radio.data.inference.GridAggregator`.
+        Default = ``'crop'``.
+    aggregator_dtype : str, optional
+        Dtype in which the predictions are accumulated, one of
+        ``'float32'``, ``'float16'`` or ``'bfloat16'``. Half precision halves
+        the memory of the output volumes. Default = ``'float32'``.
+    output_mode : str, optional
+        If ``'dense'``, the aggregated model outputs are returned. If
+        ``'labels'``, the outputs are class logits of a segmentation model,
+        and a ``uint8`` label map is returned instead, aggregated without
+        keeping the class scores of the whole volume. See
+        :class:`~radio.data.inference.LabelAggregator`.
+        Default = ``'dense'``.
+    max_probability : bool, optional
+        If ``True`` and ``output_mode`` is ``'labels'``, the probability of
+        the predicted label of each voxel is also returned, in the
+        ``'<intensity>_probability'`` image. Default = ``False``.
+    skip_background : bool, optional
+        If ``True``, the grid patches without any foreground voxel are not
+        fed to the model, and their output is set to ``background_value``.
+        The outputs of the patches containing foreground, and thus of all
+        the foreground voxels, are unchanged. See
+        :class:`~radio.data.inference.BackgroundDetector`.
+        Default = ``False``.
+    foreground_image : str, optional
+        Name of the image defining the foreground of a subject, e.g., a brain
+        mask. If ``None``, the foreground of each intensity is defined by the
+        intensity itself. Default = ``None``.
+    foreground_threshold : float, optional
+        Value above which a voxel is foreground. Default = ``0``.
+    background_value : float or str, optional
+        Output of the skipped patches. If ``'model'``, the output of the
+        model for the first background patch of each intensity is reused for
+        all the skipped patches of that intensity. Otherwise, the outputs are
+        filled with this constant. Default = ``'model'``.
+    roi_mode : str, optional
+        If not ``None``, inference is restricted to a region of interest of
+        each subject. Only the patches of the grid of the whole volume that
+        intersect the region are fed to the model, so the outputs inside the
+        region are the ones of the inference of the whole volume. Outside the
+        region, the output is ``background_value``, or ``0`` if it is
+        ``'model'``, and the labels are ``0``. If ``'coarse'``, the region is
+        the bounding box of the foreground reduced to blocks of
+        ``roi_downsampling`` voxels, defined as for ``skip_background``. If
+        ``'metadata'``, the region is the bounding box ``(i_ini, j_ini, k_ini,
+        i_fin, j_fin, k_fin)``, in voxels, found in the ``roi_key`` entry of
+        the batch. The region is enlarged by ``roi_margin`` voxels on each
+        side. Default = ``None``.
+    roi_key : str, optional
+        Batch entry holding the bounding boxes if ``roi_mode`` is
+        ``'metadata'``. Default = ``'roi'``.
+    roi_downsampling : int, optional
+        Size in voxels of the blocks of the coarse pass. Default = ``8``.
+    roi_margin : int, optional
+        Margin in voxels added around the region of interest.
+        Default = ``16``.
+    output_dir : PathType, optional
+        If not ``None``, the outputs are written into NIfTI files of this
+        directory, with the affine of the inferred images, instead of being
+        kept in memory. The volumes are memory-mapped and written as the grid
+        advances, and the weighted predictions are accumulated in a slab of
+        the width of a patch, so that the memory used does not depend on the
+        size of the volumes. The returned subjects hold images read lazily
+        from the files, named ``<subj_id>_<scan_id>_<intensity>.nii``, or
+        with a running index if the subjects have no identifiers. Half
+        precision volumes are written in ``float32``. Default = ``None``.
+    augmentations : Sequence[PatchAugmentation], optional
+        Test-time augmentations. Each batch of patches is expanded along the
+        batch dimension with every augmentation, and run through the model
+        in a single forward pass, so the model sees batches of
+        ``patch_batch_size * len(augmentations)`` patches. The outputs are
+        inverse-transformed and averaged on the device of the model before
+        aggregation. Include the identity, ``PatchAugmentation()``, to keep
+        the prediction of the original patches, as
+        :func:`~radio.data.inference.get_flip_augmentations` does.
+        Default = ``None``.
+    ensemble_mode : str, optional
+        Aggregation of the outputs of an ensemble of models. If ``'mean'``,
+        the outputs of the models are averaged on the device of the first
+        model, and aggregated into the ``'<intensity>'`` image. If
+        ``'models'``, the outputs of the ``k``-th model are aggregated
+        separately into the ``'<intensity>_fold<k>'`` image. With
+        ``output_mode='labels'``, ``'mean'`` averages the logits of the
+        models. Default = ``'mean'``.
+    ensemble_workers : int, optional
+        Number of threads running the models of an ensemble concurrently on
+        each batch. Useful for models on different devices, or for small
+        models that do not use all the CPU threads on their own. ``0`` means
+        that the models run one after the other. Default = ``0``.
+    num_threads : int, optional
+        Number of threads used by torch within the operations of the models
+        during inference, restored afterwards. If ``None``, the current
+        setting is kept. Default = ``None``.
     num_workers : int, optional
-        How many subprocesses to use for data loading. ``0`` means that the
-        data will be loaded in the main process. Default: ``0``.
+        How many subprocesses to use for padding the volumes. ``0`` means
+        that the volumes will be padded in the main process. Default: ``0``.
     pin_memory : bool, optional
-        If ``True``, the data loader will copy Tensors into CUDA pinned memory
-        before returning them. Default = ``True``.
+        If ``True``, the batches of patches will be copied into CUDA pinned
+        memory before being moved to a CUDA model. Default = ``True``.
     verbose : bool, optional
         If ``True``, print debugging messages. Default = ``False``.
     """
@@ -80,12 +205,45 @@ class PatchBasedInference:
         patch_batch_size: int = 32,
         padding_mode: Union[str, float, None] = None,
         overlap_mode: str = 'crop',
+        aggregator_dtype: str = 'float32',
+        output_mode: str = 'dense',
+        max_probability: bool = False,
+        skip_background: bool = False,
+        foreground_image: Optional[str] = None,
+        foreground_threshold: float = 0.0,
+        background_value: Union[float, str] = 'model',
+        roi_mode: Optional[str] = None,
+        roi_key: str = 'roi',
+        roi_downsampling: int = 8,
+        roi_margin: int = 16,
+        output_dir: Optional[PathType] = None,
+        augmentations: Optional[Sequence[PatchAugmentation]] = None,
+        ensemble_mode: str = 'mean',
+        ensemble_workers: int = 0,
+        num_threads: Optional[int] = None,
         num_workers: int = 0,
         pin_memory: bool = True,
         verbose: bool = False,
     ) -> None:
+        if output_mode not in ('dense', 'labels'):
+            raise ValueError('Output mode must be "dense" or "labels", not'
+                             f' "{output_mode}".')
+        if isinstance(background_value, str) and background_value != 'model':
+            raise ValueError('Background value must be a number or "model",'
+                             f' not "{background_value}".')
+        if roi_mode not in (None, 'coarse', 'metadata'):
+            raise ValueError('ROI mode must be None, "coarse" or "metadata",'
+                             f' not "{roi_mode}".')
+        if roi_margin < 0:
+            raise ValueError('roi_margin must be non-negative.')
+        if ensemble_mode not in ('mean', 'models'):
+            raise ValueError('Ensemble mode must be "mean" or "models", not'
+                             f' "{ensemble_mode}".')
+        if ensemble_workers < 0:
+            raise ValueError('ensemble_workers must be non-negative.')
         # Init Dataloader Parameters
         self.patch_batch_size = patch_batch_size
+        self.num_threads = num_threads
         self.num_workers = num_workers
         self.pin_memory = pin_memory
 
@@ -96,44 +254,222 @@ class PatchBasedInference:
 
         # Init Aggregator Parameters
         self.overlap_mode = overlap_mode
+        self.aggregator_dtype = aggregator_dtype
+        self.output_mode = output_mode
+        self.max_probability = max_probability
+
+        # Init Background Skipping Parameters
+        self.skip_background = skip_background
+        self.foreground_image = foreground_image
+        self.background_value = background_value
+        self.background_detector = BackgroundDetector(foreground_threshold)
+        self.num_patches = 0
+        self.num_skipped = 0
+
+        # Init Region of Interest Parameters
+        self.roi_mode = roi_mode
+        self.roi_key = roi_key
+        self.roi_margin = roi_margin
+        self.roi_detector = BackgroundDetector(foreground_threshold,
+                                               roi_downsampling)
+
+        # Init Output Parameters
+        self.output_dir = None if output_dir is None else Path(output_dir)
+        self.num_outputs = 0
+
+        # Init Test-Time Augmentation Parameters
+        self.augmentations = list(augmentations) if augmentations else []
+
+        # Init Ensemble Parameters
+        self.ensemble_mode = ensemble_mode
+        self.ensemble_workers = ensemble_workers
 
         self.verbose = verbose
 
+    def __repr__(self) -> str:
+        attributes = [
+            f'patch_size={self.patch_size}',
+            f'patch_overlap={self.patch_overlap}',
+            f'overlap_mode={self.overlap_mode}',
+            f'num_patches={self.num_patches}',
+            f'num_skipped={self.num_skipped}',
+        ]
+        return f'PatchBasedInference({", ".join(attributes)})'
+
     def _inference(
         self,
-        subject: tio.Subject,
-        model: torch.nn.Module,
-        intensity: str,
-    ) -> torch.Tensor:
-        sampler = tio.data.GridSampler(
-            subject=subject,
-            patch_size=self.patch_size,
-            patch_overlap=self.patch_overlap,
-            padding_mode=self.padding_mode,
+        subjects: List[tio.Subject],
+        models: List[torch.nn.Module],
+        intensities: List[str],
+        output_names: List[List[str]],
+        output_files: Optional[List[Dict[str, _OutputFiles]]] = None,
+        rois: Optional[List[Optional[torch.Tensor]]] = None,
+    ) -> List[Dict[str, GridAggregator]]:
+        extractor = GridExtractor(self.patch_size, self.patch_overlap,
+                                  self.padding_mode)
+        if output_files is None:
+            output_files = [{} for _ in subjects]
+        if rois is None:
+            rois = [None] * len(subjects)
+        # A single grid per subject, shared by all the outputs
+        aggregators = [{
+            name: self._get_aggregator(extractor, subject.spatial_shape,
+                                       *subject_files.get(name, (None, None)))
+            for names in output_names for name in names
+        } for subject, subject_files in zip(subjects, output_files)]
+        # Subjects are padded by the workers, and their patches extracted in
+        # the main process
+        image_names = list(intensities)
+        if self.skip_background and self.foreground_image is not None:
+            image_names.append(self.foreground_image)
+        volume_loader = DataLoader(
+            _PaddedVolumes(subjects, image_names, extractor),
+            batch_size=None,
+            num_workers=self.num_workers,
         )
-        aggregator = tio.data.GridAggregator(
-            sampler,
+        batcher = _PatchBatcher()
+        background = _BackgroundOutputs(self.background_value)
+        for model in models:
+            model.eval()
+        executor = None
+        if self.ensemble_workers and len(models) > 1:
+            executor = ThreadPoolExecutor(self.ensemble_workers)
+        ensemble = _Ensemble(models, self.ensemble_mode, self.augmentations,
+                             self.pin_memory, executor)
+        predict = functools.partial(self._predict,
+                                    ensemble,
+                                    aggregators=aggregators,
+                                    output_names=output_names,
+                                    background=background)
+        with torch.no_grad(), _num_threads(self.num_threads):
+            for subject_index, volumes in enumerate(volume_loader):
+                grid_locations = _get_grid_locations(
+                    extractor, volumes[intensities[0]].shape[1:],
+                    rois[subject_index])
+                skipped = self._get_skipped(volumes, intensities,
+                                            grid_locations)
+                for first in range(0, len(grid_locations),
+                                   self.patch_batch_size):
+                    chunk = slice(first, first + self.patch_batch_size)
+                    self._add_chunk(
+                        batcher, background, extractor, volumes,
+                        intensities, grid_locations[chunk],
+                        {name: mask[chunk]
+                         for name, mask in skipped.items()},
+                        subject_index * len(intensities))
+                    # Patches of consecutive subjects are fed in the same
+                    # batches
+                    batcher.feed(predict, self.patch_batch_size)
+            batcher.feed(predict, self.patch_batch_size, flush=True)
+        if executor is not None:
+            executor.shutdown()
+        if self.verbose and self.skip_background:
+            print(f'Skipped {self.num_skipped} of {self.num_patches}'
+                  ' background patches')
+        return aggregators
+
+    def _add_chunk(self, batcher: '_PatchBatcher',
+                   background: '_BackgroundOutputs', extractor: GridExtractor,
+                   volumes: Dict[str, torch.Tensor], intensities: List[str],
+                   locations: torch.Tensor, skipped: Dict[str, torch.Tensor],
+                   owner: int) -> None:
+        # Add the patches of a chunk of grid locations of a subject for each
+        # intensity, with the inputs of the patches not skipped
+        for intensity_index, intensity in enumerate(intensities):
+            volume = volumes[intensity]
+            chunk_skipped = skipped[intensity]
+            background.capture(intensity_index, extractor, volume,
+                               locations, chunk_skipped)
+            batcher.add(
+                extractor.extract(volume, locations[~chunk_skipped]),
+                locations,
+                torch.full((len(locations), ), owner + intensity_index),
+                chunk_skipped,
+            )
+
+    def _get_skipped(self, volumes: Dict[str, torch.Tensor],
+                     intensities: List[str],
+                     locations: torch.Tensor) -> Dict[str, torch.Tensor]:
+        # Patches skipped for each intensity
+        num_patches = len(locations) * len(intensities)
+        self.num_patches += num_patches
+        if not self.skip_background:
+            no_skip = torch.zeros(len(locations), dtype=torch.bool)
+            return {intensity: no_skip for intensity in intensities}
+        if self.foreground_image is not None:
+            skipped = self.background_detector.is_background(
+                volumes[self.foreground_image], locations)
+            self.num_skipped += int(skipped.sum()) * len(intensities)
+            return {intensity: skipped for intensity in intensities}
+        skipped_by_intensity = {}
+        for intensity in intensities:
+            skipped = self.background_detector.is_background(
+                volumes[intensity], locations)
+            self.num_skipped += int(skipped.sum())
+            skipped_by_intensity[intensity] = skipped
+        return skipped_by_intensity
+
+    def _get_aggregator(
+        self,
+        extractor: GridExtractor,
+        spatial_shape: SpatialShapeType,
+        output_file: Optional[NiftiOutput] = None,
+        probability_file: Optional[NiftiOutput] = None,
+    ) -> GridAggregator:
+        if self.output_mode == 'labels':
+            return LabelAggregator(
+                extractor,
+                spatial_shape,
+                overlap_mode=self.overlap_mode,
+                dtype=self.aggregator_dtype,
+                max_probability=self.max_probability,
+                output_file=output_file,
+                probability_file=probability_file,
+            )
+        return GridAggregator(
+            extractor,
+            spatial_shape,
             overlap_mode=self.overlap_mode,
+            dtype=self.aggregator_dtype,
+            output_file=output_file,
         )
-        patch_loader = DataLoader(
-            cast(Dataset, sampler),
-            batch_size=self.patch_batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
-        )
-        model.eval()
-        with torch.no_grad():
-            for patches_batch in patch_loader:
-                insor = patches_batch[intensity][tio.DATA]
-                locations = patches_batch[tio.LOCATION]
-                outsor = model(insor)
-                aggregator.add_batch(outsor, locations)
-        return aggregator.get_output_tensor()
+
+    def _predict(
+        self,
+        ensemble: '_Ensemble',
+        batch: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+        aggregators: List[Dict[str, GridAggregator]],
+        output_names: List[List[str]],
+        background: '_BackgroundOutputs',
+    ) -> None:
+        insor, locations, owners, skipped = batch
+        # (num_outputs, N, C, w, h, d) outputs of the patches with an input
+        outsor = ensemble(insor) if len(insor) else None
+        if skipped.any():
+            background_outsor = background.get_outputs(
+                owners[skipped] % len(output_names), ensemble)
+            if outsor is None:
+                outsor = background_outsor
+            else:
+                outputs = outsor
+                outsor = outputs.new_empty((len(outputs), len(locations)) +
+                                           outputs.shape[2:])
+                outsor[:, ~skipped] = outputs
+                outsor[:, skipped] = background_outsor.to(outputs.dtype)
+        assert outsor is not None
+        # Route the outputs back to the aggregators of their subject and
+        # intensity
+        for owner in torch.unique(owners).tolist():
+            mask = owners == owner
+            subject_index, intensity_index = divmod(owner, len(output_names))
+            for name, outputs in zip(output_names[intensity_index], outsor):
+                aggregators[subject_index][name].add_batch(
+                    outputs[mask], locations[mask])
 
     def __call__(
         self,
         batch: Dict[str, Any],
-        model: torch.nn.Module,
+        model: Union[torch.nn.Module, Sequence[torch.nn.Module]],
         intensities: Optional[List[str]] = None,
     ) -> List[tio.Subject]:
         """
@@ -141,8 +477,9 @@ class PatchBasedInference:
         ----------
         batch : Dict[str, Any]
             Dataloader batch.
-        model : torch.nn.Module
-            Model to use for inference.
+        model : torch.nn.Module or Sequence[torch.nn.Module]
+            Model to use for inference, or ensemble of models, aggregated as
+            set by ``ensemble_mode``.
         intensities : List[str], optional
             In which modalilities to perform inference. Default = ``['T1']``.
 
@@ -152,17 +489,387 @@ class PatchBasedInference:
             List of test subjects with inference results on given intensities.
         """
         intensities = intensities if intensities else ['T1']
+        models = _get_models(model)
+        output_names = self._get_output_names(intensities, len(models))
         subjects = get_subjects_from_batch(batch)
+        rois = self._get_rois(batch, subjects, intensities)
+        fill = (0.0 if isinstance(self.background_value, str) else float(
+            self.background_value))
+        output_files = None
+        if self.output_dir is not None:
+            output_files = [
+                self._get_output_files(subject, intensities, output_names)
+                for subject in subjects
+            ]
+        aggregators = self._inference(subjects, models, intensities,
+                                      output_names, output_files, rois)
         subjects_list = []
-        for subject in subjects:
+        for subject, roi, subject_aggregators in zip(subjects, rois,
+                                                     aggregators):
             # Create a copy of subject and remove images
             subject_copy = copy.copy(subject)
             for image_name in subject_copy.get_images_names():
                 subject_copy.remove_image(image_name)
             # Inference on each of the required intensities
-            for intensity in intensities:
-                outsor = self._inference(subject, model, intensity)
-                subject_copy.add_image(tio.ScalarImage(tensor=outsor),
-                                       image_name=intensity)
+            for name in (name for names in output_names for name in names):
+                aggregator = subject_aggregators[name]
+                is_label = isinstance(aggregator, LabelAggregator)
+                klass = tio.LabelMap if is_label else tio.ScalarImage
+                output = aggregator.get_output_tensor()
+                _fill_outside(output, roi, 0 if is_label else fill)
+                if aggregator.output_file is not None:
+                    aggregator.output_file.flush()
+                    # Read from the file when needed
+                    image = klass(aggregator.output_file.path)
+                else:
+                    image = klass(tensor=output)
+                subject_copy.add_image(image, image_name=name)
+                if not is_label:
+                    continue
+                assert isinstance(aggregator, LabelAggregator)
+                probability = aggregator.get_probability_tensor()
+                if probability is None:
+                    continue
+                _fill_outside(probability, roi, 0)
+                if aggregator.probability_file is not None:
+                    aggregator.probability_file.flush()
+                    image = tio.ScalarImage(aggregator.probability_file.path)
+                else:
+                    image = tio.ScalarImage(tensor=probability)
+                subject_copy.add_image(image,
+                                       image_name=f'{name}_probability')
             subjects_list.append(subject_copy)
         return subjects_list
+
+    def _get_output_names(self, intensities: List[str],
+                          num_models: int) -> List[List[str]]:
+        # Names of the outputs of each intensity
+        if self.ensemble_mode == 'mean':
+            return [[intensity] for intensity in intensities]
+        return [[f'{intensity}_fold{index}' for index in range(num_models)]
+                for intensity in intensities]
+
+    def _get_output_files(
+        self,
+        subject: tio.Subject,
+        intensities: List[str],
+        output_names: List[List[str]],
+    ) -> Dict[str, _OutputFiles]:
+        # Files of the outputs of each intensity of a subject
+        assert self.output_dir is not None
+        name_parts = [
+            str(subject[key]) for key in ('subj_id', 'scan_id')
+            if key in subject
+        ]
+        if not name_parts:
+            name_parts = [f'{self.num_outputs:05d}']
+        self.num_outputs += 1
+        is_label = self.output_mode == 'labels'
+        files: Dict[str, _OutputFiles] = {}
+        for intensity, names in zip(intensities, output_names):
+            affine = subject[intensity].affine
+            for name in names:
+                prefix = self.output_dir / '_'.join(name_parts + [name])
+                output_file = NiftiOutput(f'{prefix}.nii',
+                                          subject.spatial_shape, affine)
+                probability_file = None
+                if is_label and self.max_probability:
+                    probability_file = NiftiOutput(
+                        f'{prefix}_probability.nii', subject.spatial_shape,
+                        affine)
+                files[name] = (output_file, probability_file)
+        return files
+
+    def _get_rois(self, batch: Dict[str, Any], subjects: List[tio.Subject],
+                  intensities: List[str]) -> List[Optional[torch.Tensor]]:
+        # Region of interest of each subject, None for the whole volume
+        if self.roi_mode is None:
+            return [None] * len(subjects)
+        if self.roi_mode == 'metadata' and self.roi_key not in batch:
+            raise KeyError(f'Batch has no "{self.roi_key}" bounding boxes.')
+        rois: List[Optional[torch.Tensor]] = []
+        for index, subject in enumerate(subjects):
+            spatial_shape = torch.as_tensor(subject.spatial_shape)
+            if self.roi_mode == 'metadata':
+                roi = torch.as_tensor(batch[self.roi_key][index]).long()
+            elif self.foreground_image is not None:
+                roi = self.roi_detector.get_bounding_box(
+                    subject[self.foreground_image].data)
+            else:
+                roi = self.roi_detector.get_bounding_box(
+                    torch.cat([subject[name].data for name in intensities]))
+            if roi is None:
+                # No foreground found, the whole volume is inferred
+                rois.append(None)
+                continue
+            ini = (roi[:3] - self.roi_margin).clamp(min=0)
+            fin = torch.minimum(roi[3:] + self.roi_margin, spatial_shape)
+            rois.append(torch.cat((ini, fin)))
+            if self.verbose:
+                fraction = float((fin - ini).prod() / spatial_shape.prod())
+                print(f'Region of interest {tuple(rois[-1].tolist())},'
+                      f' {fraction:.1%} of the volume')
+        return rois
+
+
+class _PaddedVolumes(Dataset):
+    """Padded data of the given images of each subject."""
+
+    def __init__(self, subjects: List[tio.Subject], image_names: List[str],
+                 extractor: GridExtractor) -> None:
+        self.subjects = subjects
+        self.image_names = image_names
+        self.extractor = extractor
+
+    def __len__(self) -> int:
+        return len(self.subjects)
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        subject = self.subjects[index]
+        images = tio.Subject(
+            {image_name: subject[image_name]
+             for image_name in self.image_names})
+        padded = self.extractor.pad(images)
+        return {
+            image_name: padded[image_name].data
+            for image_name in self.image_names
+        }
+
+
+class _BackgroundOutputs:
+    """Outputs of the skipped background patches, by intensity index."""
+
+    def __init__(self, value: Union[float, str]) -> None:
+        self.value = value
+        self._inputs: Dict[int, torch.Tensor] = {}
+        self._outputs: Dict[int, torch.Tensor] = {}
+
+    def capture(self, intensity_index: int, extractor: GridExtractor,
+                volume: torch.Tensor, locations: torch.Tensor,
+                skipped: torch.Tensor) -> None:
+        """
+        Keep the input of the first skipped patch of an intensity, unless one
+        is kept already.
+        """
+        if skipped.any() and intensity_index not in self._inputs:
+            self._inputs[intensity_index] = extractor.extract(
+                volume, locations[skipped][:1])
+
+    def get_outputs(self, intensity_indices: torch.Tensor,
+                    ensemble: '_Ensemble') -> torch.Tensor:
+        """
+        Get the ``(num_outputs, N, C, w, h, d)`` outputs of background patches
+        of the given intensities.
+        """
+        for intensity_index in torch.unique(intensity_indices).tolist():
+            if intensity_index in self._outputs:
+                continue
+            # The models run once per intensity, on a single patch, and their
+            # output gives the shape of the constant outputs
+            output = ensemble(self._inputs[intensity_index])[:, 0]
+            if self.value != 'model':
+                output = torch.full_like(output, float(self.value))
+            self._outputs[intensity_index] = output
+        return torch.stack(
+            [self._outputs[index] for index in intensity_indices.tolist()],
+            dim=1)
+
+
+class _Ensemble:
+    """
+    Models run on the same batches of patches, with test-time augmentations.
+
+    Each batch is moved once to each device of the models. Calling the
+    ensemble returns the ``(num_outputs, N, C, w, h, d)`` outputs of a batch
+    of ``N`` patches on the CPU, with a single output for the mean of the
+    models, or one per model.
+    """
+
+    def __init__(self,
+                 models: List[torch.nn.Module],
+                 mode: str,
+                 augmentations: List[PatchAugmentation],
+                 pin_memory: bool,
+                 executor: Optional[ThreadPoolExecutor] = None) -> None:
+        self.models = models
+        self.devices = [_get_device(model) for model in models]
+        self.mode = mode
+        self.augmentations = augmentations
+        self.pin_memory = pin_memory
+        self.executor = executor
+
+    def _forward(self, model: torch.nn.Module,
+                 inputs: torch.Tensor) -> torch.Tensor:
+        # Output of a model, on its device
+        if not self.augmentations:
+            return model(inputs)
+        outputs = model(
+            torch.cat(
+                [augmentation(inputs) for augmentation in self.augmentations]))
+        # Average the predictions of all the augmentations of a patch
+        mean = torch.zeros_like(outputs[:len(inputs)])
+        for augmentation, augmented in zip(self.augmentations,
+                                           outputs.split(len(inputs))):
+            mean += augmentation.invert(augmented)
+        return mean.div_(len(self.augmentations))
+
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        if self.pin_memory and any(device.type == 'cuda'
+                                   for device in self.devices):
+            inputs = inputs.pin_memory()
+        non_blocking = inputs.is_pinned()
+        inputs_by_device = {
+            device: inputs.to(device, non_blocking=non_blocking)
+            for device in set(self.devices)
+        }
+        device_inputs = [inputs_by_device[device] for device in self.devices]
+        if self.executor is None:
+            outputs = list(map(self._forward, self.models, device_inputs))
+        else:
+            outputs = list(
+                self.executor.map(self._forward, self.models, device_inputs))
+        if self.mode == 'models':
+            return torch.stack([output.cpu() for output in outputs])
+        mean = outputs[0]
+        if len(outputs) > 1:
+            for output in outputs[1:]:
+                mean = mean + output.to(mean.device)
+            mean = mean / len(outputs)
+        return mean.cpu()[None]
+
+
+def _intersects(locations: torch.Tensor, roi: torch.Tensor,
+                border: Tuple[int, int, int]) -> torch.Tensor:
+    # Whether the patches at the locations of a padded volume intersect the
+    # region of interest of the unpadded volume
+    offset = torch.as_tensor(border)
+    ini, fin = roi[:3] + offset, roi[3:] + offset
+    return ((locations[:, :3] < fin) & (locations[:, 3:] > ini)).all(dim=1)
+
+
+def _get_grid_locations(extractor: GridExtractor,
+                        spatial_shape: SpatialShapeType,
+                        roi: Optional[torch.Tensor]) -> torch.Tensor:
+    # Locations of the grid patches of a padded volume, restricted to those
+    # intersecting the region of interest, if any
+    locations = extractor.get_locations(spatial_shape)
+    if roi is None:
+        return locations
+    return locations[_intersects(locations, roi, extractor.border)]
+
+
+def _fill_outside(volume: torch.Tensor, roi: Optional[torch.Tensor],
+                  fill: float) -> None:
+    # Set in place the voxels of a (C, W, H, D) volume outside the region of
+    # interest, by slabs before and after the region along each axis
+    if roi is None:
+        return
+    ini, fin = roi[:3].tolist(), roi[3:].tolist()
+    region: List[slice] = [slice(None)]
+    for axis in range(3):
+        for outside in (slice(0, ini[axis]), slice(fin[axis], None)):
+            volume[tuple(region) + (outside, )] = fill
+        region.append(slice(ini[axis], fin[axis]))
+
+
+@contextlib.contextmanager
+def _num_threads(num_threads: Optional[int]) -> Iterator[None]:
+    # Set the number of intra-op threads of torch, if given
+    previous = torch.get_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def _get_models(
+    model: Union[torch.nn.Module, Sequence[torch.nn.Module]]
+) -> List[torch.nn.Module]:
+    # Models of an ensemble, or the single model
+    models = [model] if isinstance(model, torch.nn.Module) else list(model)
+    if not models:
+        raise ValueError('At least one model is required.')
+    return models
+
+
+def _get_device(model: torch.nn.Module) -> torch.device:
+    parameter = next(model.parameters(), None)
+    return parameter.device if parameter is not None else torch.device('cpu')
+
+
+class _PatchBatcher:
+    """
+    Buffer of patches, popped in batches of a fixed number of model inputs.
+
+    Skipped patches have no model input, and are popped with the inputs
+    around them, so that the patches of each aggregator stay in grid order.
+    """
+
+    def __init__(self) -> None:
+        self._inputs: List[torch.Tensor] = []
+        self._locations: List[torch.Tensor] = []
+        self._owners: List[torch.Tensor] = []
+        self._skipped: List[torch.Tensor] = []
+        self._length = 0
+        self.num_patches = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def add(self,
+            inputs: torch.Tensor,
+            locations: torch.Tensor,
+            owners: torch.Tensor,
+            skipped: Optional[torch.Tensor] = None) -> None:
+        """
+        Add patches with their locations and output owners, and the inputs
+        of the patches not skipped.
+        """
+        if skipped is None:
+            skipped = torch.zeros(len(locations), dtype=torch.bool)
+        self._inputs.append(inputs)
+        self._locations.append(locations)
+        self._owners.append(owners)
+        self._skipped.append(skipped)
+        self._length += len(inputs)
+        self.num_patches += len(locations)
+
+    def feed(self,
+             predict: Callable[[Tuple[torch.Tensor, torch.Tensor, torch.Tensor,
+                                      torch.Tensor]], None],
+             batch_size: int,
+             flush: bool = False) -> None:
+        """
+        Pass the full batches of ``batch_size`` inputs to ``predict``, and
+        the remaining patches too if ``flush``.
+        """
+        while len(self) >= batch_size:
+            predict(self.pop(batch_size))
+        if flush and self.num_patches:
+            predict(self.pop(len(self)))
+
+    def pop(
+        self, batch_size: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Pop the ``batch_size`` oldest inputs, with the skipped patches before
+        the next input.
+        """
+        inputs = torch.cat(self._inputs)
+        locations = torch.cat(self._locations)
+        owners = torch.cat(self._owners)
+        skipped = torch.cat(self._skipped)
+        if batch_size < len(inputs):
+            end = int(torch.nonzero(~skipped)[batch_size])
+        else:
+            end = len(locations)
+        self._inputs = [inputs[batch_size:]]
+        self._locations = [locations[end:]]
+        self._owners = [owners[end:]]
+        self._skipped = [skipped[end:]]
+        self._length = len(self._inputs[0])
+        self.num_patches = len(self._locations[0])
+        return (inputs[:batch_size], locations[:end], owners[:end],
+                skipped[:end])
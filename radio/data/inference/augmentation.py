@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Test-time augmentations applied to batches of patches.
+"""
+
+import itertools
+from typing import List, Sequence, Tuple
+
+import torch
+
+__all__ = ["PatchAugmentation", "get_flip_augmentations"]
+
+
+class PatchAugmentation:
+    """
+    Invertible flip and rotation of a batch of ``(N, C, w, h, d)`` patches.
+
+    The spatial axes ``flip_axes`` are flipped first, and the patches are
+    then rotated ``rotations`` times by 90 degrees in the plane of the
+    spatial axes ``plane``, which must have the same size. Axes are numbered
+    ``0``, ``1`` and ``2``, skipping the batch and channel dimensions.
+
+    Parameters
+    ----------
+    flip_axes : Sequence[int], optional
+        Spatial axes to flip. Default = ``()``.
+    rotations : int, optional
+        Number of rotations by 90 degrees. Default = ``0``.
+    plane : (int, int), optional
+        Spatial axes of the plane of the rotations. Default = ``(0, 1)``.
+
+    Examples
+    --------
+    >>> augmentation = PatchAugmentation(flip_axes=(0, ), rotations=1)
+    >>> inputs = augmentation(patches)
+    >>> outputs = augmentation.invert(model(inputs))
+    """
+
+    def __init__(self,
+                 flip_axes: Sequence[int] = (),
+                 rotations: int = 0,
+                 plane: Tuple[int, int] = (0, 1)) -> None:
+        if any(axis not in (0, 1, 2) for axis in (*flip_axes, *plane)):
+            raise ValueError('Spatial axes must be 0, 1 or 2.')
+        if plane[0] == plane[1]:
+            raise ValueError('The axes of the plane must be different.')
+        self.flip_axes = tuple(sorted(set(flip_axes)))
+        self.rotations = rotations % 4
+        self.plane = plane
+
+    def __repr__(self) -> str:
+        return (f'PatchAugmentation(flip_axes={self.flip_axes},'
+                f' rotations={self.rotations}, plane={self.plane})')
+
+    @property
+    def is_identity(self) -> bool:
+        """Whether the augmentation leaves the patches unchanged."""
+        return not self.flip_axes and not self.rotations
+
+    def _get_dims(self, axes: Sequence[int]) -> List[int]:
+        # Tensor dimensions of spatial axes
+        return [axis + 2 for axis in axes]
+
+    def __call__(self, patches: torch.Tensor) -> torch.Tensor:
+        """Augment a batch of patches."""
+        if self.flip_axes:
+            patches = patches.flip(self._get_dims(self.flip_axes))
+        if self.rotations:
+            dims = self._get_dims(self.plane)
+            if patches.shape[dims[0]] != patches.shape[dims[1]]:
+                raise RuntimeError(
+                    f'Patches of shape {tuple(patches.shape[2:])} cannot be'
+                    f' rotated in the plane of the axes {self.plane}.')
+            patches = patches.rot90(self.rotations, dims)
+        return patches
+
+    def invert(self, patches: torch.Tensor) -> torch.Tensor:
+        """Undo the augmentation of a batch of patches."""
+        if self.rotations:
+            patches = patches.rot90(-self.rotations,
+                                    self._get_dims(self.plane))
+        if self.flip_axes:
+            patches = patches.flip(self._get_dims(self.flip_axes))
+        return patches
+
+
+def get_flip_augmentations(
+        axes: Sequence[int] = (0, 1, 2)) -> List[PatchAugmentation]:
+    """
+    Get the augmentations flipping every subset of ``axes``, including the
+    identity.
+    """
+    return [
+        PatchAugmentation(flip_axes=subset)
+        for num_axes in range(len(axes) + 1)
+        for subset in itertools.combinations(axes, num_axes)
+    ]
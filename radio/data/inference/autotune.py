@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Autotuning of the batch size and execution settings of patch-based inference.
+"""
+
+import copy
+import hashlib
+import json
+import math
+import os
+import socket
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import torch
+import torchio as tio  # type: ignore
+
+from ...settings import SAVE_ROOT, PathType
+from ..datautils import get_subjects_from_batch
+from .aggregator import (PatchBasedInference, _Ensemble, _get_device,
+                         _get_models, _num_threads, _PaddedVolumes)
+from .grid_extractor import GridExtractor
+
+__all__ = ["InferenceAutotuner"]
+
+ModelsType = Union[torch.nn.Module, Sequence[torch.nn.Module]]
+
+
+class InferenceAutotuner:
+    """
+    Tune ``patch_batch_size``, ``num_threads``, ``num_workers`` and
+    ``pin_memory`` of a :class:`~radio.data.inference.PatchBasedInference`
+    for a model, on a sample batch of subjects.
+
+    The tuning runs in two stages:
+
+    * The model, with the ensemble and test-time augmentations of the
+      inference, is run on batches of patches of the first subject, for each
+      batch size and number of threads. Batch sizes are tried in increasing
+      order, until one exceeds ``memory_budget`` or runs out of memory, and
+      the configuration with the highest throughput, in patches per second,
+      is kept.
+    * The whole inference of the sample batch is timed for each number of
+      data loader workers, with the tuned batch size and threads. Worker
+      counts larger than the number of subjects of the batch are skipped.
+
+    Patches are pinned only if a model is on a CUDA device. The result is
+    saved in ``cache_file`` under the key of the model, patch size and host,
+    and later calls of :meth:`tune` with the same key apply it without
+    benchmarking. The model key is a hash of the class and the parameter
+    shapes and devices of the models, and of the number of augmentations, so
+    the models of all the folds of a cross-validation share their settings.
+
+    Parameters
+    ----------
+    batch_sizes : Sequence[int], optional
+        Candidate numbers of patches per model batch.
+        Default = ``(4, 8, 16, 32, 64, 128)``.
+    num_threads : Sequence[int], optional
+        Candidate numbers of torch threads. If ``None``, the threads are
+        tuned among ``1``, a quarter, half and all of the current threads
+        when the models are on the CPU, and left unchanged otherwise.
+        Default = ``None``.
+    num_workers : Sequence[int], optional
+        Candidate numbers of data loader workers. Default = ``(0, 2, 4)``.
+    memory_budget : int, optional
+        Maximum memory in bytes used by a model batch. On CUDA devices, it
+        is the peak memory allocated by torch during the batch, and defaults
+        to 90% of the free memory of the device. On the CPU, it is the total
+        size of the inputs and of the outputs of every module, an upper bound
+        of the activations held at once, and there is no default limit.
+        Default = ``None``.
+    num_repeats : int, optional
+        Number of timed model batches per configuration, after a warm-up
+        batch. Default = ``3``.
+    cache_file : PathType, optional
+        JSON file of the tuned settings. If ``None``,
+        ``SAVE_ROOT / 'inference_autotune.json'`` is used. Default = ``None``.
+    verbose : bool, optional
+        If ``True``, print the measurements. Default = ``False``.
+
+    Examples
+    --------
+    >>> inference = PatchBasedInference(96, 16, overlap_mode='hann')
+    >>> InferenceAutotuner().tune(inference, next(iter(loader)), model)
+    >>> subjects = inference(batch, model, ['T1'])
+    """
+
+    def __init__(
+        self,
+        batch_sizes: Sequence[int] = (4, 8, 16, 32, 64, 128),
+        num_threads: Optional[Sequence[int]] = None,
+        num_workers: Sequence[int] = (0, 2, 4),
+        memory_budget: Optional[int] = None,
+        num_repeats: int = 3,
+        cache_file: Optional[PathType] = None,
+        verbose: bool = False,
+    ) -> None:
+        if not batch_sizes or any(size < 1 for size in batch_sizes):
+            raise ValueError('Batch sizes must be positive.')
+        if num_threads is not None and any(threads < 1
+                                           for threads in num_threads):
+            raise ValueError('Numbers of threads must be positive.')
+        if not num_workers or any(workers < 0 for workers in num_workers):
+            raise ValueError('Numbers of workers must be non-negative.')
+        if num_repeats < 1:
+            raise ValueError('num_repeats must be at least 1.')
+        self.batch_sizes = sorted(set(batch_sizes))
+        self.num_threads = (None if num_threads is None else sorted(
+            set(num_threads)))
+        self.num_workers = sorted(set(num_workers))
+        self.memory_budget = memory_budget
+        self.num_repeats = num_repeats
+        self.cache_file = Path(cache_file if cache_file is not None else
+                               SAVE_ROOT / 'inference_autotune.json')
+        self.verbose = verbose
+        self.history: List[Dict[str, Any]] = []
+
+    def __repr__(self) -> str:
+        attributes = [
+            f'batch_sizes={self.batch_sizes}',
+            f'num_threads={self.num_threads}',
+            f'num_workers={self.num_workers}',
+            f'memory_budget={self.memory_budget}',
+            f'cache_file={self.cache_file}',
+        ]
+        return f'InferenceAutotuner({", ".join(attributes)})'
+
+    def get_key(self, inference: PatchBasedInference,
+                model: ModelsType) -> str:
+        """
+        Get the key of the settings of ``model`` with the patch size of
+        ``inference`` on this host.
+        """
+        models = _get_models(model)
+        signature = hashlib.sha1()
+        for module in models:
+            signature.update(type(module).__qualname__.encode())
+            for name, parameter in module.state_dict().items():
+                signature.update(f'{name}:{tuple(parameter.shape)}:'
+                                 f'{parameter.dtype}'.encode())
+            signature.update(str(_get_device(module)).encode())
+        augmentations = len(inference.augmentations)
+        signature.update(f'{inference.ensemble_mode}:{augmentations}'.encode())
+        patch_size = GridExtractor(inference.patch_size).patch_size
+        return '|'.join([
+            f'{type(models[0]).__qualname__}-{signature.hexdigest()[:12]}',
+            'x'.join(str(size) for size in patch_size),
+            socket.gethostname(),
+        ])
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """Load all the settings saved in ``cache_file``."""
+        if not self.cache_file.exists():
+            return {}
+        with open(self.cache_file, 'r', encoding='utf-8') as cache:
+            return json.load(cache)
+
+    def save(self, key: str, settings: Dict[str, Any]) -> None:
+        """Save the settings of ``key`` in ``cache_file``."""
+        cache = self.load()
+        cache[key] = settings
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # Replace the file at once, so that concurrent runs never read it
+        # partially written
+        descriptor, path = tempfile.mkstemp(dir=self.cache_file.parent,
+                                            suffix='.json')
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as temporary:
+            json.dump(cache, temporary, indent=2, sort_keys=True)
+        os.replace(path, self.cache_file)
+
+    @staticmethod
+    def apply(inference: PatchBasedInference,
+              settings: Dict[str, Any]) -> None:
+        """Set the tuned settings of ``inference``."""
+        inference.patch_batch_size = settings['patch_batch_size']
+        inference.num_threads = settings['num_threads']
+        inference.num_workers = settings['num_workers']
+        inference.pin_memory = settings['pin_memory']
+
+    def tune(self,
+             inference: PatchBasedInference,
+             batch: Dict[str, Any],
+             model: ModelsType,
+             intensities: Optional[List[str]] = None,
+             force: bool = False) -> Dict[str, Any]:
+        """
+        Tune ``inference`` for ``model``, or apply the saved settings.
+
+        Parameters
+        ----------
+        inference : PatchBasedInference
+            Inference whose settings are tuned in place.
+        batch : Dict[str, Any]
+            Sample dataloader batch.
+        model : torch.nn.Module or Sequence[torch.nn.Module]
+            Model, or ensemble of models, to use for inference.
+        intensities : List[str], optional
+            In which modalilities to perform inference. Default = ``['T1']``.
+        force : bool, optional
+            If ``True``, benchmark even if settings are saved for the key of
+            the model. Default = ``False``.
+
+        Returns
+        -------
+        settings : Dict[str, Any]
+            Applied settings, with the measured ``'throughput'`` in patches
+            per second and the ``'memory'`` in bytes of a model batch.
+        """
+        intensities = intensities if intensities else ['T1']
+        key = self.get_key(inference, model)
+        settings = None if force else self.load().get(key)
+        if settings is None:
+            settings = self._benchmark(inference, batch, _get_models(model),
+                                       intensities)
+            self.save(key, settings)
+        elif self.verbose:
+            print(f'Autotune: saved settings {settings}')
+        self.apply(inference, settings)
+        return settings
+
+    def _benchmark(self, inference: PatchBasedInference,
+                   batch: Dict[str, Any], models: List[torch.nn.Module],
+                   intensities: List[str]) -> Dict[str, Any]:
+        devices = [_get_device(model) for model in models]
+        pin_memory = any(device.type == 'cuda' for device in devices)
+        subjects = get_subjects_from_batch(batch)
+        patches = self._get_patches(inference, subjects[0], intensities[0])
+        budget = self._get_memory_budget(devices)
+        for model in models:
+            model.eval()
+        ensemble = _Ensemble(models, inference.ensemble_mode,
+                             inference.augmentations, pin_memory)
+        best: Optional[Dict[str, Any]] = None
+        for num_threads in self._get_thread_candidates(pin_memory):
+            for batch_size in self.batch_sizes:
+                inputs = patches[torch.arange(batch_size) % len(patches)]
+                try:
+                    with torch.no_grad(), _num_threads(num_threads):
+                        memory = self._measure_memory(ensemble, inputs,
+                                                      devices)
+                        throughput = self._measure_throughput(
+                            ensemble, inputs)
+                except RuntimeError as error:
+                    if 'out of memory' not in str(error):
+                        raise
+                    _empty_cache(devices)
+                    memory, throughput = math.inf, 0.0
+                measure = {
+                    'patch_batch_size': batch_size,
+                    'num_threads': num_threads,
+                    'throughput': throughput,
+                    'memory': memory,
+                }
+                self.history.append(measure)
+                if self.verbose:
+                    print(f'Autotune: {measure}')
+                # Larger batches do not fit either
+                if math.isinf(memory) or (budget is not None
+                                          and memory > budget):
+                    break
+                if best is None or throughput > best['throughput']:
+                    best = measure
+        if best is None:
+            raise RuntimeError(
+                f'No batch size of {self.batch_sizes} fits the memory budget'
+                f' of {budget} bytes.')
+        settings = dict(best, pin_memory=pin_memory)
+        settings['num_workers'] = self._tune_workers(inference, batch, models,
+                                                     intensities, settings,
+                                                     len(subjects))
+        if self.verbose:
+            print(f'Autotune: tuned settings {settings}')
+        return settings
+
+    def _tune_workers(self, inference: PatchBasedInference,
+                      batch: Dict[str, Any], models: List[torch.nn.Module],
+                      intensities: List[str], settings: Dict[str, Any],
+                      num_subjects: int) -> int:
+        # Time the whole inference on a copy, so that the counters of the
+        # inference are unchanged and no output is written to its directory
+        candidates = [
+            workers for workers in self.num_workers if workers <= num_subjects
+        ]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else 0
+        trial = copy.copy(inference)
+        self.apply(trial, dict(settings, num_workers=0))
+        times = {}
+        with tempfile.TemporaryDirectory() as output_dir:
+            if trial.output_dir is not None:
+                trial.output_dir = Path(output_dir)
+            for workers in candidates:
+                trial.num_workers = workers
+                start = time.perf_counter()
+                trial(batch, models, intensities)
+                times[workers] = time.perf_counter() - start
+                self.history.append({
+                    'num_workers': workers,
+                    'time': times[workers]
+                })
+                if self.verbose:
+                    print(f'Autotune: {workers} workers, {times[workers]:.3f}'
+                          ' seconds')
+        return min(times, key=times.__getitem__)
+
+    def _get_patches(self, inference: PatchBasedInference,
+                     subject: tio.Subject, intensity: str) -> torch.Tensor:
+        # Grid patches of the sample subject
+        extractor = GridExtractor(inference.patch_size,
+                                  inference.patch_overlap,
+                                  inference.padding_mode)
+        data = _PaddedVolumes([subject], [intensity], extractor)[0][intensity]
+        locations = extractor.get_locations(data.shape[1:])
+        return extractor.extract(data, locations[:max(self.batch_sizes)])
+
+    def _get_thread_candidates(self, is_cuda: bool) -> List[Optional[int]]:
+        if self.num_threads is not None:
+            return list(self.num_threads)
+        if is_cuda:
+            return [None]
+        threads = torch.get_num_threads()
+        return sorted({1, max(threads // 4, 1), max(threads // 2, 1), threads})
+
+    def _get_memory_budget(self,
+                           devices: List[torch.device]) -> Optional[float]:
+        if self.memory_budget is not None:
+            return self.memory_budget
+        budgets = [
+            0.9 * (torch.cuda.get_device_properties(device).total_memory -
+                   torch.cuda.memory_reserved(device)) for device in devices
+            if device.type == 'cuda'
+        ]
+        return min(budgets) if budgets else None
+
+    def _measure_memory(self, ensemble: _Ensemble, inputs: torch.Tensor,
+                        devices: List[torch.device]) -> float:
+        cuda_devices = {device for device in devices if device.type == 'cuda'}
+        if cuda_devices:
+            baselines = {}
+            for device in cuda_devices:
+                torch.cuda.reset_peak_memory_stats(device)
+                baselines[device] = torch.cuda.memory_allocated(device)
+            ensemble(inputs)
+            return max(
+                torch.cuda.max_memory_allocated(device) - baseline
+                for device, baseline in baselines.items())
+        # Without an allocator to query, add up the outputs of every leaf
+        # module
+        total = inputs.numel() * inputs.element_size()
+
+        def hook(module: torch.nn.Module, args: Any, output: Any) -> None:
+            nonlocal total
+            if isinstance(output, torch.Tensor):
+                total += output.numel() * output.element_size()
+
+        handles = [
+            module.register_forward_hook(hook) for model in ensemble.models
+            for module in model.modules() if not list(module.children())
+        ]
+        try:
+            ensemble(inputs)
+        finally:
+            for handle in handles:
+                handle.remove()
+        return total
+
+    def _measure_throughput(self, ensemble: _Ensemble,
+                            inputs: torch.Tensor) -> float:
+        # The outputs are returned on the CPU, which waits for the devices
+        ensemble(inputs)
+        start = time.perf_counter()
+        for _ in range(self.num_repeats):
+            ensemble(inputs)
+        elapsed = time.perf_counter() - start
+        return len(inputs) * self.num_repeats / max(elapsed, 1e-9)
+
+
+def _empty_cache(devices: List[torch.device]) -> None:
+    if any(device.type == 'cuda' for device in devices):
+        torch.cuda.empty_cache()
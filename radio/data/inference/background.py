@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Detection of the grid patches and regions that contain no foreground.
+"""
+
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from ..summed_area import get_box_sums, get_summed_area_table
+
+__all__ = ["BackgroundDetector"]
+
+
+class BackgroundDetector:
+    """
+    Find the grid patches of a volume without any foreground voxel.
+
+    A voxel is foreground if its value is above ``threshold`` in any channel,
+    e.g., in the input image itself or in a brain mask. The foreground is
+    reduced to blocks of ``downsampling`` voxels per dimension, a block being
+    foreground if any of its voxels is, and the summed-area table of the
+    blocks is computed once per volume. A patch is background if the blocks
+    it overlaps contain no foreground block, which is read from the table at
+    the 8 corners of the enclosing blocks. The test is exact on the blocks
+    and conservative on the voxels: a patch containing a foreground voxel is
+    never reported as background. The blocks also give the bounding box of
+    the foreground at low resolution, used to restrict inference to a region
+    of interest.
+
+    Parameters
+    ----------
+    threshold : float, optional
+        Value above which a voxel is foreground. Default = ``0``.
+    downsampling : int, optional
+        Size in voxels of the blocks. Default = ``4``.
+    """
+
+    def __init__(self, threshold: float = 0.0, downsampling: int = 4) -> None:
+        if downsampling < 1:
+            raise ValueError('downsampling must be at least 1.')
+        self.threshold = threshold
+        self.downsampling = downsampling
+
+    def _get_blocks(self, data: torch.Tensor) -> torch.Tensor:
+        # Whether each block has a foreground voxel
+        foreground = (data > self.threshold).any(dim=0)
+        return F.max_pool3d(foreground[None, None].float(),
+                            self.downsampling,
+                            ceil_mode=True)[0, 0]
+
+    def get_integral(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        Get the summed-area table of the foreground blocks of a ``(C, W, H,
+        D)`` tensor.
+
+        Returns
+        -------
+        integral : torch.Tensor
+            ``(w + 1, h + 1, d + 1)`` integer tensor, where ``(w, h, d)`` is
+            the number of blocks per dimension, whose entry ``[i, j, k]`` is
+            the number of foreground blocks in ``[:i, :j, :k]``.
+        """
+        return get_summed_area_table(self._get_blocks(data).long())
+
+    def is_background(self, data: torch.Tensor,
+                      locations: torch.Tensor) -> torch.Tensor:
+        """
+        Find the background patches of a ``(C, W, H, D)`` tensor.
+
+        Parameters
+        ----------
+        data : torch.Tensor
+            Tensor defining the foreground, in the same space as the
+            patches.
+        locations : torch.Tensor
+            ``(N, 6)`` tensor of patch locations.
+
+        Returns
+        -------
+        background : torch.Tensor
+            ``(N,)`` boolean tensor, ``True`` for the background patches.
+        """
+        integral = self.get_integral(data)
+        # Enclosing blocks of each patch
+        ini = locations[:, :3] // self.downsampling
+        end = -(-locations[:, 3:] // self.downsampling)
+        return get_box_sums(integral, ini, end) == 0
+
+    def get_bounding_box(self, data: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Get the bounding box of the foreground blocks of a ``(C, W, H, D)``
+        tensor.
+
+        Returns
+        -------
+        bounding_box : torch.Tensor or None
+            ``(6,)`` tensor with the first and last (exclusive) voxel indices
+            of the foreground blocks, clipped to the tensor, or ``None`` if
+            there is no foreground.
+        """
+        indices = torch.nonzero(self._get_blocks(data))
+        if not len(indices):
+            return None
+        ini = indices.min(dim=0).values * self.downsampling
+        fin = (indices.max(dim=0).values + 1) * self.downsampling
+        fin = torch.minimum(fin, torch.as_tensor(data.shape[1:]))
+        return torch.cat((ini, fin))
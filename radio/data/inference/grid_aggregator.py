@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Aggregation of the patches of a regular grid into a volume.
+"""
+
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import torch
+
+from ..datatypes import SpatialShapeType
+from .grid_extractor import GridExtractor
+from .nifti_output import NiftiOutput
+
+__all__ = [
+    "GridAggregator", "LabelAggregator", "OVERLAP_MODES", "AGGREGATOR_DTYPES"
+]
+
+#: Ways of combining the predictions of overlapping patches.
+OVERLAP_MODES = ('crop', 'average', 'gaussian', 'hann')
+#: Dtypes in which the predictions can be accumulated.
+AGGREGATOR_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+# Smallest Gaussian weight, relative to the center of the patch, so that
+# every voxel gets a positive total weight
+MIN_GAUSSIAN_WEIGHT = 1e-3
+# Number of labels of a uint8 label map
+MAX_LABELS = 256
+
+
+@lru_cache(maxsize=16)
+def _get_weights(overlap_mode: str, patch_size: Tuple[int, int, int],
+                 sigma_scale: float) -> torch.Tensor:
+    windows = []
+    for size in patch_size:
+        if overlap_mode == 'hann':
+            # Same window as torchio, without its zero endpoints
+            window = torch.hann_window(size + 2, periodic=False)[1:-1]
+        else:
+            center = (size - 1) / 2
+            sigma = sigma_scale * size
+            positions = torch.arange(size, dtype=torch.float32) - center
+            window = torch.exp(-positions**2 / (2 * sigma**2))
+        windows.append(window)
+    weights = (windows[0][:, None, None] * windows[1][None, :, None] *
+               windows[2][None, None, :])
+    if overlap_mode == 'gaussian':
+        weights = weights.clamp(min=MIN_GAUSSIAN_WEIGHT)
+    return weights
+
+
+class GridAggregator:
+    """
+    Accumulate in place the predictions of the grid patches of a volume.
+
+    The patches are expected at the locations given by a
+    :class:`~radio.data.inference.GridExtractor`, i.e., in the padded volume
+    if ``padding_mode`` is not ``None``. With ``overlap_mode='crop'``, half
+    the overlap is cropped from each side of the patches, as
+    :class:`torchio.data.GridAggregator` does. Otherwise, each patch is
+    multiplied by a weight window and added in place to the output volume,
+    and the output is divided by the sum of the weights once all the patches
+    are added:
+
+    * ``'average'``: equal weights.
+    * ``'gaussian'``: Gaussian window of standard deviation ``sigma_scale``
+      times the patch size, down-weighting the patch borders, where
+      convolutional networks lack context.
+    * ``'hann'``: Hann window, as in :class:`torchio.data.GridAggregator`.
+
+    The windows are computed once per patch size and shared between
+    aggregators. The sum of the weights is kept in a single-channel volume,
+    whatever the number of output channels, and the output can be
+    accumulated in ``float16`` or ``bfloat16`` to halve its memory.
+
+    If ``output_file`` is given, the volume is written directly into a
+    memory-mapped NIfTI file, without padding. The weighted predictions are
+    then accumulated in a slab of the width of a patch along the first axis.
+    As the patches are added in the order of the grid locations, the voxels
+    before the first voxel of the current patch along this axis are final,
+    and are normalized and written to the file before the slab moves
+    forward, so that the memory used is bounded by the size of the slab.
+
+    Parameters
+    ----------
+    extractor : GridExtractor
+        Extractor of the patches.
+    spatial_shape : int or (int, int, int)
+        Spatial shape of the volume, before padding.
+    overlap_mode : str, optional
+        One of ``'crop'``, ``'average'``, ``'gaussian'`` or ``'hann'``.
+        Default = ``'crop'``.
+    dtype : str, optional
+        Dtype of the output volume, one of ``'float32'``, ``'float16'`` or
+        ``'bfloat16'``. With an output file, it is the dtype of the slab, and
+        half precision volumes are written in ``float32``.
+        Default = ``'float32'``.
+    sigma_scale : float, optional
+        Standard deviation of the Gaussian window, relative to the patch
+        size. Default = ``0.125``.
+    output_file : NiftiOutput, optional
+        File into which the volume is written. If ``None``, the volume is
+        kept in memory. Default = ``None``.
+    """
+
+    def __init__(self,
+                 extractor: GridExtractor,
+                 spatial_shape: SpatialShapeType,
+                 overlap_mode: str = 'crop',
+                 dtype: str = 'float32',
+                 sigma_scale: float = 0.125,
+                 output_file: Optional[NiftiOutput] = None) -> None:
+        if overlap_mode not in OVERLAP_MODES:
+            raise ValueError(f'Overlap mode must be one of {OVERLAP_MODES},'
+                             f' not "{overlap_mode}".')
+        if dtype not in AGGREGATOR_DTYPES:
+            raise ValueError(f'Aggregator dtype must be one of'
+                             f' {tuple(AGGREGATOR_DTYPES)}, not "{dtype}".')
+        if sigma_scale <= 0:
+            raise ValueError('sigma_scale must be positive.')
+        self.extractor = extractor
+        self.spatial_shape = extractor.get_padded_shape(spatial_shape)
+        self.overlap_mode = overlap_mode
+        self.dtype = AGGREGATOR_DTYPES[dtype]
+        self.sigma_scale = sigma_scale
+        self.output_file = output_file
+        # Whether the weighted predictions are accumulated in a slab
+        self.streaming = output_file is not None
+        self._output: Optional[torch.Tensor] = None
+        self._weight_sum: Optional[torch.Tensor] = None
+        self._slab: Optional[torch.Tensor] = None
+        # First voxel of the slab along the first axis
+        self._slab_start = 0
+        self._weights: Optional[torch.Tensor] = None
+        if overlap_mode in ('gaussian', 'hann'):
+            self._weights = _get_weights(overlap_mode, extractor.patch_size,
+                                         sigma_scale)
+
+    def _initialize(self, num_channels: int) -> None:
+        if self._output is not None:
+            return
+        self._output = self._create_volume(num_channels, self.dtype,
+                                           self.output_file)
+        self._initialize_slab(num_channels)
+
+    def _create_volume(self, num_channels: int, dtype: torch.dtype,
+                       output_file: Optional[NiftiOutput]) -> torch.Tensor:
+        # Padded volume in memory, or unpadded volume in the output file
+        if output_file is not None:
+            return output_file.create(num_channels, dtype)
+        return torch.zeros(num_channels, *self.spatial_shape, dtype=dtype)
+
+    def _initialize_slab(self, num_channels: int) -> None:
+        if self.overlap_mode == 'crop':
+            return
+        if not self.streaming:
+            # The predictions are accumulated in the output volume
+            self._weight_sum = torch.zeros(1,
+                                           *self.spatial_shape,
+                                           dtype=torch.float32)
+            return
+        slab_shape = (self.extractor.patch_size[0], *self.spatial_shape[1:])
+        self._slab = torch.zeros(num_channels, *slab_shape, dtype=self.dtype)
+        self._weight_sum = torch.zeros(1, *slab_shape, dtype=torch.float32)
+
+    def add_batch(self, batch: torch.Tensor, locations: torch.Tensor) -> None:
+        """
+        Add a batch of predicted patches.
+
+        Parameters
+        ----------
+        batch : torch.Tensor
+            ``(N, C, w, h, d)`` tensor of predictions.
+        locations : torch.Tensor
+            ``(N, 6)`` tensor of the locations of the patches.
+        """
+        if tuple(batch.shape[2:]) != self.extractor.patch_size:
+            raise RuntimeError(
+                f'The shape of the patches, {tuple(batch.shape[2:])}, does'
+                f' not match the patch size, {self.extractor.patch_size}.')
+        batch = batch.cpu()
+        self._initialize(batch.shape[1])
+        if self.overlap_mode == 'crop':
+            self._add_cropped(batch, locations)
+        elif self.streaming:
+            self._add_to_slab(batch, locations)
+        else:
+            self._add_weighted(batch, locations)
+
+    def _get_cropped(
+        self, patch: torch.Tensor, location: torch.Tensor
+    ) -> Tuple[torch.Tensor, Tuple[slice, slice, slice]]:
+        # Crop half the overlap of each side of the patch, and get the
+        # region of the volume where the cropped patch goes
+        half_overlap = torch.as_tensor(self.extractor.patch_overlap) // 2
+        crop_ini = half_overlap.clone()
+        crop_fin = half_overlap.clone()
+        # Patches at the border of an unpadded volume are not cropped on that
+        # side
+        if self.extractor.padding_mode is None:
+            crop_ini *= location[:3] > 0
+            crop_fin *= location[3:] != torch.as_tensor(self.spatial_shape)
+        ini = (location[:3] + crop_ini).tolist()
+        fin = (location[3:] - crop_fin).tolist()
+        patch_ini = crop_ini.tolist()
+        patch_fin = (torch.as_tensor(patch.shape[1:]) - crop_fin).tolist()
+        cropped = patch[:, patch_ini[0]:patch_fin[0],
+                        patch_ini[1]:patch_fin[1], patch_ini[2]:patch_fin[2]]
+        region = (slice(ini[0], fin[0]), slice(ini[1], fin[1]),
+                  slice(ini[2], fin[2]))
+        return cropped, region
+
+    def _write(self, volume: torch.Tensor, values: torch.Tensor,
+               region: Tuple[slice, slice, slice]) -> None:
+        # Write values to a region of the padded volume, clipped to the
+        # unpadded volume of an output file
+        if self.output_file is None:
+            volume[(slice(None), ) + region] = values
+            return
+        volume_region = []
+        values_region = []
+        for axis, (bounds, border) in enumerate(
+                zip(region, self.extractor.border)):
+            start = bounds.start or 0
+            stop = start + values.shape[axis + 1]
+            ini = max(start - border, 0)
+            fin = min(stop - border, volume.shape[axis + 1])
+            if fin <= ini:
+                return
+            volume_region.append(slice(ini, fin))
+            values_region.append(slice(ini + border - start,
+                                       fin + border - start))
+        volume[(slice(None), ) + tuple(volume_region)] = values[
+            (slice(None), ) + tuple(values_region)]
+
+    def _add_cropped(self, batch: torch.Tensor,
+                     locations: torch.Tensor) -> None:
+        assert self._output is not None
+        for patch, location in zip(batch, locations):
+            cropped, region = self._get_cropped(patch, location)
+            self._write(self._output, cropped, region)
+
+    def _add_weighted(self, batch: torch.Tensor,
+                      locations: torch.Tensor) -> None:
+        assert self._output is not None and self._weight_sum is not None
+        for patch, location in zip(batch, locations):
+            i_ini, j_ini, k_ini, i_fin, j_fin, k_fin = location.tolist()
+            output = self._output[:, i_ini:i_fin, j_ini:j_fin, k_ini:k_fin]
+            weight_sum = self._weight_sum[:, i_ini:i_fin, j_ini:j_fin,
+                                          k_ini:k_fin]
+            if self._weights is None:
+                output.add_(patch)
+                weight_sum.add_(1)
+            else:
+                output.addcmul_(patch, self._weights)
+                weight_sum.add_(self._weights)
+
+    def _get_slab_values(self, patch: torch.Tensor) -> torch.Tensor:
+        # Values of a patch accumulated in the slab
+        return patch
+
+    def _add_to_slab(self, batch: torch.Tensor,
+                     locations: torch.Tensor) -> None:
+        assert self._slab is not None and self._weight_sum is not None
+        for patch, location in zip(batch, locations):
+            i_ini, j_ini, k_ini, i_fin, j_fin, k_fin = location.tolist()
+            if i_ini < self._slab_start:
+                raise RuntimeError(
+                    'Patches must be added in the order of the grid'
+                    ' locations.')
+            self._flush(i_ini)
+            region = (slice(None), slice(0, i_fin - i_ini),
+                      slice(j_ini, j_fin), slice(k_ini, k_fin))
+            values = self._get_slab_values(patch)
+            if self._weights is None:
+                self._slab[region].add_(values)
+                self._weight_sum[region].add_(1)
+            else:
+                self._slab[region].addcmul_(values, self._weights)
+                self._weight_sum[region].add_(self._weights)
+
+    def _flush(self, end: int) -> None:
+        # Write the final voxels of the slab before end, and move the slab
+        # forward
+        assert self._slab is not None and self._weight_sum is not None
+        num_final = min(end, self.spatial_shape[0]) - self._slab_start
+        if num_final <= 0:
+            return
+        num_final = min(num_final, len(self._weight_sum[0]))
+        weight_sum = self._weight_sum[:, :num_final]
+        # Voxels not covered by any patch are set to zero
+        values = self._slab[:, :num_final].float().div_(
+            weight_sum.clamp(min=torch.finfo().tiny))
+        self._write_final(
+            values,
+            (slice(self._slab_start, self._slab_start + num_final),
+             slice(None), slice(None)))
+        for slab in (self._slab, self._weight_sum):
+            slab[:, :-num_final] = slab[:, num_final:].clone()
+            slab[:, -num_final:] = 0
+        self._slab_start = max(end, self._slab_start + num_final)
+
+    def _write_final(self, values: torch.Tensor,
+                     region: Tuple[slice, slice, slice]) -> None:
+        assert self._output is not None
+        self._write(self._output, values, region)
+
+    def _finalize(self) -> None:
+        # Write the voxels still in the slab, or normalize the output
+        if self._slab is not None:
+            self._flush(self.spatial_shape[0])
+        elif self._weight_sum is not None:
+            assert self._output is not None
+            # Voxels not covered by any patch are left to zero
+            self._output.div_(self._weight_sum.clamp_(min=torch.finfo().tiny))
+            self._weight_sum = None
+        if self.output_file is not None:
+            self.output_file.flush()
+
+    def get_output_tensor(self) -> torch.Tensor:
+        """
+        Get the aggregated volume, cropped to its size before padding.
+
+        The output is normalized in place, so no patch can be added after
+        this call. With an output file, the returned tensor is a view of the
+        memory-mapped file.
+        """
+        if self._output is None:
+            raise RuntimeError('No patch was added to the aggregator.')
+        self._finalize()
+        return self._crop_border(self._output)
+
+    def _crop_border(self, volume: torch.Tensor) -> torch.Tensor:
+        # Remove the padding of the extractor
+        if self.extractor.padding_mode is None or self.output_file is not None:
+            return volume
+        border = self.extractor.border
+        return volume[:, border[0]:volume.shape[1] - border[0],
+                      border[1]:volume.shape[2] - border[1],
+                      border[2]:volume.shape[3] - border[2]].clone()
+
+
+class LabelAggregator(GridAggregator):
+    """
+    Aggregate the class scores of the grid patches of a volume into a label
+    map, without keeping the scores of the whole volume.
+
+    The predictions are class logits, converted to probabilities with a
+    softmax over the channels, or with a sigmoid if there is a single
+    channel, which gives the probability of label ``1``. Only a ``uint8``
+    label map, and optionally the probability of the predicted label, are
+    kept for the whole volume:
+
+    * With ``overlap_mode='crop'``, each voxel is predicted by a single
+      patch, and the labels of a patch are written as soon as it is added.
+    * Otherwise, the weighted probabilities are accumulated in a slab, as
+      for a :class:`GridAggregator` with an output file, and the final
+      voxels are converted to labels before the slab moves forward.
+
+    For ``K`` classes, the memory of the aggregated volume drops from ``4K``
+    bytes per voxel, plus the weights, to ``1`` byte, plus the precision of
+    ``dtype`` if the probabilities are kept, and the slab.
+
+    Parameters
+    ----------
+    extractor : GridExtractor
+        Extractor of the patches.
+    spatial_shape : int or (int, int, int)
+        Spatial shape of the volume, before padding.
+    overlap_mode : str, optional
+        One of ``'crop'``, ``'average'``, ``'gaussian'`` or ``'hann'``.
+        Default = ``'crop'``.
+    dtype : str, optional
+        Dtype of the slab and of the probability map, one of ``'float32'``,
+        ``'float16'`` or ``'bfloat16'``. Default = ``'float32'``.
+    sigma_scale : float, optional
+        Standard deviation of the Gaussian window, relative to the patch
+        size. Default = ``0.125``.
+    max_probability : bool, optional
+        If ``True``, keep the probability of the predicted label of each
+        voxel. Default = ``False``.
+    output_file : NiftiOutput, optional
+        File into which the label map is written. If ``None``, the label
+        map is kept in memory. Default = ``None``.
+    probability_file : NiftiOutput, optional
+        File into which the probability map is written. If ``None``, the
+        probability map is kept in memory. Default = ``None``.
+    """
+
+    def __init__(self,
+                 extractor: GridExtractor,
+                 spatial_shape: SpatialShapeType,
+                 overlap_mode: str = 'crop',
+                 dtype: str = 'float32',
+                 sigma_scale: float = 0.125,
+                 max_probability: bool = False,
+                 output_file: Optional[NiftiOutput] = None,
+                 probability_file: Optional[NiftiOutput] = None) -> None:
+        if (probability_file is not None) != (output_file is not None
+                                              and max_probability):
+            raise ValueError('The label and probability maps must both be'
+                             ' written to files, or both kept in memory.')
+        super().__init__(extractor, spatial_shape, overlap_mode, dtype,
+                         sigma_scale, output_file)
+        self.max_probability = max_probability
+        self.probability_file = probability_file
+        self.streaming = True
+        self._probability: Optional[torch.Tensor] = None
+
+    def _initialize(self, num_channels: int) -> None:
+        if self._output is not None:
+            return
+        if num_channels > MAX_LABELS:
+            raise ValueError(f'At most {MAX_LABELS} classes can be stored in'
+                             f' a uint8 label map, not {num_channels}.')
+        self._output = self._create_volume(1, torch.uint8, self.output_file)
+        if self.max_probability:
+            self._probability = self._create_volume(1, self.dtype,
+                                                    self.probability_file)
+        # Binary predictions are expanded to two classes
+        self._initialize_slab(max(num_channels, 2))
+
+    def _get_slab_values(self, patch: torch.Tensor) -> torch.Tensor:
+        # Class probabilities along the first dimension
+        if len(patch) == 1:
+            probability = torch.sigmoid(patch.float())
+            return torch.cat((1 - probability, probability))
+        return torch.softmax(patch.float(), dim=0)
+
+    def _write_final(self, values: torch.Tensor,
+                     region: Tuple[slice, slice, slice]) -> None:
+        assert self._output is not None
+        probability, labels = values.max(dim=0, keepdim=True)
+        self._write(self._output, labels, region)
+        if self._probability is not None:
+            self._write(self._probability, probability, region)
+
+    def _add_cropped(self, batch: torch.Tensor,
+                     locations: torch.Tensor) -> None:
+        for patch, location in zip(batch, locations):
+            cropped, region = self._get_cropped(patch, location)
+            self._write_final(self._get_slab_values(cropped), region)
+
+    def _finalize(self) -> None:
+        super()._finalize()
+        if self.probability_file is not None:
+            self.probability_file.flush()
+
+    def get_output_tensor(self) -> torch.Tensor:
+        """Get the ``(1, W, H, D)`` uint8 label map."""
+        return super().get_output_tensor()
+
+    def get_probability_tensor(self) -> Optional[torch.Tensor]:
+        """
+        Get the ``(1, W, H, D)`` probability of the predicted labels, or
+        ``None`` if ``max_probability`` is ``False``.
+        """
+        if self._probability is None:
+            return None
+        self._finalize()
+        return self._crop_border(self._probability)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Extraction of the patches of a regular grid, as tensors.
+"""
+
+from functools import lru_cache
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+import torchio as tio  # type: ignore
+from torchio.data import GridSampler
+
+from ..datatypes import SpatialShapeType
+
+__all__ = ["GridExtractor"]
+
+TripletInt = Tuple[int, int, int]
+
+
+@lru_cache(maxsize=64)
+def _get_grid_locations(spatial_shape: TripletInt, patch_size: TripletInt,
+                        patch_overlap: TripletInt) -> torch.Tensor:
+    # Same locations and order as GridSampler
+    # pylint: disable=protected-access
+    locations = GridSampler._get_patches_locations(spatial_shape, patch_size,
+                                                   patch_overlap)
+    return torch.as_tensor(locations.astype(np.int64))
+
+
+class GridExtractor:
+    """
+    Extract the patches of the grid of a volume directly as tensors.
+
+    A :class:`torchio.data.GridSampler` crops a copy of the subject for every
+    patch of the grid, and the patches are then collated by a
+    :class:`~torch.utils.data.DataLoader`. Instead, this extractor computes
+    the grid locations once per ``(spatial_shape, patch_size,
+    patch_overlap)``, and shares them across all the volumes of the same
+    shape. The patches of a batch of locations are gathered from a strided
+    view of the volume holding every patch of the volume, which
+    :meth:`torch.Tensor.unfold` builds without copying any voxel.
+
+    The locations are the ones of a :class:`torchio.data.GridSampler` with the
+    same parameters, so the patches can be aggregated with a
+    :class:`torchio.data.GridAggregator`.
+
+    Parameters
+    ----------
+    patch_size : int or (int, int, int)
+        Tuple of integers ``(w, h, d)`` to generate patches of size ``w x h x
+        d``. If a single number ``n`` is provided, ``w = h = d = n``.
+    patch_overlap : int or (int, int, int), optional
+        Tuple of even integers ``(w_o, h_o, d_o)`` specifying the overlap
+        between patches. If a single number ``n`` is provided, ``w_o = h_o =
+        d_o = n``. Default = ``(0, 0, 0)``.
+    padding_mode : str or float or None, optional
+        Same as ``padding_mode`` in :class:`torchio.data.GridSampler`. If not
+        ``None``, the volumes are padded with ``w_o/2, h_o/2, d_o/2`` on each
+        side before extracting the patches. Default = ``None``.
+
+    Examples
+    --------
+    >>> extractor = GridExtractor(64, 16)
+    >>> data = extractor.pad(subject)['t1'][tio.DATA]
+    >>> locations = extractor.get_locations(data.shape[1:])
+    >>> extractor.extract(data, locations[:8]).shape
+    torch.Size([8, 1, 64, 64, 64])
+    """
+
+    def __init__(self,
+                 patch_size: SpatialShapeType,
+                 patch_overlap: SpatialShapeType = (0, 0, 0),
+                 padding_mode: Union[str, float, None] = None) -> None:
+        self.patch_size = self._to_triplet(patch_size)
+        self.patch_overlap = self._to_triplet(patch_overlap)
+        if any(size < 1 for size in self.patch_size):
+            raise ValueError('Patch size must be positive.')
+        if any(overlap % 2 for overlap in self.patch_overlap):
+            raise ValueError('Patch overlap must be a tuple of even integers,'
+                             f' not {self.patch_overlap}.')
+        if any(overlap >= size
+               for overlap, size in zip(self.patch_overlap, self.patch_size)):
+            raise ValueError(f'Patch overlap {self.patch_overlap} must be'
+                             f' smaller than patch size {self.patch_size}.')
+        self.padding_mode = padding_mode
+
+    @staticmethod
+    def _to_triplet(value: SpatialShapeType) -> TripletInt:
+        values = tuple(int(item) for item in np.broadcast_to(value, 3))
+        return values[0], values[1], values[2]
+
+    @property
+    def border(self) -> TripletInt:
+        """Padding added on each side of the volumes."""
+        if self.padding_mode is None:
+            return 0, 0, 0
+        border = tuple(overlap // 2 for overlap in self.patch_overlap)
+        return border[0], border[1], border[2]
+
+    def get_padded_shape(self, spatial_shape: SpatialShapeType) -> TripletInt:
+        """Spatial shape of a volume of ``spatial_shape`` once padded."""
+        padded = tuple(
+            int(size) + 2 * border
+            for size, border in zip(spatial_shape, self.border))
+        return padded[0], padded[1], padded[2]
+
+    def pad(self, subject: tio.Subject) -> tio.Subject:
+        """Pad the images of ``subject`` as a GridSampler would."""
+        if self.padding_mode is None:
+            return subject
+        padding = tuple(border for border in self.border for _ in range(2))
+        return tio.Pad(padding, padding_mode=self.padding_mode)(subject)
+
+    def get_locations(self, spatial_shape: SpatialShapeType) -> torch.Tensor:
+        """
+        Get the grid locations of a padded volume.
+
+        The locations are cached and shared by all the volumes of the same
+        shape, and must not be modified in place.
+
+        Parameters
+        ----------
+        spatial_shape : int or (int, int, int)
+            Spatial shape of the padded volume.
+
+        Returns
+        -------
+        locations : torch.Tensor
+            ``(N, 6)`` tensor with the first and last (exclusive) voxel
+            indices of each patch, as in ``patch[LOCATION]``.
+        """
+        shape = self._to_triplet(spatial_shape)
+        if any(size > dim for size, dim in zip(self.patch_size, shape)):
+            raise ValueError(f'Patch size {self.patch_size} cannot be larger'
+                             f' than image size {shape}.')
+        return _get_grid_locations(shape, self.patch_size, self.patch_overlap)
+
+    def extract(self, data: torch.Tensor,
+                locations: torch.Tensor) -> torch.Tensor:
+        """
+        Extract the patches at ``locations`` of a ``(C, W, H, D)`` tensor.
+
+        Returns
+        -------
+        patches : torch.Tensor
+            ``(N, C, w, h, d)`` tensor of patches.
+        """
+        # (C, W - w + 1, H - h + 1, D - d + 1, w, h, d) view of every patch
+        windows = data
+        for axis, size in enumerate(self.patch_size, start=1):
+            windows = windows.unfold(axis, size, 1)
+        patches = windows[:, locations[:, 0], locations[:, 1], locations[:, 2]]
+        return patches.transpose(0, 1)
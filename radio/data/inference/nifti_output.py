@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Inference outputs written directly into NIfTI files.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+import nibabel as nib  # type: ignore
+import numpy as np
+import torch
+
+from ...settings import PathType
+from ..datatypes import SpatialShapeType
+
+__all__ = ["NiftiOutput"]
+
+# NIfTI-1 header and empty extension flag
+NIFTI_DATA_OFFSET = 352
+# Dtypes of the files, by dtype of the outputs. NIfTI has no half precision,
+# so half precision outputs are written in single precision
+NIFTI_DTYPES = {
+    torch.uint8: np.uint8,
+    torch.int16: np.int16,
+    torch.int32: np.int32,
+    torch.float16: np.float32,
+    torch.bfloat16: np.float32,
+    torch.float32: np.float32,
+    torch.float64: np.float64,
+}
+
+
+class NiftiOutput:
+    """
+    Volume memory-mapped onto a NIfTI file.
+
+    The header is written when the volume is created, and the voxels are
+    written in place by the aggregator through a tensor view of the memory
+    map, so that the whole volume is never held in memory. Once flushed, the
+    file can be read by any NIfTI reader, e.g., as a
+    :class:`torchio.ScalarImage`.
+
+    Parameters
+    ----------
+    path : PathType
+        Path of the ``.nii`` file, which is overwritten.
+    spatial_shape : int or (int, int, int)
+        Spatial shape of the whole volume.
+    affine : np.ndarray, optional
+        ``4 x 4`` affine of the volume. If ``None``, the identity is used.
+        Default = ``None``.
+    """
+
+    def __init__(self,
+                 path: PathType,
+                 spatial_shape: SpatialShapeType,
+                 affine: Optional[np.ndarray] = None) -> None:
+        self.path = Path(path)
+        shape = tuple(int(size) for size in np.broadcast_to(spatial_shape, 3))
+        self.spatial_shape = shape
+        self.affine = np.eye(4) if affine is None else np.asarray(affine)
+        self._memmap: Optional[np.memmap] = None
+
+    def create(self, num_channels: int, dtype: torch.dtype) -> torch.Tensor:
+        """Create the file and get a ``(C, W, H, D)`` tensor view of it."""
+        if dtype not in NIFTI_DTYPES:
+            raise ValueError(f'Dtype {dtype} cannot be written to NIfTI.')
+        numpy_dtype = np.dtype(NIFTI_DTYPES[dtype])
+        shape = self.spatial_shape
+        if num_channels > 1:
+            shape += (num_channels, )
+        header = nib.Nifti1Header()
+        header.set_data_dtype(numpy_dtype)
+        header.set_data_shape(shape)
+        header.set_data_offset(NIFTI_DATA_OFFSET)
+        header.set_sform(self.affine, code='aligned')
+        header.set_qform(self.affine, code='aligned')
+        num_bytes = int(np.prod(shape)) * numpy_dtype.itemsize
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'wb') as nifti_file:
+            nifti_file.write(header.binaryblock)
+            nifti_file.write(b'\0' * (NIFTI_DATA_OFFSET - header.sizeof_hdr))
+            # The data is left sparse until it is written
+            nifti_file.truncate(NIFTI_DATA_OFFSET + num_bytes)
+        # NIfTI data is in Fortran order, with the channels last
+        self._memmap = np.memmap(self.path,
+                                 dtype=numpy_dtype,
+                                 mode='r+',
+                                 offset=NIFTI_DATA_OFFSET,
+                                 shape=self.spatial_shape + (num_channels, ),
+                                 order='F')
+        return torch.from_numpy(self._memmap).permute(3, 0, 1, 2)
+
+    def flush(self) -> None:
+        """Write the pending changes of the volume to the file."""
+        if self._memmap is not None:
+            self._memmap.flush()
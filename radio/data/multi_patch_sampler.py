@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Sampler that extracts all the patches of a volume at once.
+"""
+
+from typing import Any, Dict
+
+import numpy as np
+import torch
+from torchio import Subject, DATA, LOCATION
+from torchio.data import PatchSampler, UniformSampler, WeightedSampler
+
+__all__ = ["MultiPatchSampler"]
+
+# Same as torchio.constants.MIN_FLOAT_32
+MIN_FLOAT_32 = float(np.finfo(np.float32).eps)
+
+
+class MultiPatchSampler:
+    """
+    Draw several patches of a subject at once.
+
+    A :class:`torchio.data.PatchSampler` yields one patch per step, cropping
+    a copy of the whole subject each time. Instead, this sampler draws the
+    locations of all the patches first, and then extracts the patches of each
+    image with a single indexed gather, returning them stacked in the same
+    layout as :meth:`~radio.data.patch_storage.TensorPatchStorage.pop_batch`.
+    Patch locations are drawn with the same distribution as the wrapped
+    sampler. :class:`torchio.data.UniformSampler`,
+    :class:`torchio.data.WeightedSampler` and
+    :class:`torchio.data.LabelSampler` are supported.
+
+    Parameters
+    ----------
+    sampler : PatchSampler
+        Sampler defining the patch size and the distribution of the patch
+        locations.
+
+    Examples
+    --------
+    >>> import torchio as tio
+    >>> sampler = MultiPatchSampler(tio.UniformSampler(64))
+    >>> patches = sampler(subject, 16)
+    >>> patches['t1'][tio.DATA].shape
+    torch.Size([16, 1, 64, 64, 64])
+    """
+
+    def __init__(self, sampler: PatchSampler) -> None:
+        if not self.is_supported(sampler):
+            raise ValueError(
+                f'Sampler {type(sampler).__name__} is not supported. Use a'
+                ' UniformSampler, WeightedSampler or LabelSampler.')
+        self.sampler = sampler
+        self.patch_size = torch.as_tensor(sampler.patch_size.astype(np.int64))
+
+    @staticmethod
+    def is_supported(sampler: PatchSampler) -> bool:
+        """Whether the patches of ``sampler`` can be drawn at once."""
+        # LabelSampler is a WeightedSampler
+        return isinstance(sampler, (UniformSampler, WeightedSampler))
+
+    def __call__(self, subject: Subject, num_patches: int) -> Dict[str, Any]:
+        """
+        Extract ``num_patches`` patches of ``subject``.
+
+        Parameters
+        ----------
+        subject : Subject
+            Subject from which to extract the patches.
+        num_patches : int
+            Number of patches to extract.
+
+        Returns
+        -------
+        patches : Dict[str, Any]
+            ``{image_name: {DATA: tensor}, LOCATION: locations}`` dictionary
+            where the first dimension of each tensor is the patch dimension.
+        """
+        locations = self.get_locations(subject, num_patches)
+        return self.extract_patches(subject, locations)
+
+    def extract_patches(self, subject: Subject,
+                        locations: torch.Tensor) -> Dict[str, Any]:
+        """
+        Extract the patches of ``subject`` at ``locations``.
+
+        Parameters
+        ----------
+        subject : Subject
+            Subject from which to extract the patches.
+        locations : torch.Tensor
+            ``(N, 6)`` tensor of patch locations, e.g., returned by
+            :meth:`get_locations`.
+
+        Returns
+        -------
+        patches : Dict[str, Any]
+            ``{image_name: {DATA: tensor}, LOCATION: locations}`` dictionary
+            where the first dimension of each tensor is the patch dimension.
+        """
+        images = subject.get_images_dict(intensity_only=False)
+        patches: Dict[str, Any] = {
+            name: {
+                DATA: self.extract(image.data, locations)
+            }
+            for name, image in images.items()
+        }
+        patches[LOCATION] = locations
+        return patches
+
+    def get_locations(self, subject: Subject,
+                      num_patches: int) -> torch.Tensor:
+        """
+        Draw the locations of ``num_patches`` patches of ``subject``.
+
+        Returns
+        -------
+        locations : torch.Tensor
+            ``(num_patches, 6)`` tensor with the first and last (exclusive)
+            voxel indices of each patch, as in ``patch[LOCATION]``.
+        """
+        subject.check_consistent_space()
+        spatial_shape = torch.as_tensor(subject.spatial_shape)
+        if torch.any(self.patch_size > spatial_shape):
+            raise RuntimeError(
+                f'Patch size {tuple(self.patch_size.tolist())} cannot be'
+                f' larger than image size {tuple(spatial_shape.tolist())}')
+        if isinstance(self.sampler, WeightedSampler):
+            index_ini = self._get_weighted_index_ini(subject, num_patches)
+        else:
+            valid_range = spatial_shape - self.patch_size
+            index_ini = torch.stack([
+                torch.randint(int(value) + 1, (num_patches, ))
+                for value in valid_range
+            ], dim=1)
+        return torch.cat((index_ini, index_ini + self.patch_size), dim=1)
+
+    def _get_weighted_index_ini(self, subject: Subject,
+                                num_patches: int) -> torch.Tensor:
+        sampler = self.sampler
+        assert isinstance(sampler, WeightedSampler)
+        probability_map = sampler.process_probability_map(
+            sampler.get_probability_map(subject), subject)
+        cdf = np.cumsum(probability_map.ravel())
+        # Inverse transform sampling of all the centers at once, excluding
+        # random numbers equal to 0, as torchio does
+        random_numbers = torch.rand(num_patches, dtype=torch.float64)
+        random_numbers = random_numbers.clamp_(min=MIN_FLOAT_32) * cdf[-1]
+        indices = np.searchsorted(cdf, random_numbers.numpy())
+        centers = np.stack(np.unravel_index(indices, probability_map.shape),
+                           axis=1)
+        return torch.as_tensor(centers) - self.patch_size // 2
+
+    def extract(self, data: torch.Tensor,
+                locations: torch.Tensor) -> torch.Tensor:
+        """
+        Extract the patches at ``locations`` of a ``(C, W, H, D)`` tensor.
+
+        Returns
+        -------
+        patches : torch.Tensor
+            ``(N, C, w, h, d)`` tensor of patches.
+        """
+        index_i, index_j, index_k = (
+            locations[:, axis, None] + torch.arange(int(size))
+            for axis, size in enumerate(self.patch_size))
+        # A single advanced indexing gathers every patch, giving
+        # (C, N, w, h, d)
+        patches = data[:, index_i[:, :, None, None],
+                       index_j[:, None, :, None], index_k[:, None, None, :]]
+        return patches.transpose(0, 1)
@@ -0,0 +1,996 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Patches queue for one or several domains, generalizing torchio.data.Queue.
+"""
+
+import copy
+import math
+import queue
+import threading
+import time
+from itertools import islice
+from typing import (Any, Dict, Iterator, List, Optional, Sequence, Tuple,
+                    Union, cast)
+
+import humanize  # type: ignore
+import numpy as np
+from torch.utils.data import DataLoader
+from torch.utils.data import Dataset, Sampler, SequentialSampler
+
+from torchio import Subject, LOCATION
+from torchio.data import PatchSampler
+
+from .datatypes import SpatialShapeType
+from .unpaired_dataset import UnpairedDomainDataset
+from .patch_storage import (PatchStorage, ListPatchStorage,
+                            TensorPatchStorage)
+from .subject_sampler import SubjectSampler
+from .multi_patch_sampler import MultiPatchSampler
+from .foreground_filter import ForegroundFilter
+from .queue_autoscaler import QueueAutoscaler
+from .subjects_loader import SubjectsPool, UnorderedSubjectsLoader
+
+__all__ = ["PatchQueue"]
+
+NUM_SAMPLES = 'num_samples'
+SUBJECTS = 'subjects'
+#: Name of the domain of single domain datasets.
+DEFAULT_DOMAIN = 'default'
+SubjectsLoaderType = Union[DataLoader, UnorderedSubjectsLoader]
+PATCH_STORAGES = ('list', 'tensor')
+
+
+def resize_sampler(sampler: PatchSampler,
+                   patch_size: SpatialShapeType) -> PatchSampler:
+    """Copy of ``sampler`` drawing patches of size ``patch_size``."""
+    resized = copy.copy(sampler)
+    # Only the patch size is set, the other attributes of the copy are kept
+    PatchSampler.__init__(resized, patch_size)
+    return resized
+
+
+class PatchQueue(Dataset):
+    r"""Queue used for stochastic patch-based training.
+
+    Patches are sampled from volumes loaded in parallel by a subjects
+    loader, stored in a buffer and popped for training, as with
+    :class:`torchio.data.Queue`, whose documentation describes the queueing
+    workflow in detail. Subjects are shuffled at the beginning of each
+    epoch, which ends once the patches of all the subjects have been used,
+    and the patches are shuffled once the buffer is full so that batches mix
+    patches of different subjects.
+
+    The queue handles one or several domains, e.g., the 3T and 7T volumes of
+    an unpaired dataset. With a single domain, each item is a patch, as with
+    :class:`~torchio.data.Queue`. With several domains, each item is a tuple
+    with one patch per domain, and the patches of each domain are kept in
+    their own storage.
+
+    Args:
+        subjects_dataset: Dataset of subjects. With a single domain, e.g., a
+            :class:`~torchio.data.SubjectsDataset`, each item is a
+            :class:`~torchio.Subject`. With several domains, e.g., a
+            :class:`~radio.data.unpaired_dataset.MRIUnpairedDataset`, each
+            item is a tuple with one subject per domain.
+        max_length: Maximum number of patches that can be stored in the queue.
+            Using a large number means that the queue needs to be filled less
+            often, but more CPU memory is needed to store the patches.
+        samples_per_volume: Default number of patches to extract from each
+            volume. If a subject contains an attribute :attr:`num_samples`, it
+            will be used instead of :attr:`samples_per_volume`.
+            A small number of patches ensures a large variability in the queue,
+            but training will be slower.
+        sampler: A subclass of :class:`~torchio.data.sampler.PatchSampler` used
+            to extract patches from the volumes.
+        num_workers: Number of subprocesses to use for data loading
+            (as in :class:`torch.utils.data.DataLoader`).
+            ``0`` means that the data will be loaded in the main process.
+        shuffle_subjects: If ``True``, the subjects dataset is shuffled at the
+            beginning of each epoch, i.e. when all patches from all subjects
+            have been processed.
+        persistent_workers: If ``True``, the subjects loader is created once
+            and its workers are kept alive across epochs, the subjects being
+            reshuffled at the beginning of each epoch by a
+            :class:`~radio.data.subject_sampler.SubjectSampler`. If
+            ``False``, a new loader, and new worker processes, are created
+            every epoch.
+        shuffle_patches: If ``True``, patches are shuffled after filling the
+            queue.
+        start_background: If ``True``, the loader will start working in the
+            background as soon as the queue is instantiated.
+        double_buffer: If ``True``, a background thread fills a second
+            patches buffer while the current one is being consumed, and the
+            buffers are swapped when the current one runs out. This hides the
+            filling time from the training loop at the cost of keeping up to
+            two buffers in memory. If ``False``, the queue is filled
+            synchronously when it runs empty.
+        patch_storage: How the patches are stored in the queue. If
+            ``'list'``, patches are kept as a list of
+            :class:`~torchio.Subject` instances. If ``'tensor'``, the patches
+            of each domain are kept in preallocated contiguous tensors, see
+            :class:`~radio.data.patch_storage.TensorPatchStorage`. With
+            ``'tensor'`` storage and a uniform, weighted or label sampler,
+            all the patches of a volume are extracted at once by a
+            :class:`~radio.data.multi_patch_sampler.MultiPatchSampler`.
+        shared_memory: If ``True`` and :attr:`patch_storage` is
+            ``'tensor'``, the patches tensors are allocated in shared memory.
+        batch_size: If not ``None``, the queue yields ready-made batches of
+            ``batch_size`` patches per domain, gathered at once from its
+            storage, instead of single patches. Each item is a
+            ``{image_name: {DATA: tensor}, LOCATION: locations}`` dictionary,
+            or a tuple with one such dictionary per domain, laid out as the
+            default collate function would have collated single patches. The
+            :class:`~torch.utils.data.DataLoader` popping from the queue must
+            then use ``batch_size=None``.
+            Requires :attr:`patch_storage` to be ``'tensor'``.
+        decouple_domains: If ``True``, each domain has its own subjects
+            loader and is refilled independently when its patches run out,
+            so a volume of one domain is only loaded when that domain needs
+            patches. If ``False``, one subject of each domain is loaded and
+            sampled in lock-step. Datasets other than
+            :class:`~radio.data.unpaired_dataset.MRIUnpairedDataset` must
+            implement ``get_domain_dataset(domain)``, returning the dataset
+            of the subjects of a domain.
+        storage_dtype: If not ``None``, floating point patches are stored
+            compressed in this dtype, one of ``'float16'``, ``'bfloat16'`` or
+            ``'int16'`` (with a per-patch scale and offset), and decompressed
+            to ``float32`` when popped. Requires :attr:`patch_storage` to be
+            ``'tensor'``.
+        autoscaler: If not ``None``, :attr:`samples_per_volume` and
+            :attr:`max_length` are adjusted from the time to load a volume
+            and the time to consume a patch, measured after each fill, see
+            :class:`~radio.data.queue_autoscaler.QueueAutoscaler`. As the
+            number of patches per epoch depends on the samples per volume,
+            the new values are applied at the end of the epoch, once the
+            items of the sampler returned by :meth:`get_epoch_sampler`, or
+            ``len(queue)`` items without it, have been popped, or else when
+            the next epoch starts. The initial values are clipped to the
+            autoscaler bounds.
+        unordered_subjects: If ``True`` and :attr:`num_workers` is positive,
+            subjects are delivered to the queue as soon as a worker has
+            loaded them, instead of in the order drawn for the epoch, so a
+            slow subject does not hold back the ones already loaded. See
+            :class:`~radio.data.subjects_loader.UnorderedSubjectsLoader` and
+            :attr:`head_of_line_time`.
+        subjects_pool: If not ``None``, the subjects are loaded by the
+            workers of this :class:`~radio.data.subjects_loader.SubjectsPool`,
+            which can be shared with other queues, e.g., the train and
+            validation queues of a datamodule, instead of :attr:`num_workers`
+            workers of the queue. Subjects are then delivered as with
+            :attr:`unordered_subjects`. The datasets of the queue are
+            registered in the pool when the queue is created.
+        foreground_filter: If not ``None``, patches whose foreground fraction
+            is below the threshold of this
+            :class:`~radio.data.foreground_filter.ForegroundFilter` are
+            replaced by new draws before they are inserted in the queue. The
+            accepted and rejected counts are kept by the filter.
+        domains: Names of the domains of the items of
+            :attr:`subjects_dataset`. If ``None``, the ``domain_a`` and
+            ``domain_b`` attributes of the dataset are used if it has them,
+            else the dataset is assumed to have a single domain.
+        verbose: If ``True``, some debugging messages will be printed.
+
+    .. note:: :attr:`num_workers` refers to the number of workers used to
+        load and transform the volumes. Multiprocessing is not needed to pop
+        patches from the queue, so you should always use ``num_workers=0`` for
+        the :class:`~torch.utils.data.DataLoader` you instantiate to generate
+        training batches.
+
+    Example:
+
+    >>> import torch
+    >>> import torchio as tio
+    >>> from torch.utils.data import DataLoader
+    >>> patch_size = 96
+    >>> queue_length = 300
+    >>> samples_per_volume = 10
+    >>> sampler = tio.data.UniformSampler(patch_size)
+    >>> subject = tio.datasets.Colin27()
+    >>> subjects_dataset = tio.SubjectsDataset(10 * [subject])
+    >>> patches_queue = PatchQueue(
+    ...     subjects_dataset,
+    ...     queue_length,
+    ...     samples_per_volume,
+    ...     sampler,
+    ...     num_workers=4,
+    ... )
+    >>> patches_loader = DataLoader(
+    ...     patches_queue,
+    ...     batch_size=16,
+    ...     num_workers=0,  # this must be 0
+    ... )
+    >>> num_epochs = 2
+    >>> model = torch.nn.Identity()
+    >>> for epoch_index in range(num_epochs):
+    ...     for patches_batch in patches_loader:
+    ...         inputs = patches_batch['t1'][tio.DATA]
+    ...         targets = patches_batch['brain'][tio.DATA]
+    ...         logits = model(inputs)
+    """
+
+    def __init__(
+        self,
+        subjects_dataset: Dataset,
+        max_length: int,
+        samples_per_volume: int,
+        sampler: PatchSampler,
+        num_workers: int = 0,
+        shuffle_subjects: bool = True,
+        shuffle_patches: bool = True,
+        start_background: bool = True,
+        persistent_workers: bool = True,
+        double_buffer: bool = False,
+        patch_storage: str = 'list',
+        shared_memory: bool = False,
+        storage_dtype: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        decouple_domains: bool = False,
+        autoscaler: Optional[QueueAutoscaler] = None,
+        unordered_subjects: bool = False,
+        subjects_pool: Optional[SubjectsPool] = None,
+        foreground_filter: Optional[ForegroundFilter] = None,
+        domains: Optional[Sequence[str]] = None,
+        verbose: bool = False,
+    ):
+        if patch_storage not in PATCH_STORAGES:
+            raise ValueError(f'patch_storage must be one of {PATCH_STORAGES},'
+                             f' but "{patch_storage}" was passed.')
+        if storage_dtype is not None and patch_storage != 'tensor':
+            raise ValueError(
+                'storage_dtype requires patch_storage to be "tensor".')
+        if batch_size is not None and patch_storage != 'tensor':
+            raise ValueError(
+                'batch_size requires patch_storage to be "tensor".')
+        if batch_size is not None and batch_size > max_length:
+            raise ValueError('batch_size cannot be larger than max_length.')
+        self.subjects_dataset = subjects_dataset
+        self.max_length = max_length
+        self.shuffle_subjects = shuffle_subjects
+        self.shuffle_patches = shuffle_patches
+        self._samples_per_volume = samples_per_volume
+        self.sampler = sampler
+        self._multi_patch_sampler: Optional[MultiPatchSampler] = None
+        if patch_storage == 'tensor' and MultiPatchSampler.is_supported(
+                sampler):
+            self._multi_patch_sampler = MultiPatchSampler(sampler)
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        self.double_buffer = double_buffer
+        self.patch_storage = patch_storage
+        self.shared_memory = shared_memory
+        self.storage_dtype = storage_dtype
+        self.batch_size = batch_size
+        self.autoscaler = autoscaler
+        self.unordered_subjects = unordered_subjects
+        self.subjects_pool = subjects_pool
+        self.foreground_filter = foreground_filter
+        if autoscaler is not None:
+            autoscaler.start(samples_per_volume,
+                             max_length,
+                             background=double_buffer)
+            self._samples_per_volume = autoscaler.samples_per_volume
+            self.max_length = max(autoscaler.length, batch_size or 1)
+        self.verbose = verbose
+        self.domains: Tuple[str, ...] = (tuple(domains) if domains else
+                                         self._get_default_domains())
+        # Decoupling a single domain would only duplicate its loader
+        self.decouple_domains = decouple_domains and self.num_domains > 1
+        self._domain_datasets: Dict[int, Dataset] = {}
+        self._fill_stats = [self._new_fill_stats() for _ in self.domains]
+        self._num_samples: np.ndarray = self._get_num_samples()
+        self._total_num_samples = int(self._num_samples.sum())
+        self._subjects_loaders: Dict[str, SubjectsLoaderType] = {}
+        self._subject_samplers: Dict[str, SubjectSampler] = {}
+        self._past_head_of_line_time = 0.0
+        self._subjects_iterable = None
+        self._domain_iterables: List[Optional[Iterator]] = [
+            None for _ in self.domains
+        ]
+        if subjects_pool is not None:
+            # The workers of the pool only know the datasets registered before
+            # they start, which may happen before this queue loads a subject
+            if self.decouple_domains:
+                for domain in range(self.num_domains):
+                    subjects_pool.register(self._get_domain_dataset(domain))
+            else:
+                subjects_pool.register(subjects_dataset)
+        if start_background:
+            if self.decouple_domains:
+                for domain in range(self.num_domains):
+                    self._initialize_domain_iterable(domain)
+            else:
+                self._initialize_subjects_iterable()
+        self.patches: List[PatchStorage] = self._new_storages()
+        self.num_sampled_patches = 0
+        self.starvation_time = 0.0
+        # Consumption measurements since the last autoscaling
+        self._consume_time = 0.0
+        self._num_consumed = 0
+        self._last_pop_end: Optional[float] = None
+        # Items popped in the current epoch, and autoscaled values waiting
+        # for the next epoch
+        self._num_epoch_items = 0
+        self._epoch_length: Optional[int] = None
+        self._pending_autoscale: Optional[Tuple[int, int]] = None
+        self._autoscaled_stats = [dict(stats) for stats in self._fill_stats]
+        self._producer: Optional[threading.Thread] = None
+        self._ready_buffers: queue.Queue = queue.Queue(maxsize=1)
+        self._free_buffers: queue.Queue = queue.Queue(maxsize=1)
+
+    def __len__(self):
+        if self.batch_size is not None:
+            return math.ceil(self.iterations_per_epoch / self.batch_size)
+        return self.iterations_per_epoch
+
+    def __getitem__(self, _):
+        start = time.perf_counter()
+        if self._last_pop_end is not None:
+            self._consume_time += start - self._last_pop_end
+        if self._any_needs_fill():
+            self._print('Patches list is empty.')
+            # Loop as a fill may stop before the other domains have enough
+            # patches for a batch
+            while self._any_needs_fill():
+                if self.double_buffer:
+                    self._swap_buffers()
+                else:
+                    self._fill()
+            self.starvation_time += time.perf_counter() - start
+            if self.autoscaler is not None:
+                self._autoscale()
+        if self.batch_size is not None:
+            samples = [
+                cast(TensorPatchStorage, patches).pop_batch(self.batch_size)
+                for patches in self.patches
+            ]
+            num_patches = len(samples[0][LOCATION])
+        else:
+            samples = [patches.pop() for patches in self.patches]
+            num_patches = 1
+        self.num_sampled_patches += num_patches
+        self._num_consumed += num_patches
+        self._last_pop_end = time.perf_counter()
+        self._num_epoch_items += 1
+        epoch_length = self._epoch_length
+        if self._num_epoch_items >= (epoch_length or len(self)):
+            # The epoch is over, the loaders read the length of the next one
+            # when they are iterated again
+            self._num_epoch_items = 0
+            self._epoch_length = None
+            self.apply_autoscaling()
+        if self.num_domains == 1:
+            return samples[0]
+        return tuple(samples)
+
+    def _autoscale(self) -> None:
+        assert self.autoscaler is not None
+        load_times = []
+        for stats, previous in zip(self._fill_stats, self._autoscaled_stats):
+            num_subjects = stats['num_subjects'] - previous['num_subjects']
+            if num_subjects > 0:
+                fill_time = stats['fill_time'] - previous['fill_time']
+                load_times.append(fill_time / num_subjects)
+        if not load_times or not self._num_consumed:
+            return
+        # Lock-step fills time all the domains at once, while decoupled
+        # domains are each loaded once per samples_per_volume patches
+        if self.decouple_domains:
+            load_time = sum(load_times)
+        else:
+            load_time = max(load_times)
+        consume_time = self._consume_time / self._num_consumed
+        if self.autoscaler.update(load_time, consume_time):
+            self._print(f'Autoscaling: {self.autoscaler}')
+            # Changing the samples per volume now would change len(self) in
+            # the middle of the epoch
+            self._pending_autoscale = (self.autoscaler.samples_per_volume,
+                                       self.autoscaler.length)
+        self._autoscaled_stats = [dict(stats) for stats in self._fill_stats]
+        self._consume_time = 0.0
+        self._num_consumed = 0
+
+    def get_epoch_sampler(self, sampler: Optional[Sampler] = None) -> Sampler:
+        """Get a sampler starting a new epoch of the queue when iterated.
+
+        The epoch then ends once the items of ``sampler`` have been popped,
+        e.g., the subset of the queue drawn by a
+        :class:`~torch.utils.data.SubsetRandomSampler`, so that the values of
+        the autoscaler are only applied between epochs.
+
+        Args:
+            sampler: Sampler of the items of the queue. If ``None``, the
+                items are drawn in order.
+        """
+        return _EpochSampler(self, sampler or SequentialSampler(self))
+
+    def start_epoch(self, num_items: Optional[int] = None) -> None:
+        """Start a new epoch, applying the autoscaled values not applied yet.
+
+        Args:
+            num_items: Number of items popped in the epoch. If ``None``,
+                ``len(queue)`` items are popped.
+        """
+        self._num_epoch_items = 0
+        self._epoch_length = num_items
+        self.apply_autoscaling()
+
+    def apply_autoscaling(self) -> None:
+        """Apply the values last set by the autoscaler, if any.
+
+        It is called at the end of each epoch, when a new epoch starts, and
+        by :meth:`set_patch_size`.
+        """
+        if self._pending_autoscale is None:
+            return
+        samples_per_volume, length = self._pending_autoscale
+        self._pending_autoscale = None
+        self.max_length = max(length, self.batch_size or 1)
+        if samples_per_volume != self.samples_per_volume:
+            self.samples_per_volume = samples_per_volume
+
+    def _needs_fill(self, patches: PatchStorage) -> bool:
+        return len(patches) < (self.batch_size or 1)
+
+    def _any_needs_fill(self) -> bool:
+        return any(self._needs_fill(patches) for patches in self.patches)
+
+    def __repr__(self):
+        attributes = [
+            f'max_length={self.max_length}',
+            f'domains={self.domains}',
+            f'num_subjects={self.num_subjects}',
+            f'num_patches={self.num_patches}',
+            f'samples_per_volume={self.samples_per_volume}',
+            f'num_sampled_patches={self.num_sampled_patches}',
+            f'iterations_per_epoch={self.iterations_per_epoch}',
+            f'starvation_time={self.starvation_time:.2f}s',
+            f'head_of_line_time={self.head_of_line_time:.2f}s',
+        ]
+        if self.foreground_filter is not None:
+            attributes.append(f'foreground_filter={self.foreground_filter}')
+        attributes_string = ', '.join(attributes)
+        return f'{type(self).__name__}({attributes_string})'
+
+    def _print(self, *args):
+        if self.verbose:
+            print(*args)  # noqa: T201
+
+    @property
+    def num_domains(self) -> int:
+        return len(self.domains)
+
+    def _get_default_domains(self) -> Tuple[str, ...]:
+        dataset = self.subjects_dataset
+        if hasattr(dataset, 'domain_a') and hasattr(dataset, 'domain_b'):
+            return (dataset.domain_a, dataset.domain_b)  # type: ignore
+        return (DEFAULT_DOMAIN, )
+
+    def _get_domain_dataset(self, domain: int) -> Dataset:
+        if self.num_domains == 1:
+            return self.subjects_dataset
+        if domain not in self._domain_datasets:
+            name = self.domains[domain]
+            dataset = self.subjects_dataset
+            if hasattr(dataset, 'get_domain_dataset'):
+                domain_dataset = dataset.get_domain_dataset(name)
+            else:
+                domain_dataset = UnpairedDomainDataset(
+                    cast(Any, dataset), name)
+            self._domain_datasets[domain] = domain_dataset
+        return self._domain_datasets[domain]
+
+    def _initialize_subjects_iterable(self):
+        self._subjects_iterable = self._get_subjects_iterable()
+
+    @property
+    def subjects_iterable(self):
+        if self._subjects_iterable is None:
+            self._initialize_subjects_iterable()
+        return self._subjects_iterable
+
+    def _initialize_domain_iterable(self, domain: int) -> None:
+        name = self.domains[domain]
+        loaders = self._subjects_loaders
+        if not self.persistent_workers or name not in loaders:
+            dataset = self._get_domain_dataset(domain)
+            self._subjects_loaders[name] = self._get_subjects_loader(
+                dataset, name)
+        self._domain_iterables[domain] = iter(self._subjects_loaders[name])
+
+    def _get_subject_sampler(self, key: str) -> SubjectSampler:
+        # Samplers outlive the loaders, so the subjects order and the
+        # position in the epoch are kept if a loader is created again
+        if key not in self._subject_samplers:
+            self._subject_samplers[key] = SubjectSampler(
+                self._get_num_subjects(key), shuffle=self.shuffle_subjects)
+        return self._subject_samplers[key]
+
+    def _get_num_subjects(self, key: str) -> int:
+        if key == SUBJECTS:
+            return len(cast(Any, self.subjects_dataset))
+        domain = self.domains.index(key)
+        return len(cast(Any, self._get_domain_dataset(domain)))
+
+    def state_dict(self, include_patches: bool = False) -> Dict[str, Any]:
+        """Get the state of the queue, to resume it from a checkpoint.
+
+        The state holds the subjects order, the position in the epoch and the
+        generator state of each subjects loader, and, optionally, the queued
+        patches. Patches of a buffer being filled in the background are not
+        included.
+
+        Args:
+            include_patches: If ``True``, include the queued patches, so that
+                they do not have to be sampled again.
+        """
+        state: Dict[str, Any] = {
+            'samplers': {
+                key: sampler.state_dict()
+                for key, sampler in self._subject_samplers.items()
+            },
+            'num_sampled_patches': self.num_sampled_patches,
+        }
+        if include_patches:
+            state['patches'] = [
+                patches.state_dict() for patches in self.patches
+            ]
+        return state
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restore a state returned by :meth:`state_dict`.
+
+        This should be called before patches are popped from the queue.
+
+        Args:
+            state_dict: State of a queue.
+        """
+        for key, sampler_state in state_dict['samplers'].items():
+            self._get_subject_sampler(key).load_state_dict(sampler_state)
+        self.num_sampled_patches = state_dict['num_sampled_patches']
+        if 'patches' in state_dict:
+            for patches, patches_state in zip(self.patches,
+                                              state_dict['patches']):
+                patches.load_state_dict(patches_state)
+        # Iterate again over the loaders to resume from the restored position
+        self._subjects_iterable = None
+        self._domain_iterables = [None for _ in self.domains]
+
+    @property
+    def head_of_line_time(self) -> float:
+        """Time in seconds that loaded subjects would have waited behind
+        slower subjects with ordered delivery, saved by
+        :attr:`unordered_subjects`."""
+        return self._past_head_of_line_time + sum(
+            loader.head_of_line_time
+            for loader in self._subjects_loaders.values()
+            if isinstance(loader, UnorderedSubjectsLoader))
+
+    @property
+    def fill_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Fill statistics of each domain.
+
+        For each domain name: number of fills, number of subjects loaded,
+        number of patches queued, number of patches discarded because the
+        queue was full, and total time spent in fills in seconds.
+        """
+        return {
+            name: dict(stats)
+            for name, stats in zip(self.domains, self._fill_stats)
+        }
+
+    @staticmethod
+    def _new_fill_stats() -> Dict[str, Any]:
+        return {
+            'num_fills': 0,
+            'num_subjects': 0,
+            'num_patches': 0,
+            'num_discarded_patches': 0,
+            'fill_time': 0.0,
+        }
+
+    def _update_fill_stats(self, domain: int, num_requested: int,
+                           num_patches: int) -> None:
+        stats = self._fill_stats[domain]
+        stats['num_subjects'] += 1
+        stats['num_patches'] += num_patches
+        stats['num_discarded_patches'] += num_requested - num_patches
+
+    @property
+    def num_subjects(self) -> int:
+        return len(cast(Any, self.subjects_dataset))
+
+    @property
+    def num_patches(self) -> Union[int, Tuple[int, ...]]:
+        """Number of queued patches, per domain if there are several."""
+        if self.num_domains == 1:
+            return len(self.patches[0])
+        return tuple(len(patches) for patches in self.patches)
+
+    @property
+    def samples_per_volume(self) -> int:
+        return self._samples_per_volume
+
+    @samples_per_volume.setter
+    def samples_per_volume(self, samples_per_volume: int) -> None:
+        self._samples_per_volume = samples_per_volume
+        self.reset_num_samples()
+
+    def set_patch_size(self,
+                       patch_size: SpatialShapeType,
+                       samples_per_volume: Optional[int] = None) -> None:
+        """Change the size of the patches, e.g., between epochs.
+
+        The queued patches are discarded, and the queue is filled again with
+        patches of the new size. With :attr:`double_buffer`, the fill in
+        progress is awaited and discarded too. The subjects loaders and their
+        workers are kept, so the subjects already loaded are sampled with the
+        new patch size.
+
+        Args:
+            patch_size: New size of the patches.
+            samples_per_volume: If not ``None``, new default number of patches
+                extracted from each volume.
+        """
+        sampler = resize_sampler(self.sampler, patch_size)
+        if self._producer is not None:
+            # The producer fills a set of buffers at any time, wait for it to
+            # be done with the old sampler
+            buffers = self._ready_buffers.get()
+            if isinstance(buffers, Exception):
+                self._producer = None
+                raise buffers
+        self.sampler = sampler
+        if self._multi_patch_sampler is not None:
+            self._multi_patch_sampler = MultiPatchSampler(sampler)
+        # A new epoch starts with the new patch size
+        self.start_epoch()
+        if samples_per_volume is not None:
+            if self.autoscaler is not None:
+                # Scaling goes on from the new value
+                self.autoscaler.start(samples_per_volume,
+                                      self.max_length,
+                                      background=self.double_buffer)
+                samples_per_volume = self.autoscaler.samples_per_volume
+            self.samples_per_volume = samples_per_volume
+        self.patches = self._new_storages()
+        if self._producer is not None:
+            self._free_buffers.put(self._new_storages())
+
+    @property
+    def iterations_per_epoch(self) -> int:
+        # The subjects list may live in a manager process, only go through it
+        # again if the number of subjects changed
+        if len(self._num_samples) != self._get_num_epoch_subjects():
+            self.reset_num_samples()
+        return self._total_num_samples
+
+    def reset_num_samples(self) -> None:
+        """Recompute the number of patches extracted per subject.
+
+        The number of patches per epoch is cached when the queue is created.
+        This method should be called if the subjects of the dataset change.
+        """
+        self._num_samples = self._get_num_samples()
+        self._total_num_samples = int(self._num_samples.sum())
+
+    def _get_num_epoch_subjects(self) -> int:
+        # An epoch goes through the subjects of the first domain
+        dataset = self.subjects_dataset
+        if hasattr(dataset, 'size_a'):
+            return dataset.size_a  # type: ignore
+        return len(cast(Any, dataset))
+
+    def _get_epoch_subjects(self) -> Sequence[Any]:
+        dataset = cast(Any, self.subjects_dataset)
+        if hasattr(dataset, 'dry_iter_a'):
+            # A single slice of the list proxy is one round trip to the
+            # manager
+            return [subject for subject, _ in dataset.dry_iter_a()[:]]
+        if hasattr(dataset, 'dry_iter'):
+            subjects = list(dataset.dry_iter())
+            if self.num_domains > 1:
+                subjects = [domain_subjects[0] for domain_subjects in subjects]
+            return subjects
+        # Without a dry iterator, the default samples_per_volume is used
+        return [None] * len(dataset)
+
+    def _get_num_samples(self) -> np.ndarray:
+        num_samples = [
+            self._get_subject_num_samples(subject)
+            for subject in self._get_epoch_subjects()
+        ]
+        return np.array(num_samples, dtype=np.int64)
+
+    def _get_subject_num_samples(self, subject):
+        num_samples = getattr(
+            subject,
+            NUM_SAMPLES,
+            self.samples_per_volume,
+        )
+        return num_samples
+
+    def _new_storage(self) -> PatchStorage:
+        if self.patch_storage == 'tensor':
+            return TensorPatchStorage(self.max_length,
+                                      shared_memory=self.shared_memory,
+                                      dtype=self.storage_dtype)
+        return ListPatchStorage(self.max_length)
+
+    def _new_storages(self) -> List[PatchStorage]:
+        return [self._new_storage() for _ in self.domains]
+
+    def _fill(self) -> None:
+        self._fill_buffers(self.patches)
+
+    def _fill_buffers(self, buffers: Sequence[PatchStorage]) -> None:
+        # Apply the length set by the autoscaler to the buffers being filled
+        for patches in buffers:
+            if patches.max_length != self.max_length:
+                patches.resize(self.max_length)
+        if not self.decouple_domains:
+            start = time.perf_counter()
+            self._sample_patches(buffers)
+            elapsed = time.perf_counter() - start
+            for stats in self._fill_stats:
+                stats['num_fills'] += 1
+                stats['fill_time'] += elapsed
+            return
+        # Only the domains that ran out of patches are refilled
+        for domain, patches in enumerate(buffers):
+            if self._needs_fill(patches):
+                start = time.perf_counter()
+                self._sample_domain_patches(domain, patches)
+                stats = self._fill_stats[domain]
+                stats['num_fills'] += 1
+                stats['fill_time'] += time.perf_counter() - start
+
+    def _sample_domain_patches(self, domain: int,
+                               patches: PatchStorage) -> None:
+        assert self.sampler is not None
+
+        num_domain_subjects = self._get_num_subjects(self.domains[domain])
+        num_subjects = 0
+        while True:
+            subject = self._get_next_domain_subject(domain)
+            num_requested = self._get_subject_num_samples(subject)
+            num_samples = min(num_requested, patches.num_free_slots)
+            self._extract_patches(subject, num_samples, patches)
+            self._update_fill_stats(domain, num_requested, num_samples)
+            num_subjects += 1
+            if patches.is_full or num_subjects >= num_domain_subjects:
+                break
+
+        if self.shuffle_patches:
+            patches.shuffle()
+
+    def _sample_patches(self, buffers: Sequence[PatchStorage]) -> None:
+        assert self.sampler is not None
+
+        num_subjects = 0
+        while True:
+            subjects = self._get_next_subject()
+            for domain, (subject,
+                         patches) in enumerate(zip(subjects, buffers)):
+                num_requested = self._get_subject_num_samples(subject)
+                num_samples = min(num_requested, patches.num_free_slots)
+                self._extract_patches(subject, num_samples, patches)
+                self._update_fill_stats(domain, num_requested, num_samples)
+            num_subjects += 1
+            any_full = any(patches.is_full for patches in buffers)
+            all_subjects_sampled = num_subjects >= self.num_subjects
+            if any_full or all_subjects_sampled:
+                break
+
+        if self.shuffle_patches:
+            for patches in buffers:
+                patches.shuffle()
+
+    def _extract_patches(self, subject: Subject, num_samples: int,
+                         patches: PatchStorage) -> None:
+        assert self.sampler is not None
+        if num_samples <= 0:
+            return
+        foreground_filter = self.foreground_filter
+        multi_patch_sampler = self._multi_patch_sampler
+        if multi_patch_sampler is not None and foreground_filter is not None:
+            locations = foreground_filter.filter_locations(
+                subject, num_samples, multi_patch_sampler.get_locations)
+            patches.extend_batch(
+                multi_patch_sampler.extract_patches(subject, locations))
+        elif multi_patch_sampler is not None:
+            patches.extend_batch(multi_patch_sampler(subject, num_samples))
+        elif foreground_filter is not None:
+            patches.extend(
+                foreground_filter.filter_patches(subject, num_samples,
+                                                 self.sampler(subject)))
+        else:
+            patches.extend(list(islice(self.sampler(subject), num_samples)))
+
+    def _start_producer(self) -> None:
+        self._print('Starting background producer')
+        self._free_buffers.put(self._new_storages())
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+
+    def _produce(self) -> None:
+        # Runs in the producer thread, which is the only one touching the
+        # subjects iterable while the queue is double buffered. It blocks
+        # until the consumer hands back its emptied buffers, so that only two
+        # sets of buffers are ever allocated
+        while True:
+            buffers = self._free_buffers.get()
+            try:
+                self._fill_buffers(buffers)
+            except Exception as exception:  # pylint: disable=broad-except
+                self._ready_buffers.put(exception)
+                return
+            self._ready_buffers.put(buffers)
+
+    def _swap_buffers(self) -> None:
+        if self._producer is None:
+            self._start_producer()
+        buffers = self._ready_buffers.get()
+        if isinstance(buffers, Exception):
+            self._producer = None
+            raise buffers
+        # Patches left in the current buffers are popped first, if there is
+        # room for them in the new ones
+        for patches, leftovers in zip(buffers, self.patches):
+            patches.merge(leftovers)
+        self._free_buffers.put(self.patches)
+        self.patches = buffers
+
+    def _as_domain_subjects(self, item: Any) -> Tuple[Subject, ...]:
+        if self.num_domains == 1:
+            return (item, )
+        return tuple(item)
+
+    def _get_next_subject(self) -> Tuple[Subject, ...]:
+        # A StopIteration exception is expected when the queue is empty
+        try:
+            item = next(self.subjects_iterable)
+        except StopIteration as exception:
+            self._print('Queue is empty:', exception)
+            self._initialize_subjects_iterable()
+            item = next(self.subjects_iterable)
+        except AssertionError as exception:
+            if 'can only test a child process' in str(exception):
+                message = (
+                    'The number of workers for the data loader used to pop'
+                    ' patches from the queue should be 0. Is it?')
+                raise RuntimeError(message) from exception
+            raise exception
+        self._advance_subject_sampler(SUBJECTS)
+        return self._as_domain_subjects(item)
+
+    def _get_next_domain_subject(self, domain: int) -> Subject:
+        if self._domain_iterables[domain] is None:
+            self._initialize_domain_iterable(domain)
+        try:
+            subject = next(self._domain_iterables[domain])
+        except StopIteration as exception:
+            self._print(f'Domain {self.domains[domain]} is empty:',
+                        exception)
+            self._initialize_domain_iterable(domain)
+            subject = next(self._domain_iterables[domain])
+        self._advance_subject_sampler(self.domains[domain])
+        return subject
+
+    def _advance_subject_sampler(self, key: str) -> None:
+        # Unordered loaders deliver subjects out of the sampler order, so they
+        # report the position of the subject delivered
+        loader = self._subjects_loaders.get(key)
+        sampler = self._get_subject_sampler(key)
+        if (isinstance(loader, UnorderedSubjectsLoader)
+                and loader.last_position is not None):
+            sampler.consume(loader.last_position)
+        else:
+            sampler.advance()
+
+    @staticmethod
+    def _get_first_item(batch):
+        return batch[0]
+
+    def _get_subjects_iterable(self) -> Iterator:
+        # With persistent workers, iterating again over the same loader
+        # reuses its worker processes and draws a new subjects order
+        loaders = self._subjects_loaders
+        if not self.persistent_workers or SUBJECTS not in loaders:
+            self._subjects_loaders[SUBJECTS] = self._get_subjects_loader(
+                self.subjects_dataset, SUBJECTS)
+        return iter(self._subjects_loaders[SUBJECTS])
+
+    def _get_subjects_loader(self, dataset: Dataset,
+                             key: str) -> SubjectsLoaderType:
+        self._print(
+            f'\nCreating subjects loader with {self.num_workers} workers', )
+        previous = self._subjects_loaders.get(key)
+        if isinstance(previous, UnorderedSubjectsLoader):
+            self._past_head_of_line_time += previous.head_of_line_time
+        if self.subjects_pool is not None:
+            return UnorderedSubjectsLoader(
+                dataset,
+                self._get_subject_sampler(key),
+                self.subjects_pool.num_workers,
+                pool=self.subjects_pool)
+        if self.unordered_subjects and self.num_workers > 0:
+            return UnorderedSubjectsLoader(
+                dataset,
+                self._get_subject_sampler(key),
+                self.num_workers,
+                persistent_workers=self.persistent_workers)
+        # I need a DataLoader to handle parallelism
+        # But this loader is always expected to yield single subject samples
+        subjects_loader: DataLoader = DataLoader(
+            dataset,
+            num_workers=self.num_workers,
+            batch_size=1,
+            collate_fn=self._get_first_item,
+            sampler=self._get_subject_sampler(key),
+            persistent_workers=self.persistent_workers
+            and self.num_workers > 0,
+        )
+        return subjects_loader
+
+    def get_max_memory(self, subject: Optional[Any] = None) -> int:
+        """Get the maximum RAM occupied by the patches queue in bytes.
+
+        Args:
+            subject: Sample subject, or tuple with one subject per domain, to
+                compute the size of a patch.
+        """
+        if subject is None:
+            subject = cast(Any, self.subjects_dataset)[0]
+        bytes_per_patch = sum(
+            self._get_bytes_per_patch(domain_subject)
+            for domain_subject in self._as_domain_subjects(subject))
+        num_buffers = 2 if self.double_buffer else 1
+        return int(num_buffers * bytes_per_patch * self.max_length)
+
+    def _get_bytes_per_patch(self, subject: Subject) -> int:
+        num_voxels = int(self.sampler.patch_size.prod())
+        num_bytes = 0
+        for image in subject.get_images(intensity_only=False):
+            if self.patch_storage == 'tensor':
+                num_bytes += TensorPatchStorage.get_image_nbytes(
+                    len(image.data),
+                    num_voxels,
+                    image.data.dtype,
+                    dtype=self.storage_dtype,
+                )
+            else:
+                num_bytes += (len(image.data) * num_voxels *
+                              image.data.element_size())
+        if self.patch_storage == 'tensor':
+            num_bytes += 6 * 8  # int64 location of each patch
+        return num_bytes
+
+    def get_max_memory_pretty(self, subject: Optional[Any] = None) -> str:
+        """Get human-readable maximum RAM occupied by the patches queue.
+
+        Args:
+            subject: Sample subject, or tuple with one subject per domain, to
+                compute the size of a patch.
+        """
+        memory = self.get_max_memory(subject=subject)
+        return humanize.naturalsize(memory, binary=True)
+
+
+class _EpochSampler(Sampler):
+    """Sampler starting a new epoch of a queue each time it is iterated."""
+
+    def __init__(self, queue: PatchQueue, sampler: Sampler) -> None:
+        # pylint: disable=super-init-not-called
+        self.queue = queue
+        self.sampler = sampler
+
+    def __len__(self) -> int:
+        return len(self.sampler)  # type: ignore
+
+    def __iter__(self) -> Iterator[int]:
+        # Values left by an epoch that was not completed are applied before
+        # the length of the sampler is read
+        self.queue.apply_autoscaling()
+        self.queue.start_epoch(len(self))
+        return iter(self.sampler)
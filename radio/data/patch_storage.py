@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Storage backends for the patches held by a patches queue.
+"""
+
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple, Union
+
+import torch
+from torchio import Subject, DATA, LOCATION
+
+__all__ = [
+    "PatchStorage", "ListPatchStorage", "TensorPatchStorage", "STORAGE_DTYPES"
+]
+
+PatchType = Union[Subject, Mapping[str, Any]]
+
+#: Dtypes in which floating point patches can be compressed.
+STORAGE_DTYPES = {
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int16': torch.int16,
+}
+INT16_MIN = -2**15
+INT16_LEVELS = 2**16 - 1
+
+
+class PatchStorage(metaclass=ABCMeta):
+    """
+    Fixed capacity buffer of patches.
+
+    Patches are appended until the storage is full and popped from its end,
+    like a Python list.
+
+    Parameters
+    ----------
+    max_length : int
+        Maximum number of patches that can be stored.
+    """
+
+    def __init__(self, max_length: int) -> None:
+        self.max_length = max_length
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of patches currently stored."""
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    @property
+    def num_free_slots(self) -> int:
+        """Number of patches that can still be appended."""
+        return max(self.max_length - len(self), 0)
+
+    @property
+    def is_full(self) -> bool:
+        """Whether the storage has no free slots left."""
+        return len(self) >= self.max_length
+
+    @abstractmethod
+    def append(self, patch: PatchType) -> None:
+        """Append a patch to the end of the storage."""
+
+    def extend(self, patches: List[PatchType]) -> None:
+        """Append a list of patches to the end of the storage."""
+        for patch in patches:
+            self.append(patch)
+
+    def extend_batch(self, batch: Mapping[str, Any]) -> None:
+        """
+        Append stacked patches to the end of the storage.
+
+        Parameters
+        ----------
+        batch : Mapping[str, Any]
+            ``{image_name: {DATA: tensor}, LOCATION: locations}`` dictionary
+            where the first dimension of each tensor is the patch dimension,
+            as returned by
+            :class:`~radio.data.multi_patch_sampler.MultiPatchSampler`.
+        """
+        for index in range(len(batch[LOCATION])):
+            patch: Dict[str, Any] = {
+                name: {
+                    DATA: value[DATA][index]
+                }
+                for name, value in batch.items() if name != LOCATION
+            }
+            patch[LOCATION] = batch[LOCATION][index]
+            self.append(patch)
+
+    @abstractmethod
+    def pop(self) -> Any:
+        """Remove and return the last patch of the storage."""
+
+    @abstractmethod
+    def shuffle(self) -> None:
+        """Randomly permute the stored patches."""
+
+    @abstractmethod
+    def truncate(self, length: int) -> None:
+        """Keep only the first ``length`` patches."""
+
+    @abstractmethod
+    def state_dict(self) -> Dict[str, Any]:
+        """Get the stored patches."""
+
+    @abstractmethod
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Replace the stored patches by the ones of ``state_dict``."""
+
+    def merge(self, leftovers: 'PatchStorage') -> None:
+        """
+        Move the patches of ``leftovers`` to the free slots at the end of this
+        storage, so that they are popped first. The patches of this storage,
+        usually a fresh fill, are all kept, and the leftovers that do not fit
+        are dropped, as they come from older volumes. ``leftovers`` is empty
+        afterwards.
+        """
+        while leftovers and not self.is_full:
+            self.append(leftovers.pop())
+        leftovers.truncate(0)
+
+    def resize(self, max_length: int) -> None:
+        """
+        Change the capacity of the storage, dropping the last patches if
+        they do not fit anymore.
+        """
+        self.truncate(max_length)
+        self.max_length = max_length
+
+
+class ListPatchStorage(PatchStorage):
+    """
+    Storage that keeps patches as a list of :class:`torchio.Subject`.
+    """
+
+    def __init__(self, max_length: int) -> None:
+        super().__init__(max_length)
+        self.patches: List[PatchType] = []
+
+    def __len__(self) -> int:
+        return len(self.patches)
+
+    def append(self, patch: PatchType) -> None:
+        self.patches.append(patch)
+
+    def extend(self, patches: List[PatchType]) -> None:
+        self.patches.extend(patches)
+
+    def pop(self) -> PatchType:
+        return self.patches.pop()
+
+    def shuffle(self) -> None:
+        indices = torch.randperm(len(self.patches))
+        self.patches = [self.patches[i] for i in indices]
+
+    def truncate(self, length: int) -> None:
+        del self.patches[max(length, 0):]
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {'patches': list(self.patches)}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.patches = list(state_dict['patches'])[:self.max_length]
+
+
+class TensorPatchStorage(PatchStorage):
+    """
+    Storage that keeps patches in one preallocated contiguous tensor per
+    image, shaped ``(max_length, C, W, H, D)``, plus a ``(max_length, 6)``
+    tensor with the patches locations.
+
+    Slots are addressed through a permutation of indices, so shuffling and
+    popping never move patch data. The tensors are allocated when the first
+    patch is appended.
+
+    Popped patches are returned as ``{image_name: {DATA: tensor}, LOCATION:
+    location}`` dictionaries, which are collated by the default
+    :class:`~torch.utils.data.DataLoader` collate function as a
+    :class:`torchio.Subject` would. The tensors are copies of the slots, as
+    slots are reused by the following fills.
+
+    Floating point images can be stored compressed as ``float16``,
+    ``bfloat16``, or as ``int16`` with a per-patch and per-channel scale and
+    offset. They are decompressed to ``float32`` when popped. Non floating
+    point images, e.g., label maps, are stored as they are.
+
+    Parameters
+    ----------
+    max_length : int
+        Maximum number of patches that can be stored.
+    shared_memory : bool, optional
+        If ``True``, allocate the patches tensors in shared memory.
+        Default = ``False``.
+    dtype : str, optional
+        Storage dtype of floating point images, one of ``'float16'``,
+        ``'bfloat16'`` or ``'int16'``. If ``None``, patches are stored
+        uncompressed. Default = ``None``.
+    """
+
+    def __init__(self,
+                 max_length: int,
+                 shared_memory: bool = False,
+                 dtype: Optional[str] = None) -> None:
+        super().__init__(max_length)
+        if dtype is not None and dtype not in STORAGE_DTYPES:
+            raise ValueError(f'dtype must be one of {tuple(STORAGE_DTYPES)},'
+                             f' but "{dtype}" was passed.')
+        self.shared_memory = shared_memory
+        self.dtype = dtype
+        self.data: Dict[str, torch.Tensor] = {}
+        self.scales: Dict[str, torch.Tensor] = {}
+        self.offsets: Dict[str, torch.Tensor] = {}
+        self.compressed: Set[str] = set()
+        self.locations: Optional[torch.Tensor] = None
+        self._order = torch.arange(max_length)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes allocated by the storage."""
+        tensors = list(self.data.values())
+        tensors.extend(self.scales.values())
+        tensors.extend(self.offsets.values())
+        if self.locations is not None:
+            tensors.append(self.locations)
+        return sum(t.element_size() * t.nelement() for t in tensors)
+
+    @staticmethod
+    def get_image_nbytes(num_channels: int,
+                         num_voxels: int,
+                         image_dtype: torch.dtype,
+                         dtype: Optional[str] = None) -> int:
+        """
+        Bytes needed to store the patch of an image in a slot.
+
+        Parameters
+        ----------
+        num_channels : int
+            Number of channels of the image.
+        num_voxels : int
+            Number of voxels in a patch.
+        image_dtype : torch.dtype
+            Dtype of the image data.
+        dtype : str, optional
+            Storage dtype, as in :class:`TensorPatchStorage`.
+            Default = ``None``.
+        """
+        compress = dtype is not None and image_dtype.is_floating_point
+        storage_dtype = STORAGE_DTYPES[dtype] if compress else image_dtype
+        element_size = torch.empty(0, dtype=storage_dtype).element_size()
+        num_bytes = num_channels * num_voxels * element_size
+        if compress and dtype == 'int16':
+            num_bytes += 2 * 4 * num_channels  # float32 scale and offset
+        return num_bytes
+
+    @staticmethod
+    def _unpack(
+            patch: PatchType) -> Tuple[Dict[str, torch.Tensor], torch.Tensor]:
+        if isinstance(patch, Subject):
+            images = patch.get_images_dict(intensity_only=False)
+            data = {name: image.data for name, image in images.items()}
+        else:
+            data = {
+                name: value[DATA]
+                for name, value in patch.items() if name != LOCATION
+            }
+        return data, torch.as_tensor(patch[LOCATION])
+
+    def _allocate(self, data: Dict[str, torch.Tensor]) -> None:
+        for name, tensor in data.items():
+            compress = self.dtype is not None and tensor.is_floating_point()
+            dtype = STORAGE_DTYPES[self.dtype] if compress else tensor.dtype
+            if compress:
+                self.compressed.add(name)
+            self.data[name] = torch.empty((self.max_length, *tensor.shape),
+                                          dtype=dtype)
+            if compress and self.dtype == 'int16':
+                num_channels = tensor.shape[0]
+                self.scales[name] = torch.empty(
+                    (self.max_length, num_channels))
+                self.offsets[name] = torch.empty(
+                    (self.max_length, num_channels))
+        self.locations = torch.empty((self.max_length, 6), dtype=torch.long)
+        if self.shared_memory:
+            for buffer in self.data.values():
+                buffer.share_memory_()
+            for buffer in self.scales.values():
+                buffer.share_memory_()
+            for buffer in self.offsets.values():
+                buffer.share_memory_()
+            self.locations.share_memory_()
+
+    def _write(self, name: str, slots: torch.Tensor,
+               tensors: torch.Tensor) -> None:
+        # tensors holds one patch per slot along its first dimension
+        if name not in self.scales:
+            self.data[name].index_copy_(0, slots,
+                                        tensors.to(self.data[name].dtype))
+            return
+        # Map each channel range to the int16 range
+        flat = tensors.flatten(2).float()
+        offset = flat.min(dim=2).values
+        scale = (flat.max(dim=2).values - offset) / INT16_LEVELS
+        scale[scale == 0] = 1
+        view_shape = tensors.shape[:2] + (1, ) * (tensors.dim() - 2)
+        quantized = torch.round(
+            (tensors - offset.view(view_shape)) / scale.view(view_shape))
+        quantized = (quantized + INT16_MIN).clamp_(INT16_MIN, -INT16_MIN - 1)
+        self.data[name].index_copy_(0, slots, quantized.to(torch.int16))
+        self.scales[name].index_copy_(0, slots, scale)
+        self.offsets[name].index_copy_(0, slots, offset)
+
+    def _read(self, name: str, slots: torch.Tensor) -> torch.Tensor:
+        # index_select gathers all the slots at once into a new tensor
+        buffer = self.data[name].index_select(0, slots)
+        if name in self.scales:
+            view_shape = buffer.shape[:2] + (1, ) * (buffer.dim() - 2)
+            scale = self.scales[name].index_select(0, slots).view(view_shape)
+            offset = self.offsets[name].index_select(0,
+                                                     slots).view(view_shape)
+            return (buffer.float() - INT16_MIN) * scale + offset
+        if name in self.compressed:
+            return buffer.float()
+        return buffer
+
+    def append(self, patch: PatchType) -> None:
+        if self.is_full:
+            raise IndexError('append to a full patch storage')
+        data, location = self._unpack(patch)
+        if self.locations is None:
+            self._allocate(data)
+        slots = self._order[self._size:self._size + 1]
+        for name, tensor in data.items():
+            self._write(name, slots, tensor.unsqueeze(0))
+        self.locations[slots] = location.long()
+        self._size += 1
+
+    def extend_batch(self, batch: Mapping[str, Any]) -> None:
+        num_patches = len(batch[LOCATION])
+        if num_patches > self.num_free_slots:
+            raise IndexError('extend a patch storage beyond its capacity')
+        data = {
+            name: value[DATA]
+            for name, value in batch.items() if name != LOCATION
+        }
+        if self.locations is None:
+            self._allocate({name: tensor[0] for name, tensor in data.items()})
+        assert self.locations is not None
+        slots = self._order[self._size:self._size + num_patches]
+        for name, tensors in data.items():
+            self._write(name, slots, tensors)
+        locations = torch.as_tensor(batch[LOCATION], dtype=torch.long)
+        self.locations.index_copy_(0, slots, locations)
+        self._size += num_patches
+
+    def pop(self) -> Dict[str, Any]:
+        if not self._size:
+            raise IndexError('pop from an empty patch storage')
+        batch = self.pop_batch(1)
+        patch: Dict[str, Any] = {
+            name: {
+                DATA: batch[name][DATA][0]
+            }
+            for name in self.data
+        }
+        patch[LOCATION] = batch[LOCATION][0]
+        return patch
+
+    def pop_batch(self, batch_size: int) -> Dict[str, Any]:
+        """
+        Remove the last ``batch_size`` patches of the storage and return them
+        stacked, as the default collate function would have stacked the
+        patches returned by ``batch_size`` calls to :meth:`pop`.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of patches to pop. Fewer patches are returned if the
+            storage holds less than ``batch_size`` patches.
+
+        Returns
+        -------
+        batch : Dict[str, Any]
+            ``{image_name: {DATA: tensor}, LOCATION: locations}`` dictionary
+            where the first dimension of each tensor is the batch dimension.
+        """
+        if self.locations is None:
+            raise IndexError('pop from an empty patch storage')
+        start = max(self._size - batch_size, 0)
+        # Same order as successive calls to pop()
+        slots = self._order[start:self._size].flip(0)
+        self._size = start
+        batch: Dict[str, Any] = {
+            name: {
+                DATA: self._read(name, slots)
+            }
+            for name in self.data
+        }
+        batch[LOCATION] = self.locations.index_select(0, slots)
+        return batch
+
+    def shuffle(self) -> None:
+        permutation = torch.randperm(self._size)
+        self._order[:self._size] = self._order[:self._size][permutation]
+
+    def truncate(self, length: int) -> None:
+        self._size = min(self._size, max(length, 0))
+
+    def resize(self, max_length: int) -> None:
+        if self.locations is None:
+            self.max_length = max_length
+            self._order = torch.arange(max_length)
+        elif max_length > len(self._order):
+            # Grow the buffers, keeping the stored patches
+            state = self.state_dict()
+            self.max_length = max_length
+            self.load_state_dict(state)
+        else:
+            # Keep the allocated buffers to avoid reallocating them when the
+            # storage grows again
+            super().resize(max_length)
+
+    def state_dict(self) -> Dict[str, Any]:
+        slots = self._order[:self._size]
+
+        def _select(buffers: Dict[str, torch.Tensor]) -> Dict[str, Any]:
+            return {
+                name: buffer.index_select(0, slots)
+                for name, buffer in buffers.items()
+            }
+
+        locations = (None if self.locations is None else
+                     self.locations.index_select(0, slots))
+        return {
+            'data': _select(self.data),
+            'scales': _select(self.scales),
+            'offsets': _select(self.offsets),
+            'compressed': sorted(self.compressed),
+            'locations': locations,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self.data, self.scales, self.offsets = {}, {}, {}
+        self.compressed = set(state_dict['compressed'])
+        self.locations = None
+        self._order = torch.arange(self.max_length)
+        self._size = 0
+        if state_dict['locations'] is None:
+            return
+        num_patches = min(len(state_dict['locations']), self.max_length)
+
+        def _restore(tensor: torch.Tensor) -> torch.Tensor:
+            buffer = torch.empty((self.max_length, *tensor.shape[1:]),
+                                 dtype=tensor.dtype)
+            buffer[:num_patches] = tensor[:num_patches]
+            if self.shared_memory:
+                buffer.share_memory_()
+            return buffer
+
+        for key, buffers in (('data', self.data), ('scales', self.scales),
+                             ('offsets', self.offsets)):
+            for name, tensor in state_dict[key].items():
+                buffers[name] = _restore(tensor)
+        self.locations = _restore(state_dict['locations'])
+        self._size = num_patches
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Online tuning of the number of samples per volume and the length of patches
+queues.
+"""
+
+import math
+from typing import Any, Dict, List, Optional
+
+__all__ = ["QueueAutoscaler"]
+
+
+class QueueAutoscaler:
+    """
+    Adjust the samples per volume and the length of a patches queue from the
+    measured time to load a volume and the time the model takes to consume a
+    patch.
+
+    The number of samples per volume is set to the smallest value that keeps
+    the queue from starving, so that as many different subjects as possible
+    are mixed for a given number of patches:
+
+    * If the queue is filled in the background, loading a volume must not
+      take longer than consuming its patches, i.e., ``samples_per_volume >=
+      load_time / consume_time``.
+    * If the queue is filled on demand, training waits for every fill, and the
+      fraction of time spent waiting is ``load_time / (load_time +
+      samples_per_volume * consume_time)``, which is kept below
+      ``target_starvation``.
+
+    The queue length follows the samples per volume, so that each fill mixes
+    the patches of ``subjects_per_fill`` subjects. Both values are kept within
+    the given bounds.
+
+    Parameters
+    ----------
+    min_samples_per_volume : int, optional
+        Lower bound of the samples per volume. Default = ``1``.
+    max_samples_per_volume : int, optional
+        Upper bound of the samples per volume. Default = ``64``.
+    min_length : int, optional
+        Lower bound of the queue length. Default = ``1``.
+    max_length : int, optional
+        Upper bound of the queue length. Default = ``1024``.
+    target_starvation : float, optional
+        Target fraction of time spent waiting for on demand fills. Must be
+        in ``(0, 1)``. Default = ``0.05``.
+    subjects_per_fill : int, optional
+        Number of subjects whose patches are mixed in a fill. If ``None``, the
+        ratio between the initial queue length and samples per volume is kept.
+        Default = ``None``.
+    momentum : float, optional
+        Weight of the past measurements in their exponential moving averages.
+        Default = ``0.5``.
+    warmup : int, optional
+        Number of initial fills ignored, as they include the start of the
+        workers loading the subjects. Default = ``1``.
+    """
+
+    def __init__(
+        self,
+        min_samples_per_volume: int = 1,
+        max_samples_per_volume: int = 64,
+        min_length: int = 1,
+        max_length: int = 1024,
+        target_starvation: float = 0.05,
+        subjects_per_fill: Optional[int] = None,
+        momentum: float = 0.5,
+        warmup: int = 1,
+    ) -> None:
+        if not 1 <= min_samples_per_volume <= max_samples_per_volume:
+            raise ValueError(
+                'Samples per volume bounds must satisfy 1 <='
+                ' min_samples_per_volume <= max_samples_per_volume.')
+        if not 1 <= min_length <= max_length:
+            raise ValueError('Queue length bounds must satisfy 1 <='
+                             ' min_length <= max_length.')
+        if not 0 < target_starvation < 1:
+            raise ValueError('target_starvation must be in (0, 1).')
+        self.min_samples_per_volume = min_samples_per_volume
+        self.max_samples_per_volume = max_samples_per_volume
+        self.min_length = min_length
+        self.max_length = max_length
+        self.target_starvation = target_starvation
+        self.subjects_per_fill = subjects_per_fill
+        self.momentum = momentum
+        self.warmup = warmup
+        self.background = False
+        self.samples_per_volume = min_samples_per_volume
+        self.length = max_length
+        self.load_time: Optional[float] = None
+        self.consume_time: Optional[float] = None
+        self.num_updates = 0
+        self.history: List[Dict[str, Any]] = []
+
+    def __repr__(self) -> str:
+        attributes = [
+            f'samples_per_volume={self.samples_per_volume}',
+            f'length={self.length}',
+            f'load_time={self.load_time}',
+            f'consume_time={self.consume_time}',
+        ]
+        return f'QueueAutoscaler({", ".join(attributes)})'
+
+    def start(self,
+              samples_per_volume: int,
+              length: int,
+              background: bool = False) -> None:
+        """
+        Set the initial values of the queue being scaled.
+
+        Parameters
+        ----------
+        samples_per_volume : int
+            Initial samples per volume of the queue.
+        length : int
+            Initial length of the queue.
+        background : bool, optional
+            Whether the queue is filled in the background. Default = ``False``.
+        """
+        self.background = background
+        if self.subjects_per_fill is None:
+            self.subjects_per_fill = max(length // samples_per_volume, 1)
+        self.samples_per_volume = self._clip(samples_per_volume,
+                                             self.min_samples_per_volume,
+                                             self.max_samples_per_volume)
+        self.length = self._clip(length, self.min_length, self.max_length)
+
+    def update(self, load_time: float, consume_time: float) -> bool:
+        """
+        Add new measurements and compute the new queue parameters.
+
+        Parameters
+        ----------
+        load_time : float
+            Mean time in seconds to load and sample one volume during the last
+            fill.
+        consume_time : float
+            Mean time in seconds between two patches popped since the last
+            fill, excluding the time spent waiting for fills.
+
+        Returns
+        -------
+        _ : bool
+            Whether ``samples_per_volume`` or ``length`` changed.
+        """
+        self.num_updates += 1
+        if self.num_updates <= self.warmup or consume_time <= 0:
+            return False
+        self.load_time = self._average(self.load_time, load_time)
+        self.consume_time = self._average(self.consume_time, consume_time)
+
+        ratio = self.load_time / self.consume_time
+        if not self.background:
+            target = self.target_starvation
+            ratio *= (1 - target) / target
+        samples_per_volume = self._clip(math.ceil(ratio),
+                                        self.min_samples_per_volume,
+                                        self.max_samples_per_volume)
+        assert self.subjects_per_fill is not None
+        length = self._clip(samples_per_volume * self.subjects_per_fill,
+                            self.min_length, self.max_length)
+        changed = (samples_per_volume != self.samples_per_volume
+                   or length != self.length)
+        self.samples_per_volume = samples_per_volume
+        self.length = length
+        self.history.append({
+            'load_time': self.load_time,
+            'consume_time': self.consume_time,
+            'samples_per_volume': samples_per_volume,
+            'length': length,
+        })
+        return changed
+
+    def _average(self, average: Optional[float], value: float) -> float:
+        if average is None:
+            return value
+        return self.momentum * average + (1 - self.momentum) * value
+
+    @staticmethod
+    def _clip(value: int, low: int, high: int) -> int:
+        return int(min(max(value, low), high))
+
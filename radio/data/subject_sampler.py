@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Resumable sampler of the subjects fed to a patches queue.
+"""
+
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+import torch
+from torch.utils.data import Sampler
+
+__all__ = ["SubjectSampler"]
+
+
+class SubjectSampler(Sampler):
+    """
+    Sampler of subject indices whose epoch order and position can be saved
+    and restored.
+
+    A new order is drawn each time the sampler is iterated after all the
+    subjects of the current order have been consumed. The consumer of the
+    subjects, e.g., a patches queue, reports consumed subjects through
+    :meth:`advance`, so the position is not affected by the subjects
+    prefetched by the workers of a :class:`~torch.utils.data.DataLoader`.
+    Loaders delivering subjects out of order, e.g., an
+    :class:`~radio.data.subjects_loader.UnorderedSubjectsLoader`, iterate over
+    :meth:`iter_positions` and report the position of each consumed subject
+    through :meth:`consume` instead. Iterating again over the sampler in the
+    middle of an epoch resumes with the subjects not consumed yet, in the
+    order of the epoch.
+
+    Parameters
+    ----------
+    num_subjects : int
+        Number of subjects in the dataset.
+    shuffle : bool, optional
+        If ``True``, subjects are shuffled every epoch. Default = ``True``.
+    seed : int, optional
+        Seed of the generator used to shuffle the subjects. If ``None``, it
+        is drawn from the default PyTorch generator. Default = ``None``.
+    """
+
+    def __init__(self,
+                 num_subjects: int,
+                 shuffle: bool = True,
+                 seed: Optional[int] = None) -> None:
+        # pylint: disable=super-init-not-called
+        self.num_subjects = num_subjects
+        self.shuffle = shuffle
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.generator = torch.Generator().manual_seed(seed)
+        self.epoch = 0
+        self.consumed: Set[int] = set()
+        self.order: Optional[torch.Tensor] = None
+        # First position of the epoch not consumed yet
+        self._cursor = 0
+
+    def __len__(self) -> int:
+        return self.num_subjects
+
+    def __iter__(self) -> Iterator[int]:
+        for _, index in self.iter_positions():
+            yield index
+
+    @property
+    def position(self) -> int:
+        """Number of subjects of the epoch consumed so far."""
+        return len(self.consumed)
+
+    def iter_positions(self) -> Iterator[Tuple[int, int]]:
+        """
+        Iterate over the ``(position, index)`` pairs of the subjects of the
+        epoch not consumed yet, where ``position`` is the position of subject
+        ``index`` in the order of the epoch.
+        """
+        if self.order is None or len(self.consumed) >= len(self.order):
+            self._new_epoch()
+        assert self.order is not None
+        start = self._cursor
+        for position, index in enumerate(self.order[start:].tolist(), start):
+            if position not in self.consumed:
+                yield position, index
+
+    def _new_epoch(self) -> None:
+        if self.shuffle:
+            self.order = torch.randperm(self.num_subjects,
+                                        generator=self.generator)
+        else:
+            self.order = torch.arange(self.num_subjects)
+        self.consumed = set()
+        self._cursor = 0
+        self.epoch += 1
+
+    def _move_cursor(self) -> None:
+        # Move the cursor past the positions already consumed
+        assert self.order is not None
+        while (self._cursor < len(self.order)
+               and self._cursor in self.consumed):
+            self._cursor += 1
+
+    def advance(self, num_subjects: int = 1) -> None:
+        """
+        Mark the first ``num_subjects`` subjects of the epoch not consumed yet
+        as consumed, for loaders delivering subjects in order.
+        """
+        if self.order is None or len(self.consumed) >= len(self.order):
+            self._new_epoch()
+        assert self.order is not None
+        while num_subjects and self._cursor < len(self.order):
+            self.consumed.add(self._cursor)
+            self._move_cursor()
+            num_subjects -= 1
+
+    def consume(self, position: int) -> None:
+        """Mark the subject at ``position`` of the epoch as consumed."""
+        self.consumed.add(position)
+        if self.order is not None:
+            self._move_cursor()
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Get the epoch, subjects order, consumed positions, and generator
+        state.
+        """
+        return {
+            'epoch': self.epoch,
+            'consumed': sorted(self.consumed),
+            'order': None if self.order is None else self.order.tolist(),
+            'generator': self.generator.get_state(),
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """Restore a state returned by :meth:`state_dict`."""
+        self.epoch = state_dict['epoch']
+        self.consumed = set(state_dict['consumed'])
+        order = state_dict['order']
+        self.order = None if order is None else torch.as_tensor(order)
+        self.generator.set_state(state_dict['generator'])
+        self._cursor = 0
+        if self.order is not None:
+            self._move_cursor()
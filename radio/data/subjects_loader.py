@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Loaders of the subjects fed to patches queues, delivering each subject as
+soon as a worker has loaded it.
+"""
+
+import copy
+import os
+import queue
+import time
+import warnings
+from collections import OrderedDict
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torchio as tio  # type: ignore
+from torch.utils.data import Dataset
+
+__all__ = [
+    "UnorderedSubjectsLoader", "SubjectsPool", "CacheableSubjectsDataset"
+]
+
+# Datasets of the current worker process by key, set by _initialize_worker
+_WORKER_DATASETS: Dict[int, Dataset] = {}
+# Decoded volumes of the current worker process, set by _initialize_worker
+_WORKER_CACHE: Optional['_VolumeCache'] = None
+
+
+class _VolumeCache:
+    """Least recently used decoded images of a worker process, by path."""
+
+    def __init__(self, max_volumes: int) -> None:
+        self.max_volumes = max_volumes
+        self._volumes: 'OrderedDict[str, Tuple[torch.Tensor, np.ndarray]]'
+        self._volumes = OrderedDict()
+
+    def load(self, image: tio.Image) -> None:
+        # pylint: disable=protected-access
+        if image._loaded or image.path is None:
+            image.load()
+            return
+        key = str(image.path)
+        if key in self._volumes:
+            self._volumes.move_to_end(key)
+            tensor, affine = self._volumes[key]
+            # Transforms copy the subject, so the cached tensor is not
+            # modified in place
+            image.set_data(tensor)
+            image.affine = affine
+            image._loaded = True
+            return
+        image.load()
+        self._volumes[key] = (image.data, image.affine)
+        if len(self._volumes) > self.max_volumes:
+            self._volumes.popitem(last=False)
+
+
+def _initialize_worker(datasets: Dict[int, Dataset],
+                       base_seed: int,
+                       cache_size: int = 0) -> None:
+    global _WORKER_DATASETS, _WORKER_CACHE  # pylint: disable=global-statement
+    _WORKER_DATASETS = datasets
+    _WORKER_CACHE = _VolumeCache(cache_size) if cache_size > 0 else None
+    # Forked workers inherit the RNG state of the parent, seed them like the
+    # DataLoader workers so that random transforms differ between workers
+    seed = (base_seed + os.getpid()) % 2**32
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+
+def _get_item(dataset: Dataset, index: int) -> Any:
+    cache = _WORKER_CACHE
+    load_item = getattr(dataset, 'load_item', None)
+    if cache is None or load_item is None:
+        return dataset[index]
+    return load_item(index, cache.load)
+
+
+def _is_cacheable(dataset: Dataset) -> bool:
+    return (hasattr(dataset, 'load_item')
+            and getattr(dataset, 'load_getitem', True))
+
+
+def _load_subject(position: int, index: int, key: int = 0) -> Tuple[int, Any]:
+    return position, _get_item(_WORKER_DATASETS[key], index)
+
+
+class _Failure:
+    """Exception raised by a worker, sent back to the main process."""
+
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+class CacheableSubjectsDataset(tio.SubjectsDataset):
+    """
+    :class:`~torchio.data.SubjectsDataset` whose images can be read through
+    the volume cache of the workers of a :class:`SubjectsPool`.
+
+    Items are loaded as in :class:`~torchio.data.SubjectsDataset`, so the
+    dataset is a drop-in replacement for it.
+    """
+
+    def load_item(self, index: int,
+                  load_image: Callable[[tio.Image], None]) -> tio.Subject:
+        """
+        Get subject ``index``, reading its images with ``load_image``.
+
+        Parameters
+        ----------
+        index : int
+            Index of the subject.
+        load_image : Callable[[tio.Image], None]
+            Function loading the data of an image in place. Only used if
+            ``load_getitem`` is ``True``.
+
+        Returns
+        -------
+        subject : tio.Subject
+            Loaded and transformed subject.
+        """
+        # Cheap, since the images are not loaded yet
+        subject = copy.deepcopy(self.dry_iter()[int(index)])
+        if self.load_getitem:
+            for image in subject.get_images(intensity_only=False):
+                load_image(image)
+        if self._transform is not None:
+            subject = self._transform(subject)
+        return subject
+
+
+class SubjectsPool:
+    """
+    Worker processes loading the subjects of several datasets, e.g., the
+    train and validation datasets of a datamodule.
+
+    Each :class:`UnorderedSubjectsLoader` created with the pool sends its
+    subjects to the same ``num_workers`` workers, instead of starting workers
+    of its own. The datasets are registered before the workers are started,
+    as the workers receive them once, when they start. Each dataset applies
+    its own transform, so the loaders of the pool can use different
+    augmentations.
+
+    Subjects are routed to the workers by index, so datasets built over the
+    same list of subjects always load a given subject in the same worker. If
+    ``cache_size`` is positive, each worker keeps the decoded images of its
+    ``cache_size`` most recently loaded subjects, and the subjects of other
+    datasets still read from the cache are not read from disk again.
+
+    The cache is only used by datasets with a ``load_item(index,
+    load_image)`` method, which returns item ``index`` with its images read
+    by ``load_image``, such as :class:`CacheableSubjectsDataset` and
+    :class:`~radio.data.unpaired_dataset.MRIUnpairedDataset`, and whose
+    ``load_getitem`` is ``True``. Registering another dataset in a pool with
+    a cache raises a warning.
+
+    Parameters
+    ----------
+    num_workers : int
+        Number of worker processes. Must be at least ``1``.
+    cache_size : int, optional
+        Number of decoded subjects cached by each worker. ``0`` disables the
+        cache. Default = ``0``.
+    """
+
+    def __init__(self, num_workers: int, cache_size: int = 0) -> None:
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1.')
+        if cache_size < 0:
+            raise ValueError('cache_size must be non-negative.')
+        self.num_workers = num_workers
+        self.cache_size = cache_size
+        self._datasets: Dict[int, Dataset] = {}
+        self._pools: Optional[List[Any]] = None
+
+    def __del__(self) -> None:
+        self.close()
+
+    @property
+    def is_started(self) -> bool:
+        """Whether the worker processes are running."""
+        return self._pools is not None
+
+    def register(self, dataset: Dataset) -> int:
+        """
+        Register a dataset whose subjects are loaded by the pool.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            Dataset from which to load the subjects.
+
+        Returns
+        -------
+        key : int
+            Key of the dataset in the pool. Registering the same dataset
+            again returns the same key.
+        """
+        for key, registered in self._datasets.items():
+            if registered is dataset:
+                return key
+        if self.is_started:
+            raise RuntimeError(
+                'Datasets must be registered before the workers are started.')
+        if self.cache_size > 0 and not _is_cacheable(dataset):
+            warnings.warn(
+                f'{type(dataset).__name__} does not read its images through '
+                'the cache of the workers, its subjects are read from disk '
+                'every time they are loaded.', RuntimeWarning)
+        key = len(self._datasets)
+        self._datasets[key] = dataset
+        return key
+
+    def apply_async(self, key: int, position: int, index: int,
+                    callback: Callable[[Any], None],
+                    error_callback: Callable[[BaseException], None]) -> None:
+        """Load subject ``index`` of dataset ``key`` in a worker."""
+        if self._pools is None:
+            self._start()
+        assert self._pools is not None
+        pool = self._pools[index % self.num_workers]
+        pool.apply_async(_load_subject, (position, index, key),
+                         callback=callback,
+                         error_callback=error_callback)
+
+    def _start(self) -> None:
+        base_seed = int(torch.empty((), dtype=torch.int64).random_())
+        # A single process pool per worker, so that tasks can be routed
+        self._pools = [
+            mp.Pool(1,
+                    initializer=_initialize_worker,
+                    initargs=(self._datasets, base_seed, self.cache_size))
+            for _ in range(self.num_workers)
+        ]
+
+    def close(self) -> None:
+        """Terminate the worker processes."""
+        if self._pools is not None:
+            for pool in self._pools:
+                pool.terminate()
+            self._pools = None
+
+
+class UnorderedSubjectsLoader:
+    """
+    Load subjects in worker processes, yielding them in completion order.
+
+    A :class:`~torch.utils.data.DataLoader` yields samples in the order of its
+    sampler, so a subject that is slow to load or augment blocks the delivery
+    of the subjects already loaded by the other workers. This loader keeps
+    ``num_workers * prefetch_factor`` subjects in flight and yields whichever
+    is ready first. The subjects of an epoch are still the ones drawn by
+    ``sampler``, only their delivery order within the window of subjects in
+    flight changes.
+
+    The time saved is tracked in :attr:`head_of_line_time`: for the ``k``-th
+    subject of the sampler order, loaded at time ``t_k``, an ordered loader
+    would have delivered it at ``max(ordered_k-1, t_k)``, and the difference
+    with ``t_k`` is time spent waiting behind slower subjects.
+
+    If ``sampler`` is a :class:`~radio.data.subject_sampler.SubjectSampler`,
+    the subjects are drawn from its :meth:`iter_positions`, and the position
+    in the epoch of the last subject yielded is kept in
+    :attr:`last_position`, so that the consumer can report exactly which
+    subjects were consumed.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Dataset from which to load the subjects.
+    sampler : Iterable[int]
+        Iterable over the indices of the subjects of an epoch.
+    num_workers : int
+        Number of worker processes. Must be at least ``1``.
+    prefetch_factor : int, optional
+        Number of subjects in flight per worker. Default = ``2``.
+    persistent_workers : bool, optional
+        If ``True``, the worker processes are kept alive across epochs.
+        Default = ``True``.
+    pool : SubjectsPool, optional
+        Pool whose workers load the subjects. If ``None``, the loader starts
+        ``num_workers`` workers of its own. The workers of a pool are kept
+        alive until the pool is closed. Default = ``None``.
+    """
+
+    def __init__(self,
+                 dataset: Dataset,
+                 sampler: Iterable[int],
+                 num_workers: int,
+                 prefetch_factor: int = 2,
+                 persistent_workers: bool = True,
+                 pool: Optional[SubjectsPool] = None) -> None:
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1.')
+        if prefetch_factor < 1:
+            raise ValueError('prefetch_factor must be at least 1.')
+        self.dataset = dataset
+        self.sampler = sampler
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.pool = pool
+        self._key = pool.register(dataset) if pool is not None else 0
+        self.head_of_line_time = 0.0
+        self.num_reordered = 0
+        self.last_position: Optional[int] = None
+        self._own_pool: Optional[Any] = None
+
+    def __len__(self) -> int:
+        return len(self.sampler)  # type: ignore
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.pool is not None:
+            return self._iterate(self._apply_shared)
+        if self._own_pool is None:
+            base_seed = int(torch.empty((), dtype=torch.int64).random_())
+            self._own_pool = mp.Pool(self.num_workers,
+                                     initializer=_initialize_worker,
+                                     initargs=({
+                                         0: self.dataset
+                                     }, base_seed))
+        return self._iterate(self._apply_own)
+
+    def _apply_own(self, position: int, index: int,
+                   callback: Callable[[Any], None],
+                   error_callback: Callable[[BaseException], None]) -> None:
+        assert self._own_pool is not None
+        self._own_pool.apply_async(_load_subject, (position, index),
+                                   callback=callback,
+                                   error_callback=error_callback)
+
+    def _apply_shared(self, position: int, index: int,
+                      callback: Callable[[Any], None],
+                      error_callback: Callable[[BaseException], None]) -> None:
+        assert self.pool is not None
+        self.pool.apply_async(self._key, position, index, callback,
+                              error_callback)
+
+    def __del__(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Terminate the worker processes, unless they belong to a pool."""
+        if self._own_pool is not None:
+            self._own_pool.terminate()
+            self._own_pool = None
+
+    def _iterate(self, apply_async: Callable[..., None]) -> Iterator[Any]:
+        results: queue.Queue = queue.Queue()
+        iter_positions = getattr(self.sampler, 'iter_positions', None)
+        if iter_positions is not None:
+            indices = enumerate(iter_positions())
+        else:
+            indices = enumerate(enumerate(iter(self.sampler)))
+        # Position in the sampler epoch of each subject in flight, by
+        # submission order
+        sampler_positions: Dict[int, int] = {}
+        num_in_flight = 0
+
+        # Results are timed when they reach the main process, not when they
+        # are consumed
+        def on_result(result: Any) -> None:
+            results.put((time.perf_counter(), result))
+
+        def on_error(exception: BaseException) -> None:
+            results.put((time.perf_counter(), _Failure(exception)))
+
+        def submit() -> bool:
+            try:
+                position, (sampler_position, index) = next(indices)
+            except StopIteration:
+                return False
+            sampler_positions[position] = sampler_position
+            apply_async(position, int(index), on_result, on_error)
+            return True
+
+        for _ in range(self.num_workers * self.prefetch_factor):
+            if not submit():
+                break
+            num_in_flight += 1
+
+        # Completion times of the subjects not yet delivered by an ordered
+        # loader, by position in the sampler order
+        ready_times: Dict[int, float] = {}
+        next_ordered = 0
+        ordered_time = 0.0
+        while num_in_flight:
+            ready_time, result = results.get()
+            num_in_flight -= 1
+            if isinstance(result, _Failure):
+                raise result.exception
+            if submit():
+                num_in_flight += 1
+            position, subject = result
+            ready_times[position] = ready_time
+            if position != next_ordered:
+                self.num_reordered += 1
+            while next_ordered in ready_times:
+                completion_time = ready_times.pop(next_ordered)
+                ordered_time = max(ordered_time, completion_time)
+                self.head_of_line_time += ordered_time - completion_time
+                next_ordered += 1
+            self.last_position = sampler_positions.pop(position)
+            yield subject
+
+        if not self.persistent_workers:
+            self.close()
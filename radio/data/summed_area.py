@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Summed-area tables of 3D masks, to sum a mask over many boxes in constant
+time per box.
+"""
+
+import torch
+import torch.nn.functional as F
+
+__all__ = ["get_summed_area_table", "get_box_sums"]
+
+
+def get_summed_area_table(mask: torch.Tensor) -> torch.Tensor:
+    """
+    Get the summed-area table of a ``(w, h, d)`` mask.
+
+    Parameters
+    ----------
+    mask : torch.Tensor
+        ``(w, h, d)`` tensor. The table has the same dtype.
+
+    Returns
+    -------
+    table : torch.Tensor
+        ``(w + 1, h + 1, d + 1)`` tensor whose entry ``[i, j, k]`` is the sum
+        of ``mask`` over ``[:i, :j, :k]``.
+    """
+    table = mask.cumsum(0).cumsum(1).cumsum(2)
+    return F.pad(table, (1, 0, 1, 0, 1, 0))
+
+
+def get_box_sums(table: torch.Tensor, ini: torch.Tensor,
+                 end: torch.Tensor) -> torch.Tensor:
+    """
+    Sum a mask over boxes, reading its summed-area table at the 8 corners of
+    each box.
+
+    Integer corners index the table directly, and the sums are exact.
+    Floating-point corners are trilinearly interpolated in the table, which
+    assumes the mask is spread uniformly within each of its elements.
+
+    Parameters
+    ----------
+    table : torch.Tensor
+        Summed-area table returned by :func:`get_summed_area_table`.
+    ini : torch.Tensor
+        ``(N, 3)`` tensor of the first corners of the boxes, in elements of
+        the mask.
+    end : torch.Tensor
+        ``(N, 3)`` tensor of the last (exclusive) corners of the boxes.
+
+    Returns
+    -------
+    sums : torch.Tensor
+        ``(N,)`` tensor of the sums of the mask over the boxes.
+    """
+    read = _interpolate if ini.is_floating_point() else _index
+    total = torch.zeros(len(ini), dtype=table.dtype)
+    for corner in range(8):
+        # Inclusion-exclusion over the 8 corners of the box
+        use_end = [(corner >> axis) & 1 == 1 for axis in range(3)]
+        point = torch.where(torch.as_tensor(use_end), end, ini)
+        sign = (-1)**(3 - sum(use_end))
+        total += sign * read(table, point)
+    return total
+
+
+def _index(table: torch.Tensor, points: torch.Tensor) -> torch.Tensor:
+    return table[points[:, 0], points[:, 1], points[:, 2]]
+
+
+def _interpolate(table: torch.Tensor, points: torch.Tensor) -> torch.Tensor:
+    shape = torch.as_tensor(table.shape, dtype=points.dtype) - 1
+    points = torch.minimum(points.clamp(min=0), shape)
+    floor = torch.minimum(points.floor(), (shape - 1).clamp(min=0))
+    weights = points - floor
+    floor = floor.long()
+    values = torch.zeros(len(points), dtype=table.dtype)
+    for corner in range(8):
+        offsets = [(corner >> axis) & 1 for axis in range(3)]
+        index = [floor[:, axis] + offsets[axis] for axis in range(3)]
+        weight = torch.ones(len(points), dtype=table.dtype)
+        for axis, offset in enumerate(offsets):
+            axis_weights = weights[:, axis]
+            weight *= axis_weights if offset else 1 - axis_weights
+        values += weight * table[index[0], index[1], index[2]]
+    return values
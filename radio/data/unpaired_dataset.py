@@ -4,6 +4,7 @@
 This module implements the Unpaired Dataset class.
 """
 
+import copy
 import sys
 from string import Template
 from pathlib import Path
@@ -11,6 +12,7 @@ from multiprocessing import Manager
 from typing import Any, Callable, Dict, List, Optional, Tuple, cast
 import numpy as np
 import torch
+from torch.utils.data import Dataset
 import torchio as tio  # type: ignore
 from radio.settings.pathutils import (DATA_ROOT, is_dir_or_symlink, PathType,
                                       MRI_EXTENSIONS)
@@ -21,7 +23,10 @@ from .datatypes import SpatialShapeType
 Sample = Tuple[Path, int]
 PairedSample = Dict[str, Tuple[Any, ...]]
 
-__all__ = ["UnpairedDataset", "MRIUnpairedDataset", "MRISliceUnpairedDataset"]
+__all__ = [
+    "UnpairedDataset", "MRIUnpairedDataset", "MRISliceUnpairedDataset",
+    "UnpairedDomainDataset"
+]
 
 
 class UnpairedDataset(FolderDataset):
@@ -347,26 +352,85 @@ class MRIUnpairedDataset(UnpairedDataset):
                        f' but an object of type "{type(idx)}" was passed.')
             raise ValueError(message) from idx_not_int
 
+        sample_a = self.get_subject(idx, self.domain_a)
+        sample_b = self.get_subject(idx, self.domain_b)
+
+        return sample_a, sample_b
+
+    def load_item(
+        self, idx: int, load_image: Callable[[tio.Image], None]
+    ) -> Tuple[tio.Subject, tio.Subject]:
+        """
+        Same as :meth:`__getitem__`, reading the images with ``load_image``.
+
+        Parameters
+        ----------
+        idx : int
+            A (random) integer for data intexing.
+        load_image : Callable[[tio.Image], None]
+            Function loading the data of an image in place, e.g., from the
+            cache of the workers of a
+            :class:`~radio.data.subjects_loader.SubjectsPool`. Only used if
+            ``load_getitem`` is ``True``.
+        """
+        idx = int(idx)
+        sample_a = self.get_subject(idx, self.domain_a, load_image)
+        sample_b = self.get_subject(idx, self.domain_b, load_image)
+        return sample_a, sample_b
+
+    def get_subject(
+        self,
+        idx: int,
+        domain: str,
+        load_image: Optional[Callable[[tio.Image], None]] = None,
+    ) -> tio.Subject:
+        """
+        Load and transform a subject of a single domain.
+
+        Parameters
+        ----------
+        idx : int
+            A (random) integer for data intexing.
+        domain : str
+            Either ``domain_a`` or ``domain_b``.
+        load_image : Callable[[tio.Image], None], optional
+            Function loading the data of an image in place. If ``None``, the
+            images are loaded from disk. Only used if ``load_getitem`` is
+            ``True``. Default = ``None``.
+
+        Returns
+        -------
+        sample : tio.Subject
+            Subject ``idx`` of ``domain``.
+        """
         # Make sure indexes are within A and B ranges
-        # sample_a, sample_b = self.loader(path_a), self.loader(path_b)
-        sample_a, target_a = self._subjects_a[idx % self.size_a]
-        sample_b, target_b = self._subjects_b[idx % self.size_b]
+        if domain == self.domain_a:
+            sample, _ = self._subjects_a[idx % self.size_a]
+            offset = 0
+        elif domain == self.domain_b:
+            sample, _ = self._subjects_b[idx % self.size_b]
+            offset = 10
+        else:
+            raise ValueError(f'Unknown domain "{domain}".')
+
+        if self.load_getitem and load_image is not None:
+            # The loaded images are then only kept by ``load_image``
+            sample = copy.deepcopy(sample)
+            for image in sample.get_images(intensity_only=False):
+                load_image(image)
+
         if self.add_sampling_map:
-            sample_a = self.get_sampling_map(sample_a,
-                                             patch_size=self.patch_size)
-            sample_b = self.get_sampling_map(sample_b,
-                                             patch_size=self.patch_size,
-                                             offset=10)
+            sample = self.get_sampling_map(sample,
+                                           patch_size=self.patch_size,
+                                           offset=offset)
 
         if self.load_getitem:
-            sample_a.load()
-            sample_b.load()
+            sample.load()
 
         if self.transform is not None:
-            sample_a = self.transform(sample_a)
-            sample_b = self.transform(sample_b)
+            sample = self.transform(sample)
 
-        return sample_a, sample_b
+        return sample
 
     def get_max_shape(self) -> Tuple[int, int, int]:
         """
@@ -613,3 +677,49 @@ class MRISliceUnpairedDataset(UnpairedDataset):
         shapes = np.array(shapes_a + shapes_b)
         shapes_tuple = tuple(map(int, shapes.max(axis=0).tolist()))
         return cast(Tuple[int, int, int], shapes_tuple)
+
+
+class UnpairedDomainDataset(Dataset):
+    """
+    View over a single domain of a :class:`MRIUnpairedDataset`.
+
+    Only the subjects of ``domain`` are loaded and transformed, which allows
+    iterating over each domain independently.
+
+    Parameters
+    ----------
+    dataset : MRIUnpairedDataset
+        Unpaired dataset.
+    domain : str
+        Either ``dataset.domain_a`` or ``dataset.domain_b``.
+    """
+
+    def __init__(self, dataset: MRIUnpairedDataset, domain: str) -> None:
+        if domain not in (dataset.domain_a, dataset.domain_b):
+            raise ValueError(f'Unknown domain "{domain}".')
+        self.dataset = dataset
+        self.domain = domain
+
+    def __len__(self) -> int:
+        if self.domain == self.dataset.domain_a:
+            return self.dataset.size_a
+        return self.dataset.size_b
+
+    @property
+    def load_getitem(self) -> bool:
+        """Whether the images of the subjects are loaded when indexed."""
+        return self.dataset.load_getitem
+
+    def __getitem__(self, idx: int) -> tio.Subject:
+        return self.dataset.get_subject(int(idx), self.domain)
+
+    def load_item(self, idx: int,
+                  load_image: Callable[[tio.Image], None]) -> tio.Subject:
+        """Same as :meth:`__getitem__`, reading images with ``load_image``."""
+        return self.dataset.get_subject(int(idx), self.domain, load_image)
+
+    def dry_iter(self):
+        """Return the internal list of subjects of the domain."""
+        if self.domain == self.dataset.domain_a:
+            return self.dataset.dry_iter_a()
+        return self.dataset.dry_iter_b()
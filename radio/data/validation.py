@@ -10,8 +10,8 @@ every epoch to reduce model overfitting, use Python's ``multiprocessing``
 to speed up data retrieval, and automatic memory pinning, in an easy API.
 """
 
-from typing import (Any, Callable, List, TypeVar, Iterator, Tuple, Union,
-                    Optional)
+from typing import (Any, Callable, Dict, List, TypeVar, Iterator, Tuple,
+                    Union, Optional)
 import numpy as np
 from sklearn.model_selection import KFold  # type: ignore
 import torch
@@ -52,7 +52,9 @@ class KFoldValidation:
         validation data from the train_dataset. ``val_dataset`` must be of the
         same size as ``train_dataset``. Default = None.
     batch_size : int, optional
-        How many samples per batch to load. Default = ``32``.
+        How many samples per batch to load. If ``None``, automatic batching
+        is disabled, e.g., for datasets that already yield batches.
+        Default = ``32``.
     shuffle : bool, optional
         Whether to shuffle the data before splitting into batches. Note that
         the samples within each split will not be shuffled.
@@ -89,7 +91,7 @@ class KFoldValidation:
         self,
         train_dataset: DatasetType,
         val_dataset: DatasetType = None,
-        batch_size: int = 32,
+        batch_size: Optional[int] = 32,
         shuffle: bool = True,
         num_workers: int = 0,
         collate_fn: CollateFnType = None,
@@ -179,6 +181,51 @@ class KFoldValidation:
         train_idx, val_idx = next(self.kfold_split)
         return (train_idx, val_idx)
 
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Get the state of the folds, to resume them from a checkpoint.
+
+        Returns
+        -------
+        _ : Dict[str, Any]
+            Current fold, train and validation indexes of every fold, and state
+            of the generator used to shuffle the samples.
+        """
+        return {
+            'fold': getattr(self, 'fold', None),
+            'generator': self.generator.get_state(),
+            'train_indices': [
+                list(sampler.indices) for sampler in self.train_samplers
+            ],
+            'val_indices': [
+                list(sampler.indices) for sampler in self.val_samplers
+            ],
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Restore a state returned by ``state_dict``.
+
+        Parameters
+        ----------
+        state_dict : Dict[str, Any]
+            State of the folds.
+        """
+        if state_dict['fold'] is not None:
+            self.fold = state_dict['fold']
+        self.generator.set_state(state_dict['generator'])
+        self.train_samplers = [
+            SubsetRandomSampler(indices, generator=self.generator)
+            for indices in state_dict['train_indices']
+        ]
+        self.val_samplers = [
+            SubsetRandomSampler(indices, generator=self.generator)
+            for indices in state_dict['val_indices']
+        ]
+        if self.train_samplers:
+            self.size_train = len(self.train_samplers[0])
+            self.size_val = len(self.val_samplers[0])
+
     def train_dataloader(self) -> TrainDataLoaderType:
         """
         Generates one or multiple Pytorch DataLoaders for train.
@@ -241,6 +288,10 @@ class KFoldValidation:
         dataset = self.train_dataset if train else self.val_dataset
         sampler = (self.train_samplers[dataloader_idx]
                    if train else self.val_samplers[dataloader_idx])
+        if hasattr(dataset, 'get_epoch_sampler'):
+            # Patches queues start a new epoch each time the loader is
+            # iterated, and end it once the subset has been drawn
+            sampler = dataset.get_epoch_sampler(sampler)
         return DataLoader(
             dataset=dataset,
             batch_size=self.batch_size,
@@ -267,7 +318,9 @@ class OneFoldValidation:
         validation data from the train_dataset. ``val_dataset`` must be of the
         same size as ``train_dataset``. Default = None.
     batch_size : int, optional
-        How many samples per batch to load. Default = ``32``.
+        How many samples per batch to load. If ``None``, automatic batching
+        is disabled, e.g., for datasets that already yield batches.
+        Default = ``32``.
     shuffle : bool, optional
         Whether to shuffle the data at every epoch. Default = ``False``.
     num_workers : int, optional
@@ -304,7 +357,7 @@ class OneFoldValidation:
         self,
         train_dataset: DatasetType,
         val_dataset: DatasetType = None,
-        batch_size: int = 32,
+        batch_size: Optional[int] = 32,
         shuffle: bool = True,
         num_workers: int = 0,
         collate_fn: CollateFnType = None,
@@ -409,6 +462,51 @@ class OneFoldValidation:
 
         return (train_idx, val_idx)
 
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Get the state of the split, to resume it from a checkpoint.
+
+        Returns
+        -------
+        _ : Dict[str, Any]
+            Train and validation indexes, and state of the generator used to
+            shuffle the samples.
+        """
+        return {
+            'generator': self.generator.get_state(),
+            'train_indices': [
+                list(sampler.indices) for sampler in self.train_samplers
+            ],
+            'val_indices': [
+                list(sampler.indices) for sampler in self.val_samplers
+            ],
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Restore a state returned by ``state_dict``.
+
+        The split is restored as it was, since ``setup`` draws it from the
+        global NumPy RNG.
+
+        Parameters
+        ----------
+        state_dict : Dict[str, Any]
+            State of the split.
+        """
+        self.generator.set_state(state_dict['generator'])
+        self.train_samplers = [
+            SubsetRandomSampler(indices, generator=self.generator)
+            for indices in state_dict['train_indices']
+        ]
+        self.val_samplers = [
+            SubsetRandomSampler(indices, generator=self.generator)
+            for indices in state_dict['val_indices']
+        ]
+        if self.train_samplers:
+            self.size_train = len(self.train_samplers[0])
+            self.size_val = len(self.val_samplers[0])
+
     def train_dataloader(self) -> TrainDataLoaderType:
         """
         Generates one or multiple Pytorch DataLoaders for train.
@@ -465,6 +563,10 @@ class OneFoldValidation:
         dataset = self.train_dataset if train else self.val_dataset
         sampler = (self.train_samplers[dataloader_idx]
                    if train else self.val_samplers[dataloader_idx])
+        if hasattr(dataset, 'get_epoch_sampler'):
+            # Patches queues start a new epoch each time the loader is
+            # iterated, and end it once the subset has been drawn
+            sampler = dataset.get_epoch_sampler(sampler)
         return DataLoader(
             dataset=dataset,
             batch_size=self.batch_size,
@@ -12,7 +12,7 @@ from abc import abstractmethod
 from typing import (Any, Callable, Mapping, Optional, Sequence, Sized, List,
                     Tuple, cast)
 import shutil
-from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data import DataLoader, IterableDataset, RandomSampler
 import torchio as tio
 import numpy as np
 from ..settings.pathutils import is_dir_or_symlink
@@ -320,10 +320,18 @@ class VisionDataModule(BaseDataModule):
         """
         shuffle = shuffle if shuffle else self.shuffle
         shuffle &= not isinstance(dataset, IterableDataset)
+        sampler = None
+        if hasattr(dataset, 'get_epoch_sampler'):
+            # Patches queues start a new epoch each time the loader is
+            # iterated
+            sampler = dataset.get_epoch_sampler(
+                RandomSampler(dataset) if shuffle else None)
+            shuffle = False
         return DataLoader(
             dataset=dataset,
             batch_size=batch_size if batch_size else self.batch_size,
             shuffle=shuffle,
+            sampler=sampler,
             num_workers=num_workers if num_workers else self.num_workers,
             pin_memory=pin_memory if pin_memory else self.pin_memory,
             drop_last=drop_last if drop_last else self.drop_last,